@@ -0,0 +1,267 @@
+import os
+import time
+import shutil
+import asyncio
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+from dotenv import load_dotenv
+
+from database import SessionLocal, BackgroundJob, GeneratedFile, MailingRecipient
+from mail_queue import PENDING_STATES
+from pdf_generator import PDF_GENERATED_DIR, DOCX_TEMP_DIR
+from mailing_store import delete_stale_mailings
+
+load_dotenv()
+
+# Erzeugte Dateien liegen pro Benutzer und Job unter generated_pdfs/<user_id>/<job_id>/.
+# Verzeichnisse, die nicht zu einem Benutzer gehören und eigene Aufräumregeln haben:
+RESERVED_DIRS = {".cache"}
+
+ARTIFACT_TTL_HOURS = float(os.environ.get("ARTIFACT_TTL_HOURS", "48"))
+ARTIFACT_USER_QUOTA_MB = int(os.environ.get("ARTIFACT_USER_QUOTA_MB", "500"))
+ARTIFACT_GLOBAL_QUOTA_MB = int(os.environ.get("ARTIFACT_GLOBAL_QUOTA_MB", "5000"))
+# Ab diesem Füllstand (Prozent der globalen Quote bzw. des Datenträgers) wird gewarnt
+ARTIFACT_ALERT_PERCENT = float(os.environ.get("ARTIFACT_ALERT_PERCENT", "85"))
+ARTIFACT_SWEEP_INTERVAL_SECONDS = int(os.environ.get("ARTIFACT_SWEEP_INTERVAL_SECONDS", "600"))
+# Temporäre DOCX-Dateien abgebrochener Läufe werden nach dieser Zeit entfernt
+TEMP_DOCX_MAX_AGE_SECONDS = 3600
+
+_usage_lock = threading.Lock()
+_last_usage: Dict[str, object] = {"total_bytes": 0, "per_user": {}, "swept_at": None}
+_sweeper_task: Optional[asyncio.Task] = None
+
+
+def job_output_subdir(user_id: int, job_id: int) -> str:
+    """Relativer Pfad (unterhalb von generated_pdfs) für die Dateien eines Jobs."""
+    return f"{int(user_id)}/{int(job_id)}"
+
+
+def job_output_dir(user_id: int, job_id: int) -> str:
+    path = os.path.join(PDF_GENERATED_DIR, str(int(user_id)), str(int(job_id)))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _directory_size(path: str) -> Tuple[int, float]:
+    """Gesamtgröße und jüngste Änderungszeit aller Dateien unterhalb von `path`."""
+    total_bytes, newest_mtime = 0, 0.0
+    for directory, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                stat_result = os.stat(os.path.join(directory, filename))
+            except OSError:
+                continue
+            total_bytes += stat_result.st_size
+            newest_mtime = max(newest_mtime, stat_result.st_mtime)
+    return total_bytes, newest_mtime or os.path.getmtime(path)
+
+
+def _scan_job_dirs() -> List[Tuple[float, int, int, int, str]]:
+    """Alle Job-Verzeichnisse als (letzte Änderung, Größe, user_id, job_id, Pfad)."""
+    job_dirs = []
+    try:
+        user_entries = [entry for entry in os.scandir(PDF_GENERATED_DIR)
+                        if entry.is_dir() and entry.name not in RESERVED_DIRS and entry.name.isdigit()]
+    except FileNotFoundError:
+        return job_dirs
+    for user_entry in user_entries:
+        for job_entry in os.scandir(user_entry.path):
+            if job_entry.is_dir() and job_entry.name.isdigit():
+                size, mtime = _directory_size(job_entry.path)
+                job_dirs.append((mtime, size, int(user_entry.name), int(job_entry.name), job_entry.path))
+    return job_dirs
+
+
+def _job_dir_of(path: str) -> Optional[Tuple[int, int]]:
+    """(user_id, job_id) des Job-Verzeichnisses, in dem eine erzeugte Datei liegt, sonst None."""
+    relative_path = os.path.relpath(os.path.abspath(path), os.path.abspath(PDF_GENERATED_DIR))
+    parts = relative_path.split(os.sep)
+    if len(parts) >= 3 and parts[0].isdigit() and parts[1].isdigit():
+        return int(parts[0]), int(parts[1])
+    return None
+
+
+def _protected_job_dirs() -> Tuple[Set[int], Set[Tuple[int, int]]]:
+    """
+    Was nicht gelöscht werden darf: die IDs laufender Jobs sowie die Verzeichnisse (user_id, job_id), auf die
+    noch offene E-Mails der Ausgangs-Warteschlange oder Vorschau-Einträge eines Vorgangs verweisen. Deren
+    Generierungs-Job ist längst beendet, der Versand kann aber über Tage warten (Wiederholungen, Tageslimit).
+    """
+    db = SessionLocal()
+    try:
+        active_job_ids = {job_id for (job_id,) in db.query(BackgroundJob.id).filter(BackgroundJob.status.in_(['queued', 'running']))}
+        pending_paths = db.query(GeneratedFile.pdf_storage_path).filter(
+            GeneratedFile.email_sent_status.in_(PENDING_STATES), GeneratedFile.pdf_storage_path != '').distinct()
+        # Vorschau-Einträge gibt es nur zu bestehenden Vorgängen (sie werden mit dem Vorgang gelöscht)
+        review_paths = db.query(MailingRecipient.pdf_path).filter(MailingRecipient.pdf_path.isnot(None)).distinct()
+        referenced_dirs = set()
+        for (path,) in pending_paths.union(review_paths):
+            job_dir = _job_dir_of(path) if path else None
+            if job_dir is not None:
+                referenced_dirs.add(job_dir)
+        return active_job_ids, referenced_dirs
+    finally:
+        db.close()
+
+
+def _remove_tree(path: str) -> bool:
+    try:
+        shutil.rmtree(path)
+        return True
+    except OSError as e:
+        print(f"WARNUNG (artifact_store.py): Verzeichnis '{path}' konnte nicht gelöscht werden: {e}")
+        return False
+
+
+def _sweep_loose_files(directory: str, max_age_seconds: float) -> int:
+    """Entfernt alte Einzeldateien direkt in `directory` (Altbestand und Reste abgebrochener Läufe)."""
+    removed = 0
+    now = time.time()
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return removed
+    for entry in entries:
+        try:
+            if entry.is_file() and now - entry.stat().st_mtime > max_age_seconds:
+                os.unlink(entry.path)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+def sweep() -> Dict[str, object]:
+    """
+    Eine Aufräumrunde: löscht abgelaufene Job-Verzeichnisse, setzt danach die Quoten pro Benutzer
+    und insgesamt durch (älteste Jobs zuerst) und aktualisiert die Belegungsstatistik.
+    Verzeichnisse laufender Jobs und solche, deren PDFs noch versendet werden sollen, werden nie gelöscht.
+    """
+    now = time.time()
+    ttl_seconds = ARTIFACT_TTL_HOURS * 3600
+    # Zuerst liegengebliebene Vorgänge (Einstellungen, Vorschau-Einträge, hochgeladene Tabelle) entfernen,
+    # damit ihre Vorschau-Einträge die Verzeichnisse nicht mehr schützen
+    removed_mailings = delete_stale_mailings()
+    active_job_ids, referenced_dirs = _protected_job_dirs()
+
+    def is_protected(user_id: int, job_id: int) -> bool:
+        return job_id in active_job_ids or (user_id, job_id) in referenced_dirs
+
+    job_dirs = sorted(_scan_job_dirs())  # älteste zuerst
+    removed_dirs = 0
+
+    remaining = []
+    for job_dir in job_dirs:
+        mtime, _, user_id, job_id, path = job_dir
+        if now - mtime > ttl_seconds and not is_protected(user_id, job_id) and _remove_tree(path):
+            removed_dirs += 1
+        else:
+            remaining.append(job_dir)
+
+    per_user: Dict[int, int] = {}
+    for _, size, user_id, _, _ in remaining:
+        per_user[user_id] = per_user.get(user_id, 0) + size
+
+    user_quota_bytes = ARTIFACT_USER_QUOTA_MB * 1024 * 1024
+    global_quota_bytes = ARTIFACT_GLOBAL_QUOTA_MB * 1024 * 1024
+    total_bytes = sum(per_user.values())
+    kept = []
+    for job_dir in remaining:
+        _, size, user_id, job_id, path = job_dir
+        over_quota = per_user[user_id] > user_quota_bytes or total_bytes > global_quota_bytes
+        if over_quota and not is_protected(user_id, job_id) and _remove_tree(path):
+            removed_dirs += 1
+            per_user[user_id] -= size
+            total_bytes -= size
+        else:
+            kept.append(job_dir)
+
+    # Leere Benutzerverzeichnisse entfernen (os.rmdir schlägt bei nicht leeren Verzeichnissen fehl)
+    for user_id in {job_dir[2] for job_dir in job_dirs}:
+        try:
+            os.rmdir(os.path.join(PDF_GENERATED_DIR, str(user_id)))
+        except OSError:
+            pass
+
+    # Altbestand direkt in generated_pdfs sowie verwaiste temporäre DOCX-Dateien
+    removed_files = _sweep_loose_files(PDF_GENERATED_DIR, ttl_seconds)
+    removed_files += _sweep_loose_files(DOCX_TEMP_DIR, TEMP_DOCX_MAX_AGE_SECONDS)
+
+    cache_bytes = _directory_size(os.path.join(PDF_GENERATED_DIR, ".cache"))[0] \
+        if os.path.isdir(os.path.join(PDF_GENERATED_DIR, ".cache")) else 0
+    usage = {
+        "total_bytes": total_bytes,
+        "cache_bytes": cache_bytes,
+        "per_user": {user_id: size for user_id, size in per_user.items() if size > 0},
+        "job_dirs": len(kept),
+        "removed_dirs": removed_dirs,
+        "removed_files": removed_files,
+        "removed_mailings": removed_mailings,
+        "swept_at": now,
+    }
+    with _usage_lock:
+        _last_usage.clear()
+        _last_usage.update(usage)
+    _check_alerts(total_bytes + cache_bytes, global_quota_bytes)
+    return usage
+
+
+def _check_alerts(used_bytes: int, global_quota_bytes: int) -> None:
+    if global_quota_bytes and used_bytes * 100 / global_quota_bytes >= ARTIFACT_ALERT_PERCENT:
+        print(f"WARNUNG (artifact_store.py): Erzeugte Dateien belegen {used_bytes / 1024 / 1024:.0f} MB "
+              f"von {ARTIFACT_GLOBAL_QUOTA_MB} MB ({used_bytes * 100 / global_quota_bytes:.0f} %).")
+    try:
+        disk = shutil.disk_usage(PDF_GENERATED_DIR)
+    except OSError:
+        return
+    if disk.used * 100 / disk.total >= ARTIFACT_ALERT_PERCENT:
+        print(f"WARNUNG (artifact_store.py): Datenträger von '{PDF_GENERATED_DIR}' ist zu "
+              f"{disk.used * 100 / disk.total:.0f} % belegt ({disk.free / 1024 / 1024:.0f} MB frei).")
+
+
+def get_disk_usage() -> Dict[str, object]:
+    """Belegung laut letzter Aufräumrunde."""
+    with _usage_lock:
+        return dict(_last_usage)
+
+
+def user_usage_bytes(user_id: int) -> int:
+    user_dir = os.path.join(PDF_GENERATED_DIR, str(int(user_id)))
+    return _directory_size(user_dir)[0] if os.path.isdir(user_dir) else 0
+
+
+def quota_error_message(user_id: int) -> Optional[str]:
+    """
+    Meldung für die Oberfläche, wenn ein Benutzer seine Quote auch nach dem Aufräumen noch überschreitet.
+    """
+    if user_usage_bytes(user_id) <= ARTIFACT_USER_QUOTA_MB * 1024 * 1024:
+        return None
+    sweep()
+    used_bytes = user_usage_bytes(user_id)
+    if used_bytes <= ARTIFACT_USER_QUOTA_MB * 1024 * 1024:
+        return None
+    return (f"Speicherplatz erschöpft: Ihre erzeugten Dateien belegen {used_bytes / 1024 / 1024:.0f} MB "
+            f"von {ARTIFACT_USER_QUOTA_MB} MB. Bitte warten Sie, bis laufende Vorgänge abgeschlossen sind.")
+
+
+async def _sweeper_loop() -> None:
+    while True:
+        try:
+            await asyncio.to_thread(sweep)
+        except Exception as e:
+            print(f"WARNUNG (artifact_store.py): Aufräumen fehlgeschlagen: {e}")
+        await asyncio.sleep(ARTIFACT_SWEEP_INTERVAL_SECONDS)
+
+
+def start_sweeper() -> None:
+    """Startet das regelmäßige Aufräumen als Hintergrund-Task (beim Start der Anwendung)."""
+    global _sweeper_task
+    if _sweeper_task is None or _sweeper_task.done():
+        _sweeper_task = asyncio.create_task(_sweeper_loop())
+
+
+def stop_sweeper() -> None:
+    global _sweeper_task
+    if _sweeper_task is not None:
+        _sweeper_task.cancel()
+        _sweeper_task = None
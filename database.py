@@ -1,5 +1,5 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, UniqueConstraint, DateTime, Boolean, DECIMAL
+from sqlalchemy import create_engine, inspect, text, Column, Integer, String, Text, ForeignKey, UniqueConstraint, DateTime, Boolean, DECIMAL
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship
 from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timedelta 
@@ -9,7 +9,7 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Pfad zur SQLite-Datenbankdatei
-DATABASE_URL = "sqlite:///./app.db"
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///./app.db")
 
 # SQLAlchemy Basis für Deklaration von Modellen
 Base = declarative_base()
@@ -39,11 +39,19 @@ class SmtpSettings(Base):
     __tablename__ = 'smtp_settings'
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey('users.id'), unique=True, nullable=False)
+    # Verbindungsdaten (Host, Benutzer, Passwort, Port, Verschlüsselung) als ein verschlüsselter JSON-Block,
+    # siehe settings_manager.py. Die einzeln verschlüsselten Spalten bleiben nur für ältere Einträge erhalten
+    # und sind bei neu gespeicherten Einstellungen leer.
+    encrypted_settings = Column(Text, nullable=True)
     encrypted_host = Column(Text, nullable=False)
     encrypted_user = Column(Text, nullable=False)
     encrypted_pass = Column(Text, nullable=False)
     encrypted_port = Column(Text, nullable=False)
     encrypted_secure = Column(Text, nullable=False)
+    # Versandgrenzen des Kontos (leer = keine Begrenzung bzw. Standardwert), siehe rate_limiter.py
+    rate_limit_per_minute = Column(Integer, nullable=True)
+    messages_per_connection = Column(Integer, nullable=True)
+    daily_limit = Column(Integer, nullable=True) # E-Mails pro 24 Stunden
 
     __table_args__ = (UniqueConstraint('user_id', name='uq_user_id'),)
 
@@ -87,8 +95,9 @@ class ProcessLogEntry(Base):
     from_name = Column(String, nullable=True)
     total_recipients = Column(Integer, nullable=False)
     sent_emails_count = Column(Integer, nullable=False)
-    status = Column(String, nullable=False) # 'completed', 'failed', 'partial_success'
-    
+    status = Column(String, nullable=False) # 'sending', 'completed', 'failed', 'partial_success'
+    job_id = Column(Integer, ForeignKey('background_jobs.id'), nullable=True) # Versand-Job, der die Warteschlange abarbeitet
+
     # Beziehung zu GeneratedFile
     generated_files = relationship("GeneratedFile", backref="process_log_entry", cascade="all, delete-orphan")
 
@@ -104,14 +113,75 @@ class GeneratedFile(Base):
     recipient_name = Column(String, nullable=False)
     pdf_filename = Column(String, nullable=False)
     pdf_storage_path = Column(String, nullable=False)
-    email_sent_status = Column(String, nullable=False) # 'success', 'failed'
+    # Ausgangs-Warteschlange: 'queued' -> 'sending' -> 'success' | 'retry' (-> 'sending' ...) | 'failed'
+    email_sent_status = Column(String, nullable=False)
     email_sent_message = Column(Text, nullable=True)
     sent_timestamp = Column(DateTime, nullable=True)
+    attempts = Column(Integer, nullable=True, default=0)
+    next_attempt_at = Column(DateTime, nullable=True)
+    # Eindeutig pro Vorschau-Eintrag (siehe mail_queue.idempotency_key); daraus wird die Message-ID abgeleitet
+    idempotency_key = Column(String, nullable=True, unique=True, index=True)
+    email_subject = Column(Text, nullable=True) # bereits personalisiert
+    email_body = Column(Text, nullable=True) # bereits personalisiert (HTML)
+    email_body_text = Column(Text, nullable=True) # bereits personalisierte Text-Alternative
 
     def __repr__(self):
         return f"<GeneratedFile(id={self.id}, process_id={self.process_id}, recipient_email='{self.recipient_email}', status='{self.email_sent_status}')>"
 
 
+# Definition der BackgroundJob-Tabelle für im Hintergrund laufende Generierungs- und Versandvorgänge
+class BackgroundJob(Base):
+    __tablename__ = 'background_jobs'
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    kind = Column(String, nullable=False) # 'generate', 'send'
+    status = Column(String, nullable=False, default='queued') # 'queued', 'running', 'done', 'failed'
+    total_items = Column(Integer, nullable=False, default=0)
+    processed_items = Column(Integer, nullable=False, default=0)
+    last_message = Column(Text, nullable=True)
+    result_json = Column(Text, nullable=True) # Ergebnis (Protokoll, Vorschau-Einträge) als JSON
+    result_applied = Column(Boolean, default=False, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<BackgroundJob(id={self.id}, user_id={self.user_id}, kind='{self.kind}', status='{self.status}')>"
+
+
+# Definition der MailingJob-Tabelle: Zustand eines Serienmail-Vorgangs (Tabelle, Filter, Einstellungen).
+# Die Session enthält nur die ID, damit das Session-Cookie unabhängig von der Größe des Vorgangs klein bleibt.
+class MailingJob(Base):
+    __tablename__ = 'mailing_jobs'
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    state_json = Column(Text, nullable=False, default='{}') # Einstellungen der Schritte 1-4 als JSON
+    filtered_row_ids = Column(Text, nullable=True) # JSON-Liste der gefilterten Zeilennummern im Datensatz
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    recipients = relationship("MailingRecipient", backref="mailing_job", cascade="all, delete-orphan")
+
+    def __repr__(self):
+        return f"<MailingJob(id={self.id}, user_id={self.user_id})>"
+
+# Definition der MailingRecipient-Tabelle: ein Vorschau-Eintrag (Schritt 5) pro Empfänger
+class MailingRecipient(Base):
+    __tablename__ = 'mailing_recipients'
+    id = Column(Integer, primary_key=True, index=True)
+    mailing_id = Column(Integer, ForeignKey('mailing_jobs.id'), nullable=False, index=True)
+    position = Column(Integer, nullable=False) # Reihenfolge wie in der gefilterten Tabelle
+    row_id = Column(Integer, nullable=False) # Zeilennummer im Datensatz (Daten für die Platzhalter)
+    recipient_name = Column(String, nullable=False)
+    recipient_email = Column(String, nullable=False)
+    subject = Column(Text, nullable=False)
+    pdf_path = Column(String, nullable=True)
+    pdf_web_path = Column(String, nullable=True)
+
+    def __repr__(self):
+        return f"<MailingRecipient(id={self.id}, mailing_id={self.mailing_id}, recipient_email='{self.recipient_email}')>"
+
+
 # Datenbank-Engine und Session-Erstellung
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 
@@ -120,6 +190,25 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 # Funktion zum Erstellen der Datenbanktabellen
 def create_db_and_tables():
     Base.metadata.create_all(bind=engine)
+    ensure_columns()
+
+def ensure_columns():
+    """
+    create_all legt nur fehlende Tabellen an. Spalten, die später zu bestehenden Tabellen hinzugekommen sind,
+    werden hier per ALTER TABLE ergänzt (neue Spalten sind daher immer nullable).
+    """
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            missing_columns = [column for column in table.columns if column.name not in existing_columns]
+            for column in missing_columns:
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                print(f"INFO (database.py): Spalte '{table.name}.{column.name}' ergänzt.")
+            if missing_columns:
+                for index in table.indexes:
+                    index.create(bind=connection, checkfirst=True)
 
 # Beispiel-Anwendung (nur zum Testen oder für Initialisierung)
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+import os
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Eingelesene Tabellen werden spaltenweise im Speicher (LRU) und als Datei unter user_uploads/.datasets
+# abgelegt. Schlüssel ist der Inhalts-Hash der Datei, eine erneut hochgeladene identische Datei wird
+# also nicht noch einmal eingelesen.
+DATASET_DIR = os.path.join("user_uploads", ".datasets")
+DATASET_MEMORY_CACHE_SIZE = int(os.environ.get("DATASET_MEMORY_CACHE_SIZE", "8"))
+DATASET_DISK_MAX_AGE_HOURS = float(os.environ.get("DATASET_DISK_MAX_AGE_HOURS", "72"))
+DATASET_FORMAT_VERSION = 1
+# Abgelaufene Dateien höchstens einmal pro Intervall suchen
+DISK_SWEEP_INTERVAL_SECONDS = 3600
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class Dataset:
+    """
+    Eine eingelesene Tabelle in Spaltenform: pro Spalte eine Liste mit den Werten aller Datenzeilen.
+    Zeilen-Dicts entstehen erst bei Bedarf (row/rows), der Spaltenname wird also nicht in jeder Zeile gespeichert.
+    `indexes` nimmt die Spalten-Indizes für Filter auf (siehe dataset_query.py).
+    """
+
+    __slots__ = ("digest", "columns", "column_values", "row_count", "indexes")
+
+    def __init__(self, digest: str, columns: List[str], column_values: List[List[Any]]):
+        self.digest = digest
+        self.columns = columns
+        self.column_values = column_values
+        self.row_count = len(column_values[0]) if column_values else 0
+        self.indexes: Dict[str, Any] = {}
+
+    def column(self, name: str) -> List[Any]:
+        try:
+            return self.column_values[self.columns.index(name)]
+        except ValueError:
+            raise ValueError(f"Spalte '{name}' nicht in der Tabelle gefunden.")
+
+    def row(self, index: int) -> Dict[str, Any]:
+        return {name: values[index] for name, values in zip(self.columns, self.column_values)}
+
+    def rows(self, indices: Optional[Iterable[int]] = None) -> List[Dict[str, Any]]:
+        if indices is None:
+            indices = range(self.row_count)
+        return [self.row(index) for index in indices]
+
+
+class DatasetRows(Sequence):
+    """Ausgewählte Zeilen eines Datensatzes als Liste; die Zeilen-Dicts entstehen erst beim Zugriff."""
+
+    def __init__(self, dataset: Dataset, indices: List[int]):
+        self.dataset = dataset
+        self.indices = indices
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self.dataset.row(index) for index in self.indices[position]]
+        return self.dataset.row(self.indices[position])
+
+
+_memory_cache: "OrderedDict[str, Dataset]" = OrderedDict()
+_digest_by_file: Dict[Tuple[str, int, int], str] = {}
+_cache_lock = threading.Lock()
+# Verhindert, dass dieselbe Datei von parallelen Anfragen gleichzeitig eingelesen wird
+_load_locks: Dict[str, threading.Lock] = {}
+_last_disk_sweep = 0.0
+
+
+def file_digest(file_path: str) -> str:
+    """
+    SHA-256 des Dateiinhalts. Das Ergebnis wird pro Pfad, Änderungszeit und Größe gemerkt,
+    damit eine unveränderte Datei nicht bei jedem Seitenaufruf neu gelesen wird.
+    """
+    stat_result = os.stat(file_path)
+    file_key = (os.path.abspath(file_path), stat_result.st_mtime_ns, stat_result.st_size)
+    with _cache_lock:
+        digest = _digest_by_file.get(file_key)
+    if digest is not None:
+        return digest
+
+    digest_builder = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest_builder.update(chunk)
+    digest = digest_builder.hexdigest()
+    with _cache_lock:
+        if len(_digest_by_file) > 1000:
+            _digest_by_file.clear()
+        _digest_by_file[file_key] = digest
+    return digest
+
+
+def _disk_path(digest: str) -> str:
+    return os.path.join(DATASET_DIR, f"{digest}.pickle")
+
+
+def _load_from_disk(digest: str) -> Optional[Dataset]:
+    try:
+        with open(_disk_path(digest), "rb") as f:
+            stored = pickle.load(f)
+        os.utime(_disk_path(digest))  # als zuletzt verwendet markieren
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"WARNUNG (dataset_cache.py): Gespeicherte Tabelle {digest[:12]} unlesbar, wird neu eingelesen: {e}")
+        return None
+    if stored.get("version") != DATASET_FORMAT_VERSION:
+        return None
+    return Dataset(digest, stored["columns"], stored["column_values"])
+
+
+def _store_on_disk(dataset: Dataset) -> None:
+    os.makedirs(DATASET_DIR, exist_ok=True)
+    path = _disk_path(dataset.digest)
+    temp_path = f"{path}.{os.urandom(4).hex()}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            pickle.dump({"version": DATASET_FORMAT_VERSION, "columns": dataset.columns,
+                         "column_values": dataset.column_values}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"WARNUNG (dataset_cache.py): Tabelle konnte nicht gespeichert werden: {e}")
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+    _sweep_disk()
+
+
+def _sweep_disk() -> None:
+    global _last_disk_sweep
+    now = time.time()
+    with _cache_lock:
+        if now - _last_disk_sweep < DISK_SWEEP_INTERVAL_SECONDS:
+            return
+        _last_disk_sweep = now
+    max_age_seconds = DATASET_DISK_MAX_AGE_HOURS * 3600
+    try:
+        entries = list(os.scandir(DATASET_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if entry.is_file() and now - entry.stat().st_mtime > max_age_seconds:
+                os.unlink(entry.path)
+        except OSError:
+            pass
+
+
+def _remember(dataset: Dataset) -> None:
+    with _cache_lock:
+        _memory_cache[dataset.digest] = dataset
+        _memory_cache.move_to_end(dataset.digest)
+        while len(_memory_cache) > DATASET_MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def get_dataset(file_path: str, loader: Callable[[str], Tuple[List[str], List[List[Any]]]]) -> Dataset:
+    """
+    Liefert die Tabelle zu `file_path` aus dem Speicher, von der Platte oder, falls noch nicht vorhanden,
+    über `loader(file_path)`, der (Spaltennamen, Spaltenwerte) zurückgibt.
+    """
+    digest = file_digest(file_path)
+    with _cache_lock:
+        dataset = _memory_cache.get(digest)
+        if dataset is not None:
+            _memory_cache.move_to_end(digest)
+            return dataset
+        load_lock = _load_locks.setdefault(digest, threading.Lock())
+
+    with load_lock:
+        with _cache_lock:
+            dataset = _memory_cache.get(digest)
+        if dataset is None:
+            dataset = _load_from_disk(digest)
+            if dataset is None:
+                columns, column_values = loader(file_path)
+                dataset = Dataset(digest, columns, column_values)
+                _store_on_disk(dataset)
+            _remember(dataset)
+    with _cache_lock:
+        _load_locks.pop(digest, None)
+    return dataset
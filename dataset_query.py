@@ -0,0 +1,270 @@
+import re
+import math
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set
+
+from dataset_cache import Dataset, DatasetRows
+
+# Vergleichsoperatoren für Filterbedingungen (Schlüssel = Wert im Formular)
+FILTER_OPERATORS = {
+    'eq': "ist gleich",
+    'ne': "ist ungleich",
+    'contains': "enthält",
+    'gt': "größer / nach",
+    'lt': "kleiner / vor",
+    'between': "zwischen",
+    'empty': "ist leer",
+    'not_empty': "ist nicht leer",
+}
+DATE_FORMATS = ('%d.%m.%Y', '%d.%m.%Y %H:%M:%S', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%d.%m.%y')
+_GERMAN_NUMBER = re.compile(r'^-?\d{1,3}(\.\d{3})+(,\d+)?$')
+# Seitengröße der Tabellen-Vorschau (Standard und Obergrenze pro Anfrage)
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def normalize_value(value: Any) -> Optional[str]:
+    """Vergleichsform eines Zellwerts: Text ohne Leerzeichen am Rand, in Kleinbuchstaben. Leere Zellen ergeben None."""
+    if value is None:
+        return None
+    text = str(value).strip()
+    return text.lower() if text else None
+
+
+def _parse_number(text: str) -> Optional[float]:
+    """Zahl aus Text in deutscher oder englischer Schreibweise (nur für Text-Zellen und Eingaben im Formular)."""
+    if _GERMAN_NUMBER.match(text):
+        text = text.replace('.', '').replace(',', '.')
+    elif ',' in text and '.' not in text:
+        text = text.replace(',', '.')
+    try:
+        number = float(text)
+    except ValueError:
+        return None
+    # "nan", "inf" usw. sind Text, keine Zahlen (NaN wäre außerdem nicht sortierbar)
+    return number if math.isfinite(number) else None
+
+
+def _parse_date(text: str) -> Optional[datetime]:
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+    return None
+
+
+def _sort_key(text: str):
+    """Zahlen und Datumswerte werden als solche verglichen, alles andere als Text."""
+    number = _parse_number(text)
+    if number is not None:
+        return (0, number)
+    date_value = _parse_date(text)
+    if date_value is not None:
+        return (1, date_value)
+    return (2, text)
+
+
+def _value_sort_key(value: Any):
+    """
+    Sortierschlüssel eines Zellwerts nach seinem Typ: Zahlen aus der Tabelle (int/float/bool) und Datumswerte
+    werden direkt übernommen, nur Text wird als Zahl bzw. Datum gedeutet (0.125 bleibt so 0.125 und wird
+    nicht als deutsche Tausendertrennung gelesen). Leere Zellen ergeben None.
+    """
+    if isinstance(value, (bool, int, float)):
+        if math.isfinite(value):
+            return (0, float(value))
+    elif isinstance(value, datetime):
+        return (1, value)
+    elif isinstance(value, date):
+        return (1, datetime(value.year, value.month, value.day))
+    text = normalize_value(value)
+    return _sort_key(text) if text is not None else None
+
+
+class ColumnIndex:
+    """
+    Invertierter Index einer Spalte: normalisierter Wert -> Zeilennummern (aufsteigend).
+    Bereichs- und Textbedingungen werden über die (meist wenigen) verschiedenen Werte ausgewertet
+    statt über alle Zeilen.
+    """
+
+    def __init__(self, values: List[Any]):
+        self.row_ids: Dict[str, List[int]] = {}
+        self.labels: Dict[str, str] = {}  # erste Schreibweise eines Wertes, für die Anzeige
+        self.values: Dict[str, Any] = {}  # erster Zellwert (mit Typ) eines Wertes, für Sortierung und Bereiche
+        self.empty_ids: List[int] = []
+        for row_id, value in enumerate(values):
+            key = normalize_value(value)
+            if key is None:
+                self.empty_ids.append(row_id)
+                continue
+            ids = self.row_ids.get(key)
+            if ids is None:
+                self.row_ids[key] = [row_id]
+                self.labels[key] = str(value).strip()
+                self.values[key] = value
+            else:
+                ids.append(row_id)
+        self._sort_keys: Optional[Dict[str, tuple]] = None
+        self._row_sort_keys: Optional[List[Optional[tuple]]] = None
+
+    def sort_keys(self) -> Dict[str, tuple]:
+        if self._sort_keys is None:
+            self._sort_keys = {key: _value_sort_key(self.values[key]) for key in self.row_ids}
+        return self._sort_keys
+
+    def row_sort_keys(self) -> List[Optional[tuple]]:
+        """Sortierschlüssel pro Zeile des Datensatzes (None bei leeren Zellen)."""
+        if self._row_sort_keys is None:
+            sort_keys = self.sort_keys()
+            row_sort_keys: List[Optional[tuple]] = [None] * (len(self.empty_ids) + sum(len(ids) for ids in self.row_ids.values()))
+            for key, ids in self.row_ids.items():
+                for row_id in ids:
+                    row_sort_keys[row_id] = sort_keys[key]
+            self._row_sort_keys = row_sort_keys
+        return self._row_sort_keys
+
+    def _collect(self, keys: Iterable[str]) -> Set[int]:
+        result: Set[int] = set()
+        for key in keys:
+            result.update(self.row_ids[key])
+        return result
+
+    def match(self, operator: str, value: str = '', value2: str = '') -> Set[int]:
+        needle = normalize_value(value) or ''
+        if operator == 'eq':
+            return set(self.row_ids.get(needle, ()))
+        if operator == 'ne':
+            return self._collect(key for key in self.row_ids if key != needle) | set(self.empty_ids)
+        if operator == 'contains':
+            return self._collect(key for key in self.row_ids if needle in key)
+        if operator == 'empty':
+            return set(self.empty_ids)
+        if operator == 'not_empty':
+            return self._collect(self.row_ids)
+        if operator in ('gt', 'lt', 'between'):
+            sort_keys = self.sort_keys()
+            lower = _sort_key(needle) if operator in ('gt', 'between') else None
+            upper = _sort_key(normalize_value(value2) or '') if operator == 'between' else \
+                _sort_key(needle) if operator == 'lt' else None
+
+            def in_range(key: str) -> bool:
+                sort_key = sort_keys[key]
+                # Nur Werte derselben Art (Zahl, Datum, Text) sind vergleichbar
+                if lower is not None and (sort_key[0] != lower[0] or sort_key < lower or
+                                          (operator == 'gt' and sort_key == lower)):
+                    return False
+                if upper is not None and (sort_key[0] != upper[0] or sort_key > upper or
+                                          (operator == 'lt' and sort_key == upper)):
+                    return False
+                return True
+            return self._collect(key for key in self.row_ids if in_range(key))
+        raise ValueError(f"Unbekannter Filter-Operator '{operator}'.")
+
+    def distinct_values(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Verschiedene Werte mit Anzahl, häufigste zuerst."""
+        ordered = sorted(self.row_ids.items(), key=lambda item: (-len(item[1]), item[0]))
+        if limit is not None:
+            ordered = ordered[:limit]
+        return [{'value': self.labels[key], 'count': len(ids)} for key, ids in ordered]
+
+
+def get_column_index(dataset: Dataset, column: str) -> ColumnIndex:
+    """Index einer Spalte; wird pro Datensatz einmal aufgebaut und am Datensatz gemerkt."""
+    index = dataset.indexes.get(column)
+    if index is None:
+        index = ColumnIndex(dataset.column(column))
+        dataset.indexes[column] = index
+    return index
+
+
+def parse_conditions(columns: List[str], operators: List[str], values: List[str], values2: List[str]) -> List[Dict[str, str]]:
+    """
+    Baut die Bedingungen aus den Formularlisten. Zeilen ohne Spalte werden ignoriert,
+    ebenso Vergleiche ohne Wert (außer 'ist leer' / 'ist nicht leer').
+    """
+    conditions = []
+    for position, column in enumerate(columns):
+        if not column:
+            continue
+        operator = operators[position] if position < len(operators) and operators[position] else 'eq'
+        value = (values[position] if position < len(values) else '') or ''
+        value2 = (values2[position] if position < len(values2) else '') or ''
+        if operator not in FILTER_OPERATORS:
+            raise ValueError(f"Unbekannter Filter-Operator '{operator}'.")
+        if operator not in ('empty', 'not_empty') and not value.strip():
+            continue
+        if operator == 'between' and not value2.strip():
+            raise ValueError(f"Für 'zwischen' in Spalte '{column}' fehlt der zweite Wert.")
+        conditions.append({'column': column, 'operator': operator, 'value': value, 'value2': value2})
+    return conditions
+
+
+def describe_conditions(conditions: List[Dict[str, str]], combine: str) -> str:
+    parts = []
+    for condition in conditions:
+        text = f"{condition['column']} {FILTER_OPERATORS[condition['operator']]}"
+        if condition['operator'] == 'between':
+            text += f" {condition['value']} und {condition['value2']}"
+        elif condition['operator'] not in ('empty', 'not_empty'):
+            text += f" '{condition['value']}'"
+        parts.append(text)
+    return (" ODER " if combine == 'or' else " UND ").join(parts)
+
+
+def query_dataset(dataset: Dataset, conditions: List[Dict[str, str]], combine: str = 'and') -> List[int]:
+    """Zeilennummern (in Tabellenreihenfolge), die die Bedingungen erfüllen, verknüpft mit UND bzw. ODER."""
+    if not conditions:
+        return list(range(dataset.row_count))
+    result: Optional[Set[int]] = None
+    for condition in conditions:
+        if condition['column'] not in dataset.columns:
+            raise ValueError(f"Filter-Spalte '{condition['column']}' nicht in Excel-Header gefunden.")
+        matched = get_column_index(dataset, condition['column']).match(
+            condition['operator'], condition.get('value', ''), condition.get('value2', ''))
+        if result is None:
+            result = matched
+        elif combine == 'or':
+            result |= matched
+        else:
+            result &= matched
+    return sorted(result)
+
+
+def paginate_rows(rows: Sequence[Dict[str, Any]], page: int = 1, page_size: int = DEFAULT_PAGE_SIZE,
+                  sort_column: Optional[str] = None, descending: bool = False) -> Dict[str, Any]:
+    """
+    Eine Seite von `rows`, optional nach einer Spalte sortiert (Zahlen und Datumswerte als solche,
+    leere Zellen immer am Ende). Jede Zeile wird mit ihrer Position in `rows` ('index') geliefert.
+    """
+    order = list(range(len(rows)))
+    if sort_column:
+        if isinstance(rows, DatasetRows) and sort_column in rows.dataset.columns:
+            # Sortierschlüssel aus dem (zwischengespeicherten) Spalten-Index, ohne Zeilen-Dicts zu bauen
+            dataset_keys = get_column_index(rows.dataset, sort_column).row_sort_keys()
+            sort_keys = [dataset_keys[row_id] for row_id in rows.indices]
+        else:
+            sort_keys = [_value_sort_key(row.get(sort_column)) for row in rows]
+        keyed, empty = [], []
+        for position in order:
+            if sort_keys[position] is None:
+                empty.append(position)
+            else:
+                keyed.append((sort_keys[position], position))
+        keyed.sort(key=lambda item: item[0], reverse=descending)
+        order = [position for _, position in keyed] + empty
+
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    pages = max(1, -(-len(order) // page_size))
+    page = max(1, min(page, pages))
+    start = (page - 1) * page_size
+    return {
+        'page': page,
+        'page_size': page_size,
+        'pages': pages,
+        'total': len(order),
+        'sort': sort_column or '',
+        'order': 'desc' if descending else 'asc',
+        'rows': [{'index': position, 'row': rows[position]} for position in order[start:start + page_size]],
+    }
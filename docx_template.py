@@ -0,0 +1,345 @@
+import os
+import re
+import posixpath
+import hashlib
+import threading
+import zipfile
+from io import BytesIO
+from collections import OrderedDict
+from typing import Dict, List, Set
+from xml.sax.saxutils import escape as xml_escape
+from lxml import etree
+
+from utils.zip_utils import RawZipWriter, read_raw_members
+from helpers import PLACEHOLDER_PATTERN
+
+WORD_NAMESPACE = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+RELATIONSHIP_ID_ATTRIBUTE = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+PACKAGE_RELATIONSHIPS_NAMESPACE = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+CONTENT_TYPES_NAMESPACE = '{http://schemas.openxmlformats.org/package/2006/content-types}'
+XML_SPACE_ATTRIBUTE = '{http://www.w3.org/XML/1998/namespace}space'
+
+# Platzhalter werden beim Kompilieren durch Marker ersetzt. U+FDD0/U+FDD1 sind Nicht-Zeichen,
+# die in echten Dokumenten nicht vorkommen, aber gültiges XML bleiben.
+_SLOT_OPEN = '\ufdd0'
+_SLOT_CLOSE = '\ufdd1'
+_SLOT_PATTERN = re.compile(_SLOT_OPEN.encode('utf-8') + rb'(\d+)' + _SLOT_CLOSE.encode('utf-8'))
+# Steuerzeichen (außer Tab/Zeilenumbruch) sind in XML nicht erlaubt und würden das Dokument beschädigen
+_INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+TEMPLATE_CACHE_SIZE = 16
+
+# Elemente, die laut Schema in w:sectPr nach w:pgNumType stehen müssen
+_SECTION_ELEMENTS_AFTER_PAGE_NUMBERING = {f'{WORD_NAMESPACE}{name}' for name in (
+    'cols', 'formProt', 'vAlign', 'noEndnote', 'titlePg', 'textDirection', 'bidi', 'rtlGutter', 'docGrid', 'printerSettings')}
+
+
+def is_placeholder_part(filename: str) -> bool:
+    """
+    Gibt an, ob ein ZIP-Eintrag einer DOCX-Datei Platzhalter enthalten kann (Haupttext, Kopf- und Fußzeilen).
+    """
+    return filename == 'word/document.xml' or \
+        filename.startswith('word/header') and filename.endswith('.xml') or \
+        filename.startswith('word/footer') and filename.endswith('.xml')
+
+
+def _restart_section(section_properties) -> None:
+    """Lässt einen Abschnitt auf einer neuen Seite mit Seitenzahl 1 beginnen."""
+    section_type = section_properties.find(f'{WORD_NAMESPACE}type')
+    if section_type is not None:
+        section_type.set(f'{WORD_NAMESPACE}val', 'nextPage')  # fehlt w:type, ist 'nextPage' ohnehin Standard
+    page_numbering = section_properties.find(f'{WORD_NAMESPACE}pgNumType')
+    if page_numbering is None:
+        page_numbering = etree.Element(f'{WORD_NAMESPACE}pgNumType')
+        following = next((child for child in section_properties if child.tag in _SECTION_ELEMENTS_AFTER_PAGE_NUMBERING), None)
+        if following is not None:
+            following.addprevious(page_numbering)
+        else:
+            section_properties.append(page_numbering)
+    page_numbering.set(f'{WORD_NAMESPACE}start', '1')
+
+
+def _merge_split_placeholders(text_elements: list) -> None:
+    """
+    Word verteilt Text oft auf mehrere Runs (z.B. '${Na' + 'me}'). Für jeden Platzhalter, der über
+    mehrere w:t-Elemente eines Absatzes verteilt ist, wird der komplette Platzhalter in das erste
+    beteiligte Element verschoben. Der Gesamttext des Absatzes bleibt dabei unverändert.
+    """
+    joined_text = ''.join(t.text or '' for t in text_elements)
+    for match in PLACEHOLDER_PATTERN.finditer(joined_text):
+        offsets, position = [], 0
+        for t in text_elements:
+            offsets.append(position)
+            position += len(t.text or '')
+
+        def element_at(char_index: int) -> int:
+            for k, t in enumerate(text_elements):
+                if offsets[k] <= char_index < offsets[k] + len(t.text or ''):
+                    return k
+            return -1
+
+        first, last = element_at(match.start()), element_at(match.end() - 1)
+        if first == last:
+            continue
+
+        moved = []
+        for k in range(first + 1, last + 1):
+            element_text = text_elements[k].text or ''
+            take = len(element_text) if k < last else match.end() - offsets[k]
+            moved.append(element_text[:take])
+            text_elements[k].text = element_text[take:]
+            # Der verbleibende Rest kann jetzt mit einem Leerzeichen beginnen
+            text_elements[k].set(XML_SPACE_ATTRIBUTE, 'preserve')
+        text_elements[first].text = (text_elements[first].text or '') + ''.join(moved)
+
+
+def document_relationship_part_name(target: str) -> str:
+    """
+    Teilname im Paket für ein Relationship-Ziel aus word/_rels/document.xml.rels (wie OPC es auflöst):
+    absolute Ziele ("/word/header1.xml") gelten ab der Paketwurzel, relative ab dem Ordner word/.
+    """
+    if target.startswith('/'):
+        return posixpath.normpath(target.lstrip('/'))
+    return posixpath.normpath(posixpath.join('word', target))
+
+class CompiledDocxPart:
+    """
+    Ein XML-Teil der Vorlage als Folge statischer Byte-Segmente mit Platzhalter-Slots dazwischen:
+    segments[0], slots[0], segments[1], slots[1], ..., segments[-1].
+    """
+
+    def __init__(self, segments: List[bytes], slots: List[str]):
+        self.segments = segments
+        self.slots = slots
+
+    @classmethod
+    def compile(cls, xml_content_bytes: bytes) -> "CompiledDocxPart":
+        # Nur auf '$' prüfen: ein über mehrere Runs verteilter Platzhalter enthält '${' nicht am Stück
+        if b'$' not in xml_content_bytes:
+            return cls([xml_content_bytes], [])
+
+        root = etree.fromstring(xml_content_bytes)
+        slots: List[str] = []
+
+        for paragraph in root.iter(f'{WORD_NAMESPACE}p'):
+            # Nur Texte, die direkt zu diesem Absatz gehören (nicht zu verschachtelten Absätzen in Textfeldern)
+            text_elements = [t for t in paragraph.iter(f'{WORD_NAMESPACE}t')
+                             if next(t.iterancestors(f'{WORD_NAMESPACE}p'), None) is paragraph]
+            if not any(t.text and '$' in t.text for t in text_elements):
+                continue
+            _merge_split_placeholders(text_elements)
+
+            for t in text_elements:
+                if not t.text or '${' not in t.text:
+                    continue
+                marked_text, position = [], 0
+                for match in PLACEHOLDER_PATTERN.finditer(t.text):
+                    marked_text.append(t.text[position:match.start()])
+                    marked_text.append(f"{_SLOT_OPEN}{len(slots)}{_SLOT_CLOSE}")
+                    slots.append(match.group(1))
+                    position = match.end()
+                marked_text.append(t.text[position:])
+                t.text = ''.join(marked_text)
+                # Eingesetzte Werte können führende oder abschließende Leerzeichen enthalten
+                t.set(XML_SPACE_ATTRIBUTE, 'preserve')
+
+        if not slots:
+            return cls([xml_content_bytes], [])
+
+        tree = root.getroottree()
+        serialized = etree.tostring(tree, encoding='UTF-8', xml_declaration=True,
+                                    standalone=tree.docinfo.standalone)
+        pieces = _SLOT_PATTERN.split(serialized)
+        # re.split liefert abwechselnd Segment und Slot-Nummer; die Nummern entsprechen der Reihenfolge in `slots`
+        return cls(pieces[0::2], slots)
+
+    def render(self, data_row: dict) -> bytes:
+        if not self.slots:
+            return self.segments[0]
+        output = [self.segments[0]]
+        for slot_key, segment in zip(self.slots, self.segments[1:]):
+            if slot_key in data_row:
+                value = data_row[slot_key]
+                replacement_value = str(value) if value is not None else ""
+            else:
+                # Unbekannte Platzhalter bleiben wie bisher unverändert im Dokument stehen
+                replacement_value = f'${{{slot_key}}}'
+            output.append(xml_escape(_INVALID_XML_CHARS.sub('', replacement_value)).encode('utf-8'))
+            output.append(segment)
+        return b''.join(output)
+
+
+class CompiledDocxTemplate:
+    """
+    Eine einmal eingelesene DOCX-Vorlage. Die Platzhalter aller XML-Teile sind vorab lokalisiert,
+    sodass pro Datenzeile nur noch Byte-Segmente zusammengefügt werden.
+    """
+
+    def __init__(self, template_bytes: bytes):
+        self.template_bytes = template_bytes
+        self.digest = hashlib.sha256(template_bytes).hexdigest()
+        self.parts: Dict[str, CompiledDocxPart] = {}
+        with zipfile.ZipFile(BytesIO(template_bytes), 'r') as zin:
+            for item in zin.infolist():
+                if is_placeholder_part(item.filename):
+                    self.parts[item.filename] = CompiledDocxPart.compile(zin.read(item.filename))
+        # Komprimierte Rohdaten aller Einträge; unveränderte Teile (z.B. Bilder) werden 1:1 übernommen
+        self.members = read_raw_members(template_bytes)
+
+    @classmethod
+    def from_file(cls, docx_path: str) -> "CompiledDocxTemplate":
+        with open(docx_path, 'rb') as f:
+            return cls(f.read())
+
+    @property
+    def placeholders(self) -> Set[str]:
+        """Alle in der Vorlage verwendeten Platzhalter-Namen."""
+        return {slot for part in self.parts.values() for slot in part.slots}
+
+    def render_part(self, filename: str, data_row: dict) -> bytes:
+        return self.parts[filename].render(data_row)
+
+    def render_docx(self, data_row: dict) -> bytes:
+        """
+        Baut die personalisierte DOCX-Datei im Speicher. Nur Teile mit Platzhaltern werden neu
+        komprimiert, alle anderen Einträge werden mit ihren komprimierten Bytes kopiert.
+        """
+        buffer = BytesIO()
+        writer = RawZipWriter(buffer)
+        for member in self.members:
+            part = self.parts.get(member.filename)
+            if part is not None and part.slots:
+                writer.add_bytes(member.filename, part.render(data_row), date_time=member.date_time)
+            else:
+                writer.add_member(member)
+        writer.close()
+        return buffer.getvalue()
+
+    def _read_member(self, filename: str) -> bytes:
+        with zipfile.ZipFile(BytesIO(self.template_bytes), 'r') as zin:
+            return zin.read(filename)
+
+    def render_merged_docx(self, data_rows: List[dict]) -> bytes:
+        """
+        Baut ein einziges Dokument, das die Vorlage für jede Datenzeile einmal enthält. Jede Kopie ist
+        ein eigener Abschnitt, beginnt auf einer neuen Seite und startet die Seitenzählung bei 1.
+        Kopf- und Fußzeilen mit Platzhaltern werden pro Kopie dupliziert, alle anderen gemeinsam genutzt.
+        """
+        if not data_rows:
+            raise ValueError("Keine Datenzeilen für das Sammeldokument.")
+        document_part = self.parts.get('word/document.xml')
+        if document_part is None:
+            raise ValueError("Die Vorlage enthält kein word/document.xml.")
+
+        relationships = etree.fromstring(self._read_member('word/_rels/document.xml.rels'))
+        content_types = etree.fromstring(self._read_member('[Content_Types].xml'))
+        override_types = {override.get('PartName'): override.get('ContentType')
+                          for override in content_types.iter(f'{CONTENT_TYPES_NAMESPACE}Override')}
+        # Kopf-/Fußzeilen mit Platzhaltern, die pro Empfänger eigene Teile brauchen: rId -> (Teilname, Typ)
+        personalized_parts = {}
+        for relationship in relationships.iter(f'{PACKAGE_RELATIONSHIPS_NAMESPACE}Relationship'):
+            if relationship.get('TargetMode') == 'External':
+                continue
+            part_name = document_relationship_part_name(relationship.get('Target', ''))
+            part = self.parts.get(part_name)
+            if part_name != 'word/document.xml' and part is not None and part.slots:
+                personalized_parts[relationship.get('Id')] = (part_name, relationship.get('Type'))
+        existing_member_names = {member.filename for member in self.members}
+
+        merged_root, merged_body, extra_parts = None, None, []
+        for copy_number, data_row in enumerate(data_rows, start=1):
+            root = etree.fromstring(document_part.render(data_row))
+            body = root.find(f'{WORD_NAMESPACE}body')
+            content = list(body)
+            section_properties = content.pop() if content and content[-1].tag == f'{WORD_NAMESPACE}sectPr' else None
+
+            relationship_ids = {}
+            for relationship_id, (part_name, relationship_type) in personalized_parts.items():
+                directory, base_name = part_name.rsplit('/', 1)
+                copy_part_name = f"{directory}/{base_name[:-4]}_s{copy_number}.xml"
+                relationship_ids[relationship_id] = f"{relationship_id}_s{copy_number}"
+                extra_parts.append((copy_part_name, self.render_part(part_name, data_row)))
+                part_relationships = f"{directory}/_rels/{base_name}.rels"
+                if part_relationships in existing_member_names:
+                    extra_parts.append((f"{directory}/_rels/{copy_part_name.rsplit('/', 1)[1]}.rels",
+                                        self._read_member(part_relationships)))
+                etree.SubElement(relationships, f'{PACKAGE_RELATIONSHIPS_NAMESPACE}Relationship', {
+                    'Id': relationship_ids[relationship_id],
+                    'Type': relationship_type,
+                    'Target': copy_part_name.split('/', 1)[1]})
+                etree.SubElement(content_types, f'{CONTENT_TYPES_NAMESPACE}Override', {
+                    'PartName': f"/{copy_part_name}", 'ContentType': override_types.get(f"/{part_name}", '')})
+            if relationship_ids:
+                for reference in root.iter(f'{WORD_NAMESPACE}headerReference', f'{WORD_NAMESPACE}footerReference'):
+                    new_id = relationship_ids.get(reference.get(RELATIONSHIP_ID_ATTRIBUTE))
+                    if new_id:
+                        reference.set(RELATIONSHIP_ID_ATTRIBUTE, new_id)
+
+            if section_properties is None:
+                section_properties = etree.Element(f'{WORD_NAMESPACE}sectPr')
+            _restart_section(section_properties)
+
+            if merged_root is None:
+                merged_root, merged_body = root, body
+                for element in content + [section_properties]:
+                    merged_body.remove(element)
+            if copy_number < len(data_rows):
+                # Abschnittsende einer Kopie: sectPr in den Eigenschaften ihres letzten Absatzes
+                last_paragraph = content[-1] if content and content[-1].tag == f'{WORD_NAMESPACE}p' else None
+                if last_paragraph is None or last_paragraph.find(f'{WORD_NAMESPACE}pPr/{WORD_NAMESPACE}sectPr') is not None:
+                    last_paragraph = etree.Element(f'{WORD_NAMESPACE}p')
+                    content.append(last_paragraph)
+                paragraph_properties = last_paragraph.find(f'{WORD_NAMESPACE}pPr')
+                if paragraph_properties is None:
+                    paragraph_properties = etree.Element(f'{WORD_NAMESPACE}pPr')
+                    last_paragraph.insert(0, paragraph_properties)
+                paragraph_properties.append(section_properties)
+                merged_body.extend(content)
+            else:
+                merged_body.extend(content)
+                merged_body.append(section_properties)
+
+        tree = merged_root.getroottree()
+        replaced_parts = {
+            'word/document.xml': etree.tostring(tree, encoding='UTF-8', xml_declaration=True,
+                                                standalone=tree.docinfo.standalone),
+            'word/_rels/document.xml.rels': etree.tostring(relationships, encoding='UTF-8', xml_declaration=True, standalone=True),
+            '[Content_Types].xml': etree.tostring(content_types, encoding='UTF-8', xml_declaration=True, standalone=True),
+        }
+
+        buffer = BytesIO()
+        writer = RawZipWriter(buffer)
+        for member in self.members:
+            if member.filename in replaced_parts:
+                writer.add_bytes(member.filename, replaced_parts[member.filename], date_time=member.date_time)
+            else:
+                writer.add_member(member)
+        for filename, data in extra_parts:
+            writer.add_bytes(filename, data)
+        writer.close()
+        return buffer.getvalue()
+
+
+_template_cache: "OrderedDict[tuple, CompiledDocxTemplate]" = OrderedDict()
+_template_cache_lock = threading.Lock()
+
+
+def get_compiled_template(docx_path: str) -> CompiledDocxTemplate:
+    """
+    Liefert die kompilierte Vorlage aus dem Cache. Schlüssel sind Pfad, Änderungszeit und Größe,
+    sodass eine neu hochgeladene Vorlage automatisch neu kompiliert wird.
+    """
+    stat_result = os.stat(docx_path)
+    cache_key = (os.path.abspath(docx_path), stat_result.st_mtime_ns, stat_result.st_size)
+    with _template_cache_lock:
+        compiled = _template_cache.get(cache_key)
+        if compiled is not None:
+            _template_cache.move_to_end(cache_key)
+            return compiled
+
+    compiled = CompiledDocxTemplate.from_file(docx_path)
+    with _template_cache_lock:
+        _template_cache[cache_key] = compiled
+        while len(_template_cache) > TEMPLATE_CACHE_SIZE:
+            _template_cache.popitem(last=False)
+    return compiled
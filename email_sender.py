@@ -1,133 +1,227 @@
-import smtplib
+import asyncio
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
 import os
-from typing import Dict, List, Any
-from datetime import datetime
-import re
+import time
+from typing import Dict, List, Any, Callable, Optional
+from datetime import datetime, timedelta
 
 from settings_manager import get_smtp_settings
 from sqlalchemy.orm import Session
-from helpers import replace_docx_placeholders_in_text, replace_html_placeholders_in_text
-
-async def send_personalized_emails(
+from database import ProcessLogEntry, GeneratedFile
+from smtp_pool import SmtpSession, SmtpConnectionPool
+from mail_queue import (MAIL_MAX_ATTEMPTS, STATE_SUCCESS, STATE_RETRY, due_entries, mark_sending, next_retry_at,
+                        record_attempt, store_attempt, finish_process, message_id_for, defer_entries, sent_in_last_day)
+from rate_limiter import rate_limiter_for
+from mime_builder import AttachmentCache, html_to_plain_text, pdf_attachment_part
+
+
+class MissingAttachmentError(Exception):
+    """Ein Anhang wurde erwartet, die PDF-Datei existiert aber nicht (mehr)."""
+
+
+def _build_message(file_info: Dict[str, Any], smtp_from_email: str, attachment_cache: Optional[AttachmentCache] = None) -> MIMEMultipart:
+    msg = MIMEMultipart('alternative')
+    sender_display_name = file_info.get('from_name') if file_info.get('from_name') else smtp_from_email.split('@')[0]
+    msg['From'] = f"{sender_display_name} <{smtp_from_email}>"
+    msg['To'] = file_info['recipient_email']
+    msg['Subject'] = file_info['subject']
+
+    if file_info.get('message_id'):
+        msg['Message-ID'] = file_info['message_id']
+
+    html_body_processed = file_info['body'] # bereits personalisiert (siehe mail_queue.enqueue_mailing)
+    # Die Text-Alternative wird beim Einreihen aus der Vorlage abgeleitet; ältere Einträge haben sie noch nicht
+    plain_body_processed = file_info.get('body_text') or html_to_plain_text(html_body_processed)
+
+    part1 = MIMEText(plain_body_processed, 'plain')
+    part2 = MIMEText(html_body_processed, 'html')
+    msg.attach(part1)
+    msg.attach(part2)
+
+    # GEÄNDERT: Anhang wird nur hinzugefügt, wenn ein PDF-Pfad vorhanden ist.
+    pdf_path = file_info.get('pdf_path')
+    if pdf_path and os.path.exists(pdf_path):
+        msg.attach(pdf_attachment_part(pdf_path, attachment_cache))
+    elif pdf_path and not os.path.exists(pdf_path):
+        # Wenn ein Anhang erwartet wurde, aber nicht gefunden wird -> Fehler
+        raise MissingAttachmentError(f"Fehler: PDF für {file_info['recipient_email']} nicht gefunden: {os.path.basename(pdf_path)}.")
+    return msg
+
+
+def _send_item(session: SmtpSession, file_info: Dict[str, Any], smtp_from_email: str, attachment_cache: AttachmentCache) -> None:
+    # Läuft im Thread des Pool-Workers: Anhang kodieren, Nachricht bauen und senden
+    session.send(_build_message(file_info, smtp_from_email, attachment_cache))
+
+
+def _build_report_message(sent_items_for_report: List[Dict[str, Any]], smtp_from_email: str) -> MIMEMultipart:
+    report_html = "<h1>Sendebestätigung</h1><p>Der Serienmail-Assistent hat am " + \
+              datetime.now().strftime(r'%d.%m.%Y \u\m %H:%M') + " Uhr E-Mails versendet:</p>"
+    report_html += "<table border='1' cellpadding='5' cellspacing='0' style='border-collapse: collapse; width: 100%;'>"
+    # GEÄNDERT: Spalte für Dokument anpassen, um "Kein Anhang" zu zeigen
+    report_html += "<tr><th style='background-color:#eee;'>Empfänger</th><th style='background-color:#eee;'>E-Mail</th><th style='background-color:#eee;'>Dokument</th></tr>"
+    for report_item in sent_items_for_report:
+        document_name = os.path.basename(report_item['pdf_path']) if report_item.get('pdf_path') else "Kein Anhang"
+        report_html += f"<tr><td>{report_item['recipient_name']}</td><td>{report_item['recipient_email']}</td><td>{document_name}</td></tr>"
+    report_html += "</table>"
+
+    report_msg = MIMEMultipart('alternative')
+    report_msg['From'] = f"Serienmail-Assistent Report <{smtp_from_email}>"
+    report_msg['To'] = smtp_from_email
+    report_msg['Subject'] = 'Protokoll: Serienmail-Versand'
+    report_msg.attach(MIMEText(report_html, 'html'))
+    return report_msg
+
+
+async def send_queued_emails(
     db: Session,
     user_id: int,
-    sent_items_data: List[Dict[str, Any]],
-    smtp_from_email: str
-) -> List[Dict[str, str]]:
+    process_id: int,
+    progress_callback: Optional[Callable[[Dict[str, Any], bool], None]] = None
+) -> List[Dict[str, Any]]:
     """
-    Sendet personalisierte E-Mails mit PDF-Anhängen.
-    Gibt ein Protokoll der gesendeten/fehlgeschlagenen E-Mails zurück.
+    Arbeitet die Ausgangs-Warteschlange eines Vorgangs ab (siehe mail_queue.py) und versendet die fälligen E-Mails
+    über einen Pool paralleler SMTP-Verbindungen (siehe smtp_pool.py). Jeder Zustellversuch wird sofort festgeschrieben;
+    vorübergehende Fehler (4xx, Verbindungsabbruch) werden mit wachsendem Abstand wiederholt.
+    `progress_callback(eintrag, abgeschlossen)` erhält nach jedem Versuch den zugehörigen Protokolleintrag.
+    Gibt das Protokoll aller Empfänger in der Reihenfolge der Warteschlange zurück.
     """
     smtp_settings = get_smtp_settings(db, user_id)
+    process = db.query(ProcessLogEntry).filter(ProcessLogEntry.id == process_id).first()
     process_log = []
 
-    if not smtp_settings:
-        process_log.append({'status': 'error', 'message': "Fehler: Keine SMTP-Einstellungen für Ihren Account gefunden. Bitte unter 'Einstellungen' konfigurieren."})
+    if process is None:
+        process_log.append({'status': 'error', 'message': 'Der Versandauftrag wurde nicht gefunden.'})
         return process_log
 
-    smtp_host = smtp_settings["host"]
-    smtp_user = smtp_settings["user"]
-    smtp_pass = smtp_settings["password"]
-    smtp_port = int(smtp_settings["port"])
-    smtp_secure = smtp_settings["secure"]
-
-    if not sent_items_data:
-        process_log.append({'status': 'error', 'message': 'Keine Dateien zum Senden ausgewählt.'})
+    if not smtp_settings:
+        process_log.append({'status': 'error', 'message': "Fehler: Keine SMTP-Einstellungen für Ihren Account gefunden. Bitte unter 'Einstellungen' konfigurieren."})
+        for entry in due_entries(db, process_id, datetime.max):
+            record_attempt(db, entry, ValueError('keine SMTP-Einstellungen'), f"Fehler beim Senden an {entry['recipient_email']}: keine SMTP-Einstellungen.")
+        finish_process(db, process)
         return process_log
 
-    try:
-        if smtp_secure == 'tls':
-            server = smtplib.SMTP(smtp_host, smtp_port, timeout=30)
-            server.starttls()
-        elif smtp_secure == 'ssl':
-            server = smtplib.SMTP_SSL(smtp_host, smtp_port, timeout=30)
+    smtp_from_email = smtp_settings['user']
+    from_name = process.from_name
+    # Gemeinsame, sich anpassende Senderate aller Versandvorgänge dieses Kontos (siehe rate_limiter.py)
+    rate_limiter = rate_limiter_for(smtp_settings)
+    throttle_count_before = rate_limiter.throttle_count
+    latencies: Dict[int, int] = {}
+    # Ein Pool für den ganzen Vorgang: Sitzungen bleiben über erneute Versuche hinweg bestehen,
+    # das Sendeprotokoll geht über dieselbe Verbindung
+    pool = SmtpConnectionPool(smtp_settings, rate_limiter=rate_limiter)
+    # Anhänge, die mehrere Empfänger erhalten, werden nur einmal kodiert
+    attachment_cache = AttachmentCache()
+    batch_started = time.monotonic()
+
+    async def handle_result(entry: Dict[str, Any], error: Optional[Exception], duration: Optional[float]) -> None:
+        if error is None:
+            message = f"E-Mail erfolgreich an {entry['recipient_email']} gesendet."
+        elif isinstance(error, MissingAttachmentError):
+            message = str(error)
         else:
-            server = smtplib.SMTP(smtp_host, smtp_port, timeout=30)
-        
-        server.login(smtp_user, smtp_pass)
+            message = f"Fehler beim Senden an {entry['recipient_email']}: {error}"
+        # Jeder Versuch wird sofort festgeschrieben (in einem Thread, die Event-Loop bleibt frei)
+        state = await asyncio.to_thread(store_attempt, entry, error, message)
+        log_entry = {'status': 'success' if state == STATE_SUCCESS else 'error', 'message': message}
+        if duration is not None:
+            latencies[entry['id']] = log_entry['latency_ms'] = round(duration * 1000)
+        if state == STATE_RETRY:
+            wait_seconds = max(0, round((entry['next_attempt_at'] - datetime.utcnow()).total_seconds()))
+            log_entry = {'status': 'info', 'message': f"{message} Neuer Versuch ({entry['attempts'] + 1}/{MAIL_MAX_ATTEMPTS}) in {wait_seconds} s."}
+        if progress_callback is not None:
+            progress_callback(log_entry, state != STATE_RETRY)
 
-        sent_items_for_report = []
+    try:
+        while True:
+            due = due_entries(db, process_id, datetime.utcnow())
+            if not due:
+                retry_at = next_retry_at(db, process_id)
+                if retry_at is None:
+                    break
+                await pool.close() # keine Verbindungen offen halten, während auf erneute Versuche gewartet wird
+                await asyncio.sleep(max(0.0, (retry_at - datetime.utcnow()).total_seconds()))
+                continue
+
+            daily_limit = smtp_settings.get('daily_limit')
+            if daily_limit:
+                sent_today, oldest_sent = sent_in_last_day(db, user_id)
+                remaining = max(0, daily_limit - sent_today)
+                if remaining < len(due):
+                    # Sobald die älteste Sendung aus dem 24-Stunden-Fenster fällt, wird erneut geprüft
+                    resume_at = (oldest_sent or datetime.utcnow()) + timedelta(days=1)
+                    defer_entries(db, due[remaining:], resume_at)
+                    resume_at_local = datetime.now() + (resume_at - datetime.utcnow())
+                    info_entry = {'status': 'info', 'message': f"Tageslimit von {daily_limit} E-Mails erreicht: {len(due) - remaining} E-Mail(s) "
+                                                               f"werden ab {resume_at_local.strftime('%d.%m.%Y %H:%M')} Uhr versendet."}
+                    process_log.append(info_entry)
+                    if progress_callback is not None:
+                        progress_callback(info_entry, False)
+                    due = due[:remaining]
+                    if not due:
+                        continue
+
+            mark_sending(db, due)
+            items = [{
+                'recipient_email': entry['recipient_email'], 'recipient_name': entry['recipient_name'],
+                'subject': entry['email_subject'], 'body': entry['email_body'], 'body_text': entry['email_body_text'],
+                'from_name': from_name,
+                'pdf_path': entry['pdf_storage_path'] or None,
+                'message_id': message_id_for(entry['idempotency_key'], smtp_from_email),
+            } for entry in due]
 
-        for file_info in sent_items_data:
             try:
-                msg = MIMEMultipart('alternative')
-                sender_display_name = file_info.get('from_name') if file_info.get('from_name') else smtp_from_email.split('@')[0]
-                msg['From'] = f"{sender_display_name} <{smtp_from_email}>"
-                msg['To'] = file_info['recipient_email']
-                msg['Subject'] = file_info['subject']
-
-                html_email_body_template = file_info['body'] 
-                html_body_processed = replace_html_placeholders_in_text(html_email_body_template, file_info['data_row'])
-
-                plain_body_processed = re.sub(r'<[^>]+>', '', html_body_processed).strip()
-                plain_body_processed = plain_body_processed.replace('</p>', '\n').replace('<p>', '')
-                plain_body_processed = re.sub(r'\s+', ' ', plain_body_processed).strip()
-                
-                part1 = MIMEText(plain_body_processed, 'plain')
-                part2 = MIMEText(html_body_processed, 'html')
-                msg.attach(part1)
-                msg.attach(part2)
-                
-                # GEÄNDERT: Anhang wird nur hinzugefügt, wenn ein PDF-Pfad vorhanden ist.
-                pdf_path = file_info.get('pdf_path')
-                if pdf_path and os.path.exists(pdf_path):
-                    with open(pdf_path, "rb") as f:
-                        attach = MIMEApplication(f.read(), _subtype="pdf")
-                        attach.add_header('Content-Disposition', 'attachment', filename=os.path.basename(pdf_path))
-                        msg.attach(attach)
-                elif pdf_path and not os.path.exists(pdf_path):
-                    # Wenn ein Anhang erwartet wurde, aber nicht gefunden wird -> Fehler
-                    process_log.append({'status': 'error', 'message': f"Fehler: PDF für {file_info['recipient_email']} nicht gefunden: {os.path.basename(pdf_path)}."})
-                    continue
-
-                server.send_message(msg)
-                process_log.append({'status': 'success', 'message': f"E-Mail erfolgreich an {file_info['recipient_email']} gesendet."})
-                sent_items_for_report.append(file_info)
-
+                await pool.open()
             except Exception as e:
-                process_log.append({'status': 'error', 'message': f"Fehler beim Senden an {file_info['recipient_email']}: {e}"})
-
-        server.quit()
-
+                critical_message = f"KRITISCHER FEHLER BEIM SENDEN (SMTP-Verbindung): {e}"
+                if not any(log_entry['message'] == critical_message for log_entry in process_log):
+                    process_log.append({'status': 'error', 'message': critical_message})
+                for entry in due:
+                    await handle_result(entry, e, None)
+                continue
+
+            await pool.deliver(items, lambda session, file_info: _send_item(session, file_info, smtp_from_email, attachment_cache),
+                               lambda index, error, duration: handle_result(due[index], error, duration))
+        batch_seconds = time.monotonic() - batch_started
+
+        finish_process(db, process)
+        queue = db.query(GeneratedFile).filter(GeneratedFile.process_id == process_id).order_by(GeneratedFile.id).all()
+        for entry in queue:
+            log_entry = {'status': 'success' if entry.email_sent_status == STATE_SUCCESS else 'error',
+                         'message': entry.email_sent_message or f"E-Mail an {entry.recipient_email} wurde nicht versendet."}
+            if entry.id in latencies:
+                log_entry['latency_ms'] = latencies[entry.id]
+            process_log.append(log_entry)
+
+        sent_latencies = [latencies[entry.id] for entry in queue if entry.email_sent_status == STATE_SUCCESS and entry.id in latencies]
+        if sent_latencies:
+            process_log.append({'status': 'info', 'message':
+                f"{len(sent_latencies)} E-Mail(s) in {batch_seconds:.1f} s über {pool.connections_opened} SMTP-Verbindung(en) versendet "
+                f"(Dauer pro E-Mail: Ø {sum(sent_latencies) / len(sent_latencies):.0f} ms, max. {max(sent_latencies)} ms)."})
+
+        throttle_count = rate_limiter.throttle_count - throttle_count_before
+        if throttle_count:
+            process_log.append({'status': 'info', 'message':
+                f"Der SMTP-Server hat den Versand {throttle_count}-mal gedrosselt (421/451); die Senderate wurde automatisch angepasst "
+                f"(zuletzt {rate_limiter.rate:.0f} E-Mails pro Minute)."})
+
+        sent_items_for_report = [{'recipient_name': entry.recipient_name, 'recipient_email': entry.recipient_email,
+                                  'pdf_path': entry.pdf_storage_path or None}
+                                 for entry in queue if entry.email_sent_status == STATE_SUCCESS]
         if sent_items_for_report:
-            report_html = "<h1>Sendebestätigung</h1><p>Der Serienmail-Assistent hat am " + \
-                      datetime.now().strftime(r'%d.%m.%Y \u\m %H:%M') + " Uhr E-Mails versendet:</p>"
-            report_html += "<table border='1' cellpadding='5' cellspacing='0' style='border-collapse: collapse; width: 100%;'>"
-            # GEÄNDERT: Spalte für Dokument anpassen, um "Kein Anhang" zu zeigen
-            report_html += "<tr><th style='background-color:#eee;'>Empfänger</th><th style='background-color:#eee;'>E-Mail</th><th style='background-color:#eee;'>Dokument</th></tr>"
-            for report_item in sent_items_for_report:
-                document_name = os.path.basename(report_item['pdf_path']) if report_item.get('pdf_path') else "Kein Anhang"
-                report_html += f"<tr><td>{report_item['recipient_name']}</td><td>{report_item['recipient_email']}</td><td>{document_name}</td></tr>"
-            report_html += "</table>"
-
-            report_msg = MIMEMultipart('alternative')
-            report_msg['From'] = f"Serienmail-Assistent Report <{smtp_from_email}>"
-            report_msg['To'] = smtp_from_email
-            report_msg['Subject'] = 'Protokoll: Serienmail-Versand'
-            report_msg.attach(MIMEText(report_html, 'html'))
-            
+            report_msg = _build_report_message(sent_items_for_report, smtp_from_email)
             try:
-                if smtp_secure == 'tls':
-                    report_server = smtplib.SMTP(smtp_host, smtp_port, timeout=30)
-                    report_server.starttls()
-                elif smtp_secure == 'ssl':
-                    report_server = smtplib.SMTP_SSL(smtp_host, smtp_port, timeout=30)
-                else:
-                    report_server = smtplib.SMTP(smtp_host, smtp_port, timeout=30)
-                
-                report_server.login(smtp_user, smtp_pass)
-                report_server.send_message(report_msg)
-                report_server.quit()
+                await pool.send(report_msg)
                 process_log.append({'status': 'info', 'message': f'Ein Sendeprotokoll wurde an {smtp_from_email} gesendet.'})
             except Exception as e:
                 process_log.append({'status': 'error', 'message': f"Fehler beim Senden des Sendeprotokolls an {smtp_from_email}: {e}"})
-
-    except Exception as e:
-        process_log.append({'status': 'error', 'message': f"KRITISCHER FEHLER BEIM SENDEN (SMTP-Verbindung): {e}"})
     finally:
-        pass
+        await pool.close()
+
+    handshake_ms = [seconds * 1000 for seconds in pool.handshake_seconds]
+    if handshake_ms:
+        process_log.append({'status': 'info', 'message':
+            f"SMTP-Verbindungsaufbau inkl. Anmeldung: {len(handshake_ms)}-mal, Ø {sum(handshake_ms) / len(handshake_ms):.0f} ms, "
+            f"max. {max(handshake_ms):.0f} ms; {pool.reconnects} Verbindung(en) nach Abbruch automatisch wiederhergestellt."})
 
-    return process_log
\ No newline at end of file
+    return process_log
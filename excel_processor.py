@@ -1,10 +1,10 @@
 import os
 import shutil
-import openpyxl
-from openpyxl.utils import get_column_letter
 from typing import Dict, List, Any
 from fastapi import UploadFile
-from helpers import clean_for_json
+from dataset_cache import Dataset, get_dataset
+from dataset_query import get_column_index, query_dataset
+from table_readers import SUPPORTED_EXTENSIONS, read_table_columns
 
 UPLOAD_DIR = "user_uploads"
 
@@ -15,8 +15,8 @@ async def handle_excel_upload(excel_file: UploadFile, user_id: int) -> Dict[str,
     file_info = os.path.splitext(excel_file.filename)
     extension = file_info[1].lower()
     
-    if extension not in ['.xlsx', '.xls']:
-        return {"error": "Ungültiges Dateiformat. Bitte .xlsx oder .xls hochladen."}
+    if extension not in SUPPORTED_EXTENSIONS:
+        return {"error": "Ungültiges Dateiformat. Bitte .xlsx, .xls, .ods oder .csv hochladen."}
 
     new_filename = f"{user_id}_{os.urandom(8).hex()}{extension}"
     new_file_path = os.path.join(UPLOAD_DIR, new_filename)
@@ -28,81 +28,69 @@ async def handle_excel_upload(excel_file: UploadFile, user_id: int) -> Dict[str,
     except Exception as e:
         return {"error": f"Fehler beim Speichern der hochgeladenen Datei: {e}"}
 
+def load_dataset(file_path: str) -> Dataset:
+    """
+    Die hochgeladene Tabelle in Spaltenform; wird pro Dateiinhalt nur einmal eingelesen.
+    Das Format (xlsx, xls, ods, csv) ergibt sich aus der Dateiendung, siehe table_readers.py.
+    """
+    return get_dataset(file_path, read_table_columns)
+
+
 def read_excel_header(file_path: str) -> List[str]:
-    header = []
     if not os.path.exists(file_path):
         return []
     try:
-        workbook = openpyxl.load_workbook(file_path, read_only=True)
-        sheet = workbook.active
-        for cell in sheet[1]:
-            if cell.value is not None and str(cell.value).strip() != '':
-                header.append(str(clean_for_json(cell.value)).strip())
-        workbook.close()
+        return list(load_dataset(file_path).columns)
     except Exception as e:
         raise Exception(f"Kritischer Fehler beim Lesen der Kopfzeile der Excel-Datei: {e}")
-    return header
 
 def read_all_excel_data(file_path: str) -> List[Dict[str, Any]]:
-    all_data = []
     if not os.path.exists(file_path):
         return []
 
     try:
-        workbook = openpyxl.load_workbook(file_path, read_only=True)
-        sheet = workbook.active
-        header_raw = [str(clean_for_json(cell.value)).strip() for cell in sheet[1] if cell.value is not None and str(cell.value).strip() != '']
-        header_index_map = {name: idx + 1 for idx, name in enumerate(header_raw)}
-
-        for row_index in range(2, sheet.max_row + 1):
-            row_data = {}
-            for col_name, col_idx in header_index_map.items():
-                cell_obj = sheet[f"{get_column_letter(col_idx)}{row_index}"]
-                row_data[col_name] = clean_for_json(cell_obj.value)
-            
-            if any(value is not None and str(value).strip() != '' for value in row_data.values()):
-                all_data.append(row_data)
-
-        workbook.close()
+        return load_dataset(file_path).rows()
     except Exception as e:
         raise Exception(f"Kritischer Fehler beim Lesen der Daten: {e}")
 
-    return all_data
-
 # === KORRIGIERTE FILTER-FUNKTION ===
 def filter_excel_data(file_path: str, column_name: str, filter_value: str) -> List[Dict[str, Any]]:
-    filtered_data = []
     if not os.path.exists(file_path):
         return []
 
+    # Beide Werte (aus der Zelle und vom Nutzer) werden als Text ohne Leerzeichen und in Kleinbuchstaben
+    # verglichen; leere Zellen (None) passen nie.
+    return query_excel_data(file_path, [{'column': column_name, 'operator': 'eq', 'value': filter_value}])
+
+def query_excel_data(file_path: str, conditions: List[Dict[str, str]], combine: str = 'and') -> List[Dict[str, Any]]:
+    """
+    Filtert mit mehreren Bedingungen (siehe dataset_query.py), verknüpft mit UND ('and') oder ODER ('or').
+    """
+    if not os.path.exists(file_path):
+        return []
+
+    try:
+        dataset = load_dataset(file_path)
+        return dataset.rows(query_dataset(dataset, conditions, combine))
+    except Exception as e:
+        raise Exception(f"Kritischer Fehler beim Filtern der Daten: {e}")
+
+def query_excel_row_ids(file_path: str, conditions: List[Dict[str, str]], combine: str = 'and') -> List[int]:
+    """Wie query_excel_data, liefert aber nur die Zeilennummern im Datensatz (ohne Bedingungen: alle Zeilen)."""
     try:
-        workbook = openpyxl.load_workbook(file_path, read_only=True)
-        sheet = workbook.active
-        header_raw = [str(clean_for_json(cell.value)).strip() for cell in sheet[1] if cell.value is not None and str(cell.value).strip() != '']
-        header_index_map = {name: idx + 1 for idx, name in enumerate(header_raw)}
-        
-        column_index_to_filter = header_index_map.get(column_name)
-        if column_index_to_filter is None:
-            raise ValueError(f"Filter-Spalte '{column_name}' nicht in Excel-Header gefunden.")
-
-        column_letter_to_filter = get_column_letter(column_index_to_filter)
-
-        for row_index in range(2, sheet.max_row + 1):
-            cell_value_on_row = sheet[f"{column_letter_to_filter}{row_index}"].value
-
-            # Hier ist die entscheidende Korrektur:
-            # 1. Prüfen, ob der Wert in der Zelle überhaupt vorhanden ist (nicht None ist).
-            # 2. Beide Werte (aus der Zelle und vom Nutzer) in Text umwandeln, Leerzeichen entfernen und in Kleinbuchstaben umwandeln für einen robusten Vergleich.
-            if cell_value_on_row is not None and str(cell_value_on_row).strip().lower() == filter_value.strip().lower():
-                row_data = {}
-                for col_name, col_idx in header_index_map.items():
-                    cell_obj = sheet[f"{get_column_letter(col_idx)}{row_index}"]
-                    row_data[col_name] = clean_for_json(cell_obj.value)
-                
-                if any(value is not None and str(value).strip() != '' for value in row_data.values()):
-                    filtered_data.append(row_data)
-        workbook.close()
+        return query_dataset(load_dataset(file_path), conditions, combine)
     except Exception as e:
         raise Exception(f"Kritischer Fehler beim Filtern der Daten: {e}")
 
-    return filtered_data
\ No newline at end of file
+def distinct_column_values(file_path: str, column_name: str, limit: int = 200) -> Dict[str, Any]:
+    """Verschiedene Werte einer Spalte mit ihrer Häufigkeit, z.B. als Vorschläge für den Filter-Wert."""
+    dataset = load_dataset(file_path)
+    if column_name not in dataset.columns:
+        raise ValueError(f"Spalte '{column_name}' nicht in Excel-Header gefunden.")
+    index = get_column_index(dataset, column_name)
+    return {
+        'column': column_name,
+        'values': index.distinct_values(limit),
+        'distinct_count': len(index.row_ids),
+        'empty_count': len(index.empty_ids),
+    }
@@ -2,6 +2,8 @@ import os
 from datetime import datetime
 import re
 import html
+from functools import lru_cache
+from typing import Callable, Iterable, List, Optional
 
 # --- Hilfsfunktion, um Werte JSON-serialisierbar zu machen (insbesondere Datums-/Zeitwerte) ---
 def clean_for_json(value):
@@ -14,16 +16,69 @@ def clean_for_json(value):
             return value.strftime('%d.%m.%Y %H:%M:%S')
     return value
 
+# --- Platzhalter im Format ${Spaltenname} (auch von docx_template.py verwendet) ---
+PLACEHOLDER_PATTERN = re.compile(r'\$\{([^}]*)\}')
+PLACEHOLDER_CACHE_SIZE = 256
+
+
+class CompiledPlaceholderTemplate:
+    """
+    Ein Text mit Platzhaltern, einmal zerlegt in statische Segmente und Slots dazwischen:
+    segments[0], slots[0], segments[1], slots[1], ..., segments[-1].
+    Eine Datenzeile wird dann in einem Durchlauf eingesetzt, unabhängig von der Anzahl der Spalten.
+    """
+
+    def __init__(self, template: str):
+        self.template = template
+        pieces = PLACEHOLDER_PATTERN.split(template)
+        # re.split liefert abwechselnd Segment und Platzhalter-Name
+        self.segments: List[str] = pieces[0::2]
+        self.slots: List[str] = pieces[1::2]
+
+    @property
+    def placeholders(self) -> List[str]:
+        """Alle verwendeten Platzhalter-Namen in der Reihenfolge ihres ersten Auftretens."""
+        return list(dict.fromkeys(self.slots))
+
+    def unknown_placeholders(self, known_names: Iterable[str]) -> List[str]:
+        known = set(known_names)
+        return [name for name in self.placeholders if name not in known]
+
+    def render(self, data_row: dict, escape: Optional[Callable[[str], str]] = None) -> str:
+        """
+        Setzt die Werte der Datenzeile ein; `escape` wird nur auf eingesetzte Werte angewendet, nie auf die Vorlage.
+        Unbekannte Platzhalter bleiben wie bisher unverändert stehen.
+        """
+        if not self.slots:
+            return self.template
+        output = [self.segments[0]]
+        for slot, segment in zip(self.slots, self.segments[1:]):
+            if slot in data_row:
+                value = data_row[slot]
+                replacement_value = str(value) if value is not None else ""
+                output.append(escape(replacement_value) if escape else replacement_value)
+            else:
+                output.append(f'${{{slot}}}')
+            output.append(segment)
+        return ''.join(output)
+
+    def render_html(self, data_row: dict) -> str:
+        """Wie render(), aber die Werte werden HTML-escaped, um XSS zu verhindern."""
+        return self.render(data_row, escape=html.escape)
+
+
+@lru_cache(maxsize=PLACEHOLDER_CACHE_SIZE)
+def compile_placeholders(template: str) -> CompiledPlaceholderTemplate:
+    """Kompilierte Form eines Textes mit Platzhaltern (zwischengespeichert pro Vorlagentext)."""
+    return CompiledPlaceholderTemplate(template)
+
+
 # --- Hilfsfunktion, um Platzhalter in DOCX-Text zu ersetzen ---
 def replace_docx_placeholders_in_text(text: str, data_row: dict) -> str:
     """
     Ersetzt Platzhalter im Format ${Platzhalter} in einem Textstring durch Werte aus einer Datenzeile.
     """
-    processed_text = text
-    for key, value in data_row.items():
-        replacement_value = str(value) if value is not None else ""
-        processed_text = processed_text.replace(f'${{{key}}}', replacement_value)
-    return processed_text
+    return compile_placeholders(text).render(data_row)
 
 # --- Hilfsfunktion, um Platzhalter in HTML zu ersetzen ---
 def replace_html_placeholders_in_text(template_html: str, data_row: dict) -> str:
@@ -31,10 +86,5 @@ def replace_html_placeholders_in_text(template_html: str, data_row: dict) -> str
     Ersetzt Platzhalter im Format ${Platzhalter} in einem HTML-String durch Werte aus einer Datenzeile.
     Values werden HTML-escaped, um XSS zu verhindern.
     """
-    processed_html = template_html
-    for key, value in data_row.items():
-        replacement_value = str(value) if value is not None else ""
-        # html.escape() wird hier verwendet, um sicherzustellen, dass die ersetzten Werte keine XSS-Angriffe ermöglichen.
-        # Es ist wichtig, dass die Platzhalter selbst nicht als HTML interpretiert werden.
-        processed_html = processed_html.replace(f'${{{key}}}', html.escape(replacement_value))
-    return processed_html
\ No newline at end of file
+    # html.escape() wird nur auf die eingesetzten Werte angewendet; die Vorlage selbst ist bereits HTML.
+    return compile_placeholders(template_html).render_html(data_row)
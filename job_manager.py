@@ -0,0 +1,149 @@
+import json
+import time
+import asyncio
+import threading
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, BackgroundJob
+
+# Fortschritt wird höchstens so oft in die Datenbank geschrieben (Sekunden)
+PROGRESS_FLUSH_INTERVAL = 1.0
+
+# Referenzen auf laufende Tasks halten, sonst kann asyncio sie vorzeitig einsammeln
+_running_tasks = set()
+
+
+def _update_job(job_id: int, **fields) -> None:
+    db = SessionLocal()
+    try:
+        db.query(BackgroundJob).filter(BackgroundJob.id == job_id).update(fields)
+        db.commit()
+    finally:
+        db.close()
+
+
+class JobProgress:
+    """
+    Thread-sicherer Fortschrittszähler eines Jobs. Kann aus Worker-Threads aufgerufen werden
+    und schreibt den Stand gedrosselt in die Datenbank.
+    """
+
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+        self.processed = 0
+        self.last_message: Optional[str] = None
+        self._lock = threading.Lock()
+        self._last_flush = 0.0
+
+    def advance(self, count: int = 1, message: Optional[str] = None) -> None:
+        with self._lock:
+            self.processed += count
+            if message:
+                self.last_message = message
+            due = time.monotonic() - self._last_flush >= PROGRESS_FLUSH_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._last_flush = time.monotonic()
+            fields = {'processed_items': self.processed}
+            if self.last_message:
+                fields['last_message'] = self.last_message
+        _update_job(self.job_id, **fields)
+
+
+def create_job(db: Session, user_id: int, kind: str, total_items: int) -> BackgroundJob:
+    job = BackgroundJob(user_id=user_id, kind=kind, status='queued', total_items=total_items,
+                        last_message="Auftrag wurde angenommen und wartet auf Bearbeitung.")
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def start_job(job_id: int, runner: Callable[[JobProgress], Awaitable[Dict[str, Any]]]) -> None:
+    """
+    Startet `runner` als Hintergrund-Task. Das zurückgegebene Dict wird als Ergebnis des Jobs gespeichert.
+    """
+    task = asyncio.create_task(_run_job(job_id, runner))
+    _running_tasks.add(task)
+    task.add_done_callback(_running_tasks.discard)
+
+
+async def _run_job(job_id: int, runner: Callable[[JobProgress], Awaitable[Dict[str, Any]]]) -> None:
+    _update_job(job_id, status='running', started_at=datetime.utcnow())
+    progress = JobProgress(job_id)
+    try:
+        result = await runner(progress)
+        progress.flush()
+        _update_job(job_id, status='done', finished_at=datetime.utcnow(),
+                    result_json=json.dumps(result, default=str),
+                    last_message=result.get('summary') or progress.last_message)
+    except Exception as e:
+        progress.flush()
+        _update_job(job_id, status='failed', finished_at=datetime.utcnow(), last_message=f"FEHLER: {e}")
+
+
+def get_job(db: Session, job_id: int, user_id: int) -> Optional[BackgroundJob]:
+    return db.query(BackgroundJob).filter(BackgroundJob.id == job_id, BackgroundJob.user_id == user_id).first()
+
+
+def job_status(job: BackgroundJob) -> Dict[str, Any]:
+    """Statusdaten für die Fortschrittsanzeige, inklusive geschätzter Restlaufzeit."""
+    eta_seconds = None
+    elapsed_seconds = None
+    if job.started_at:
+        end_time = job.finished_at or datetime.utcnow()
+        elapsed_seconds = max(0.0, (end_time - job.started_at).total_seconds())
+        if job.status == 'running' and job.processed_items > 0:
+            rate = job.processed_items / max(elapsed_seconds, 0.001)
+            eta_seconds = round(max(0, job.total_items - job.processed_items) / rate)
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'total_items': job.total_items,
+        'processed_items': job.processed_items,
+        'last_message': job.last_message,
+        'elapsed_seconds': round(elapsed_seconds) if elapsed_seconds is not None else None,
+        'eta_seconds': eta_seconds,
+    }
+
+
+def take_job_result(db: Session, job: BackgroundJob) -> Optional[Dict[str, Any]]:
+    """
+    Gibt das Ergebnis eines abgeschlossenen Jobs genau einmal zurück (danach gilt es als übernommen).
+    """
+    if job.status not in ('done', 'failed') or job.result_applied:
+        return None
+    job.result_applied = True
+    db.commit()
+    if job.status == 'failed' or not job.result_json:
+        return {'processLog': job_process_log(job)}
+    return json.loads(job.result_json)
+
+
+def job_process_log(job: BackgroundJob) -> List[Dict[str, Any]]:
+    """Protokoll eines abgeschlossenen Jobs aus seinem gespeicherten Ergebnis (bei einem Fehler die Fehlermeldung)."""
+    if job.status == 'failed' or not job.result_json:
+        return [{'status': 'error', 'message': job.last_message or 'Der Vorgang ist fehlgeschlagen.'}]
+    return json.loads(job.result_json).get('processLog', [])
+
+
+def fail_interrupted_jobs() -> None:
+    """
+    Jobs, die bei einem Neustart noch liefen, können nicht fortgesetzt werden und gelten als fehlgeschlagen.
+    Ausnahme: Versand-Jobs mit offener Ausgangs-Warteschlange (siehe routers.main_app.resume_sending_jobs).
+    """
+    db = SessionLocal()
+    try:
+        db.query(BackgroundJob).filter(BackgroundJob.status.in_(['queued', 'running'])).update(
+            {'status': 'failed', 'finished_at': datetime.utcnow(),
+             'last_message': 'FEHLER: Der Vorgang wurde durch einen Neustart des Servers abgebrochen.'},
+            synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
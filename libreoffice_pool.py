@@ -0,0 +1,344 @@
+import os
+import sys
+import time
+import queue
+import shutil
+import signal
+import tempfile
+import threading
+import subprocess
+from typing import Optional, List
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Konfiguration des Worker-Pools (über Umgebungsvariablen steuerbar) ---
+# Anzahl parallel bearbeiteter Blöcke bei der PDF-Erzeugung (Standard: Anzahl der CPU-Kerne, siehe pdf_generator.py)
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", str(os.cpu_count() or 1)))
+# Anzahl der dauerhaft laufenden LibreOffice-Instanzen, standardmäßig eine pro PDF-Worker. Beide Werte gehören
+# zusammen: Jeder parallele Block braucht eine eigene Instanz, sonst wartet er auf einen freien Worker und die
+# Konvertierungen laufen doch nacheinander. Jede Instanz belegt bis zu LIBREOFFICE_WORKER_MAX_RSS_MB Speicher,
+# wird aber erst bei Bedarf gestartet. 0 deaktiviert den Pool, dann wird wie bisher pro Dokument ein eigener
+# LibreOffice-Prozess gestartet.
+POOL_SIZE = int(os.environ.get("LIBREOFFICE_POOL_SIZE", str(max(1, PDF_WORKERS))))
+POOL_BASE_PORT = int(os.environ.get("LIBREOFFICE_POOL_BASE_PORT", "2002"))
+# Nach so vielen Konvertierungen wird ein Worker vorsorglich neu gestartet.
+WORKER_MAX_JOBS = int(os.environ.get("LIBREOFFICE_WORKER_MAX_JOBS", "200"))
+# Speichergrenze pro Worker (Resident Set Size aller Prozesse der Instanz).
+WORKER_MAX_RSS_MB = int(os.environ.get("LIBREOFFICE_WORKER_MAX_RSS_MB", "700"))
+CONVERT_TIMEOUT = int(os.environ.get("LIBREOFFICE_CONVERT_TIMEOUT", "120"))
+STARTUP_TIMEOUT = int(os.environ.get("LIBREOFFICE_STARTUP_TIMEOUT", "60"))
+WATCHDOG_INTERVAL = 5
+# Unter Debian liegt das 'uno'-Modul (Paket python3-uno) nicht im Suchpfad des Python-Images.
+UNO_PYTHON_PATH = os.environ.get("UNO_PYTHON_PATH", "/usr/lib/python3/dist-packages")
+
+
+def _import_uno():
+    """
+    Importiert die LibreOffice-UNO-Bridge. Gibt None zurück, wenn sie nicht installiert ist.
+    """
+    try:
+        import uno
+        return uno
+    except ImportError:
+        pass
+    if UNO_PYTHON_PATH and os.path.isdir(UNO_PYTHON_PATH) and UNO_PYTHON_PATH not in sys.path:
+        # Ans Ende anhängen, damit die pip-Pakete Vorrang vor den System-Paketen behalten
+        sys.path.append(UNO_PYTHON_PATH)
+        try:
+            import uno
+            return uno
+        except ImportError:
+            return None
+    return None
+
+
+def _process_group_rss_mb(pgid: int) -> float:
+    """
+    Summiert den Speicherverbrauch aller Prozesse einer Prozessgruppe (nur Linux, sonst 0).
+    LibreOffice startet über ein Wrapper-Skript, daher zählt die ganze Gruppe.
+    """
+    if not os.path.isdir("/proc"):
+        return 0.0
+    total_kb = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                # Feld 5 ist die Prozessgruppe; der Prozessname in Klammern kann Leerzeichen enthalten
+                stat_fields = f.read().rsplit(")", 1)[1].split()
+            if int(stat_fields[2]) != pgid:
+                continue
+            with open(f"/proc/{entry}/status", "r") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total_kb += int(line.split()[1])
+                        break
+        except (OSError, IndexError, ValueError):
+            continue
+    return total_kb / 1024
+
+
+class LibreOfficeWorker:
+    """
+    Eine dauerhaft laufende, unsichtbare LibreOffice-Instanz mit eigenem Benutzerprofil,
+    die Konvertierungsaufträge über eine UNO-Socket-Verbindung entgegennimmt.
+    """
+
+    def __init__(self, index: int, soffice_path: str, port: int, profile_dir: str, uno_module):
+        self.index = index
+        self.soffice_path = soffice_path
+        self.port = port
+        self.profile_dir = profile_dir
+        self.uno = uno_module
+        self.process: Optional[subprocess.Popen] = None
+        self.desktop = None
+        self.jobs_done = 0
+        self.busy_since: Optional[float] = None
+        self.busy_timeout = CONVERT_TIMEOUT
+        self.needs_restart = False
+        self.restart_count = 0
+
+    def start(self) -> None:
+        os.makedirs(self.profile_dir, exist_ok=True)
+        command = [
+            self.soffice_path,
+            "--headless", "--invisible", "--nologo", "--norestore", "--nodefault", "--nolockcheck",
+            f"-env:UserInstallation={self.uno.systemPathToFileUrl(self.profile_dir)}",
+            f"--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext",
+        ]
+        self.process = subprocess.Popen(
+            command,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=(os.name == "posix"),
+        )
+        self.desktop = self._connect()
+        self.jobs_done = 0
+        self.busy_since = None
+        self.needs_restart = False
+
+    def _connect(self):
+        local_context = self.uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local_context
+        )
+        connection_url = f"uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext"
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        last_error = None
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise Exception(f"LibreOffice-Worker {self.index} wurde beim Start beendet (Code {self.process.returncode}).")
+            try:
+                context = resolver.resolve(connection_url)
+                return context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+            except Exception as e:  # NoConnectException, solange der Listener noch nicht bereit ist
+                last_error = e
+                time.sleep(0.25)
+        raise Exception(f"LibreOffice-Worker {self.index} nicht erreichbar: {last_error}")
+
+    def _property(self, name: str, value):
+        from com.sun.star.beans import PropertyValue
+        prop = PropertyValue()
+        prop.Name = name
+        prop.Value = value
+        return prop
+
+    def convert(self, docx_path: str, pdf_path: str, timeout: int = CONVERT_TIMEOUT) -> None:
+        self.busy_timeout = timeout
+        self.busy_since = time.monotonic()
+        try:
+            document = self.desktop.loadComponentFromURL(
+                self.uno.systemPathToFileUrl(os.path.abspath(docx_path)), "_blank", 0,
+                (self._property("Hidden", True), self._property("ReadOnly", True))
+            )
+            if document is None:
+                raise Exception(f"Dokument konnte nicht geladen werden: {os.path.basename(docx_path)}")
+            try:
+                document.storeToURL(
+                    self.uno.systemPathToFileUrl(os.path.abspath(pdf_path)),
+                    (self._property("FilterName", "writer_pdf_Export"),)
+                )
+            finally:
+                document.close(True)
+            self.jobs_done += 1
+        finally:
+            self.busy_since = None
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def rss_mb(self) -> float:
+        if not self.is_alive() or os.name != "posix":
+            return 0.0
+        return _process_group_rss_mb(self.process.pid)
+
+    def kill(self) -> None:
+        if self.process is None:
+            return
+        try:
+            if os.name == "posix":
+                os.killpg(self.process.pid, signal.SIGKILL)
+            else:
+                self.process.kill()
+        except (ProcessLookupError, PermissionError, OSError):
+            pass
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            pass
+        self.process = None
+        self.desktop = None
+
+    def stop(self) -> None:
+        if self.desktop is not None:
+            try:
+                self.desktop.terminate()
+            except Exception:
+                pass
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                pass
+        self.kill()
+
+    def restart(self) -> None:
+        self.kill()
+        self.restart_count += 1
+        self.start()
+
+
+class LibreOfficePool:
+    """
+    Verwaltet eine feste Anzahl von LibreOffice-Workern. Konvertierungen warten auf einen freien
+    Worker; ein Watchdog-Thread beendet hängende Worker, die dann beim nächsten Zugriff neu starten.
+    """
+
+    def __init__(self, soffice_path: str, size: int, uno_module):
+        self.soffice_path = soffice_path
+        self.size = size
+        self.uno = uno_module
+        self.workers: List[LibreOfficeWorker] = []
+        self._idle: "queue.Queue[LibreOfficeWorker]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+        self._stopping = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+        self._base_dir = tempfile.mkdtemp(prefix="lo_pool_")
+
+    def _ensure_started(self) -> None:
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            for index in range(self.size):
+                worker = LibreOfficeWorker(
+                    index=index,
+                    soffice_path=self.soffice_path,
+                    port=POOL_BASE_PORT + index,
+                    profile_dir=os.path.join(self._base_dir, f"profile_{index}"),
+                    uno_module=self.uno,
+                )
+                # Worker werden erst bei der ersten Verwendung gestartet (needs_restart)
+                worker.needs_restart = True
+                self.workers.append(worker)
+                self._idle.put(worker)
+            self._watchdog = threading.Thread(target=self._watchdog_loop, name="libreoffice-watchdog", daemon=True)
+            self._watchdog.start()
+            self._started = True
+
+    def convert(self, docx_path: str, pdf_path: str, timeout: int = CONVERT_TIMEOUT) -> str:
+        """
+        Konvertiert eine DOCX-Datei über einen freien Worker nach `pdf_path`.
+        """
+        self._ensure_started()
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise Exception("Kein LibreOffice-Worker verfügbar (Timeout beim Warten auf einen freien Worker).")
+
+        try:
+            if worker.needs_restart or not worker.is_alive():
+                if worker.process is None:
+                    worker.start()
+                else:
+                    worker.restart()
+            worker.convert(docx_path, pdf_path, timeout)
+        except Exception as e:
+            # Der Worker ist in einem unbekannten Zustand und wird beim nächsten Auftrag neu gestartet
+            worker.needs_restart = True
+            raise Exception(f"LibreOffice-Worker {worker.index}: {e}")
+        finally:
+            if worker.jobs_done >= WORKER_MAX_JOBS or worker.rss_mb() > WORKER_MAX_RSS_MB:
+                worker.needs_restart = True
+            self._idle.put(worker)
+
+        if not os.path.exists(pdf_path):
+            raise Exception(f"LibreOffice Konvertierung fehlgeschlagen: PDF-Datei '{pdf_path}' nicht gefunden.")
+        return pdf_path
+
+    def _watchdog_loop(self) -> None:
+        while not self._stopping.wait(WATCHDOG_INTERVAL):
+            for worker in self.workers:
+                busy_since = worker.busy_since
+                if busy_since is not None and time.monotonic() - busy_since > worker.busy_timeout:
+                    # Hängende Konvertierung: Prozess beenden, der wartende Aufruf erhält einen Fehler
+                    print(f"WARNUNG (libreoffice_pool.py): Worker {worker.index} hängt seit über {worker.busy_timeout}s und wird beendet.")
+                    worker.needs_restart = True
+                    worker.kill()
+                elif busy_since is None and worker.is_alive() and worker.rss_mb() > WORKER_MAX_RSS_MB:
+                    worker.needs_restart = True
+
+    def status(self) -> List[dict]:
+        return [{
+            "index": worker.index,
+            "alive": worker.is_alive(),
+            "busy": worker.busy_since is not None,
+            "jobs_done": worker.jobs_done,
+            "restarts": worker.restart_count,
+            "rss_mb": round(worker.rss_mb(), 1),
+        } for worker in self.workers]
+
+    def shutdown(self) -> None:
+        self._stopping.set()
+        for worker in self.workers:
+            worker.stop()
+        shutil.rmtree(self._base_dir, ignore_errors=True)
+
+
+_pool: Optional[LibreOfficePool] = None
+_pool_lock = threading.Lock()
+_pool_unavailable = False
+
+
+def get_conversion_pool(soffice_path: str) -> Optional[LibreOfficePool]:
+    """
+    Liefert den globalen Worker-Pool oder None, wenn er deaktiviert ist oder die
+    UNO-Bridge fehlt (dann wird pro Dokument ein eigener LibreOffice-Prozess verwendet).
+    """
+    global _pool, _pool_unavailable
+    if _pool is not None:
+        return _pool
+    if _pool_unavailable or POOL_SIZE <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None and not _pool_unavailable:
+            uno_module = _import_uno()
+            if uno_module is None:
+                print("WARNUNG (libreoffice_pool.py): Python-Modul 'uno' nicht gefunden. "
+                      "LibreOffice wird pro Dokument einzeln gestartet (langsamer).")
+                _pool_unavailable = True
+                return None
+            _pool = LibreOfficePool(soffice_path, POOL_SIZE, uno_module)
+    return _pool
+
+
+def shutdown_conversion_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
@@ -0,0 +1,221 @@
+import os
+import socket
+import hashlib
+import smtplib
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, ProcessLogEntry, GeneratedFile
+
+load_dotenv()
+
+# Jede ausgehende E-Mail ist ein GeneratedFile-Eintrag (Ausgangs-Warteschlange). Der Versand-Job arbeitet die
+# Einträge eines Vorgangs ab; nach einem Neustart wird dort weitergemacht, wo der Versand stehen geblieben ist.
+MAIL_MAX_ATTEMPTS = int(os.environ.get("MAIL_MAX_ATTEMPTS", "5"))
+# Wartezeit vor dem n-ten erneuten Versuch: MAIL_RETRY_BASE_SECONDS * 2^(n-1), höchstens MAIL_RETRY_MAX_SECONDS
+MAIL_RETRY_BASE_SECONDS = float(os.environ.get("MAIL_RETRY_BASE_SECONDS", "30"))
+MAIL_RETRY_MAX_SECONDS = float(os.environ.get("MAIL_RETRY_MAX_SECONDS", "900"))
+
+STATE_QUEUED = 'queued'
+STATE_SENDING = 'sending'
+STATE_RETRY = 'retry'
+STATE_SUCCESS = 'success'
+STATE_FAILED = 'failed'
+PENDING_STATES = (STATE_QUEUED, STATE_SENDING, STATE_RETRY)
+
+
+def idempotency_key(mailing_id: Any, review_id: Any, recipient_id: Any) -> str:
+    """
+    Schlüssel pro Vorschau-Eintrag eines Vorgangs (MailingJob, Vorschau-Kennung, MailingRecipient): wird dasselbe
+    Formular doppelt abgeschickt, ergibt sich derselbe Schlüssel und die E-Mail wird nicht erneut eingereiht.
+    """
+    return hashlib.sha256(f"{mailing_id}:{review_id}:{recipient_id}".encode('utf-8')).hexdigest()[:40]
+
+
+def message_id_for(key: str, smtp_from_email: str) -> str:
+    """
+    Feste Message-ID pro Warteschlangen-Eintrag: Wird eine Nachricht nach einem Abbruch erneut übergeben,
+    kann der empfangende Server sie als Duplikat erkennen.
+    """
+    domain = smtp_from_email.rsplit('@', 1)[-1] if '@' in smtp_from_email else 'localhost'
+    return f"<{key}@{domain}>"
+
+
+def is_transient_error(error: Exception) -> bool:
+    """4xx-Antworten und abgebrochene Verbindungen sind vorübergehend, alles andere (5xx, fehlende Anhänge) endgültig."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        return bool(codes) and all(400 <= code < 500 for code in codes)
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, socket.timeout))
+
+
+def retry_delay(attempts: int) -> timedelta:
+    return timedelta(seconds=min(MAIL_RETRY_MAX_SECONDS, MAIL_RETRY_BASE_SECONDS * 2 ** max(0, attempts - 1)))
+
+
+def _existing_keys(db: Session, keys: List[str]) -> set:
+    existing = set()
+    for start in range(0, len(keys), 500):
+        existing.update(key for (key,) in db.query(GeneratedFile.idempotency_key)
+                        .filter(GeneratedFile.idempotency_key.in_(keys[start:start + 500])).all())
+    return existing
+
+
+def enqueue_mailing(db: Session, user_id: int, process_info: Dict[str, Any],
+                    items: List[Dict[str, Any]]) -> Tuple[Optional[ProcessLogEntry], bool]:
+    """
+    Legt den Vorgang (ProcessLogEntry) und für jede E-Mail einen Warteschlangen-Eintrag an.
+    Betreff und Text werden personalisiert gespeichert, damit der Versand ohne die Tabelle fortgesetzt werden kann.
+    Einträge, deren `idempotency_key` bereits in der Warteschlange steht (z. B. doppelt abgeschicktes Formular),
+    werden übersprungen; stehen alle schon darin, wird kein neuer Vorgang angelegt, sondern der bestehende
+    zurückgegeben. Der zweite Rückgabewert gibt an, ob ein neuer Vorgang angelegt wurde.
+    """
+    keys = [item['idempotency_key'] for item in items]
+    existing = _existing_keys(db, keys)
+    new_items = [item for item in items if item['idempotency_key'] not in existing]
+    if not new_items:
+        process = db.query(ProcessLogEntry).join(GeneratedFile, GeneratedFile.process_id == ProcessLogEntry.id) \
+            .filter(GeneratedFile.idempotency_key == keys[0]).first() if keys else None
+        return process, False
+
+    try:
+        process = ProcessLogEntry(user_id=user_id, total_recipients=len(new_items), sent_emails_count=0, status=STATE_SENDING,
+                                  **process_info)
+        db.add(process)
+        db.flush()
+        db.bulk_insert_mappings(GeneratedFile, [{
+            'process_id': process.id,
+            'recipient_email': item['recipient_email'],
+            'recipient_name': item['recipient_name'] or '',
+            'pdf_filename': os.path.basename(item['pdf_path']) if item.get('pdf_path') else '',
+            'pdf_storage_path': item.get('pdf_path') or '',
+            'email_sent_status': STATE_QUEUED,
+            'attempts': 0,
+            'idempotency_key': item['idempotency_key'],
+            'email_subject': item['subject'],
+            'email_body': item['body'],
+            'email_body_text': item.get('body_text'),
+        } for item in new_items])
+        db.commit()
+    except IntegrityError:
+        # Eine gleichzeitige Anfrage hat dieselben Einträge eben eingereiht: erneut prüfen
+        db.rollback()
+        return enqueue_mailing(db, user_id, process_info, items)
+    db.refresh(process)
+    return process, True
+
+
+def queue_counts(db: Session, process_id: int) -> Dict[str, int]:
+    rows = db.query(GeneratedFile.email_sent_status, func.count(GeneratedFile.id)) \
+        .filter(GeneratedFile.process_id == process_id).group_by(GeneratedFile.email_sent_status).all()
+    return {state: count for state, count in rows}
+
+
+def due_entries(db: Session, process_id: int, now: datetime) -> List[Dict[str, Any]]:
+    """
+    Alle jetzt fälligen Einträge als einfache Dicts (ORM-Objekte würden nach jedem Commit einzeln neu geladen).
+    'sending' kommt nur nach einem Abbruch vor: ob die Nachricht angekommen ist, ist unbekannt,
+    sie wird daher mit derselben Message-ID erneut übergeben.
+    """
+    rows = db.query(GeneratedFile.id, GeneratedFile.recipient_email, GeneratedFile.recipient_name,
+                    GeneratedFile.pdf_storage_path, GeneratedFile.attempts, GeneratedFile.idempotency_key,
+                    GeneratedFile.email_subject, GeneratedFile.email_body, GeneratedFile.email_body_text).filter(
+        GeneratedFile.process_id == process_id,
+        GeneratedFile.email_sent_status.in_(PENDING_STATES),
+        (GeneratedFile.next_attempt_at.is_(None)) | (GeneratedFile.next_attempt_at <= now)
+    ).order_by(GeneratedFile.id).all()
+    return [dict(row._mapping, attempts=row.attempts or 0) for row in rows]
+
+
+def mark_sending(db: Session, entries: List[Dict[str, Any]]) -> None:
+    ids = [entry['id'] for entry in entries]
+    for start in range(0, len(ids), 500):
+        db.query(GeneratedFile).filter(GeneratedFile.id.in_(ids[start:start + 500])) \
+            .update({'email_sent_status': STATE_SENDING}, synchronize_session=False)
+    db.commit()
+
+
+def defer_entries(db: Session, entries: List[Dict[str, Any]], until: datetime) -> None:
+    """Stellt Einträge ohne Zustellversuch zurück (z. B. wegen des Tageslimits des SMTP-Kontos)."""
+    ids = [entry['id'] for entry in entries]
+    for start in range(0, len(ids), 500):
+        db.query(GeneratedFile).filter(GeneratedFile.id.in_(ids[start:start + 500])) \
+            .update({'email_sent_status': STATE_RETRY, 'next_attempt_at': until}, synchronize_session=False)
+    db.commit()
+
+
+def sent_in_last_day(db: Session, user_id: int) -> Tuple[int, Optional[datetime]]:
+    """Anzahl der in den letzten 24 Stunden versendeten E-Mails eines Benutzers und der Zeitpunkt der ältesten davon."""
+    since = datetime.utcnow() - timedelta(days=1)
+    count, oldest = db.query(func.count(GeneratedFile.id), func.min(GeneratedFile.sent_timestamp)) \
+        .join(ProcessLogEntry, ProcessLogEntry.id == GeneratedFile.process_id).filter(
+            ProcessLogEntry.user_id == user_id,
+            GeneratedFile.email_sent_status == STATE_SUCCESS,
+            GeneratedFile.sent_timestamp >= since).one()
+    return count, oldest
+
+
+def next_retry_at(db: Session, process_id: int) -> Optional[datetime]:
+    return db.query(func.min(GeneratedFile.next_attempt_at)).filter(
+        GeneratedFile.process_id == process_id, GeneratedFile.email_sent_status == STATE_RETRY).scalar()
+
+
+def record_attempt(db: Session, entry: Dict[str, Any], error: Optional[Exception], message: str) -> str:
+    """
+    Schreibt das Ergebnis eines Zustellversuchs sofort fest und gibt den neuen Zustand zurück
+    (`entry` erhält die neuen Werte für attempts und next_attempt_at).
+    """
+    entry['attempts'] += 1
+    fields = {'attempts': entry['attempts'], 'email_sent_message': message, 'next_attempt_at': None}
+    if error is None:
+        fields.update(email_sent_status=STATE_SUCCESS, sent_timestamp=datetime.utcnow())
+    elif is_transient_error(error) and entry['attempts'] < MAIL_MAX_ATTEMPTS:
+        fields.update(email_sent_status=STATE_RETRY, next_attempt_at=datetime.utcnow() + retry_delay(entry['attempts']))
+    else:
+        fields.update(email_sent_status=STATE_FAILED)
+    db.query(GeneratedFile).filter(GeneratedFile.id == entry['id']).update(fields, synchronize_session=False)
+    db.commit()
+    entry['next_attempt_at'] = fields['next_attempt_at']
+    return fields['email_sent_status']
+
+
+def store_attempt(entry: Dict[str, Any], error: Optional[Exception], message: str) -> str:
+    """
+    record_attempt mit eigener Session: wird vom Versand über asyncio.to_thread aufgerufen, damit die Event-Loop
+    nicht auf die Datenbank wartet. Der Worker nimmt erst danach die nächste Nachricht, sodass nach einem
+    Abbruch keine bereits angenommene E-Mail erneut versendet wird.
+    """
+    db = SessionLocal()
+    try:
+        return record_attempt(db, entry, error, message)
+    finally:
+        db.close()
+
+
+def finish_process(db: Session, process: ProcessLogEntry) -> None:
+    counts = queue_counts(db, process.id)
+    process.sent_emails_count = counts.get(STATE_SUCCESS, 0)
+    if process.sent_emails_count == process.total_recipients:
+        process.status = 'completed'
+    elif process.sent_emails_count == 0:
+        process.status = 'failed'
+    else:
+        process.status = 'partial_success'
+    db.commit()
+
+
+def interrupted_processes() -> List[Dict[str, Any]]:
+    """Vorgänge, deren Versand bei einem Neustart noch nicht abgeschlossen war."""
+    db = SessionLocal()
+    try:
+        processes = db.query(ProcessLogEntry).filter(ProcessLogEntry.status == STATE_SENDING).all()
+        return [{'process_id': process.id, 'user_id': process.user_id, 'job_id': process.job_id,
+                 'total': process.total_recipients} for process in processes]
+    finally:
+        db.close()
@@ -0,0 +1,209 @@
+import os
+import json
+import secrets
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional
+from dotenv import load_dotenv
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, MailingJob, MailingRecipient
+from dataset_query import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+
+load_dotenv()
+
+# Der Zustand eines Serienmail-Vorgangs liegt in der Datenbank (mailing_jobs / mailing_recipients),
+# die Session enthält nur noch dessen ID unter diesem Schlüssel.
+SESSION_KEY = 'mailing_id'
+# Nicht abgeschlossene Vorgänge werden nach dieser Zeit ohne Änderung entfernt
+MAILING_MAX_AGE_HOURS = float(os.environ.get("MAILING_MAX_AGE_HOURS", "168"))
+
+REVIEW_SORT_COLUMNS = {
+    'recipient_name': MailingRecipient.recipient_name,
+    'recipient_email': MailingRecipient.recipient_email,
+    'pdf_web_path': MailingRecipient.pdf_web_path,
+}
+
+
+class MailingState:
+    """
+    Einstellungen und Filterergebnis eines Vorgangs. Verhält sich wie ein Dict (wie zuvor die Session);
+    Änderungen werden erst mit save() in die Datenbank geschrieben.
+    """
+
+    def __init__(self, user_id: int, record: Optional[MailingJob] = None):
+        self.user_id = user_id
+        self.record = record
+        self.data: Dict[str, Any] = json.loads(record.state_json) if record and record.state_json else {}
+        self.filtered_row_ids: Optional[List[int]] = \
+            json.loads(record.filtered_row_ids) if record and record.filtered_row_ids else None
+        self._dirty = False
+
+    @property
+    def id(self) -> Optional[int]:
+        return self.record.id if self.record else None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.data.get(key, default)
+
+    def __getitem__(self, key: str) -> Any:
+        return self.data[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.data
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.data[key] = value
+        self._dirty = True
+
+    def update(self, values: Dict[str, Any]) -> None:
+        self.data.update(values)
+        self._dirty = True
+
+    def pop(self, key: str, default: Any = None) -> Any:
+        if key in self.data:
+            self._dirty = True
+        return self.data.pop(key, default)
+
+    def set_filtered_row_ids(self, row_ids: Optional[List[int]]) -> None:
+        self.filtered_row_ids = list(row_ids) if row_ids is not None else None
+        self._dirty = True
+
+    def save(self, db: Session, session) -> None:
+        """Schreibt geänderte Werte; legt den Vorgang bei der ersten Änderung an und merkt die ID in der Session."""
+        if not self._dirty:
+            return
+        if self.record is None:
+            self.record = MailingJob(user_id=self.user_id)
+            db.add(self.record)
+        self.record.state_json = json.dumps(self.data, default=str)
+        self.record.filtered_row_ids = json.dumps(self.filtered_row_ids) if self.filtered_row_ids is not None else None
+        self.record.updated_at = datetime.utcnow()
+        db.commit()
+        session[SESSION_KEY] = self.record.id
+        self._dirty = False
+
+
+def load_mailing(db: Session, session, user_id: int) -> MailingState:
+    """Der Vorgang aus der Session; ohne (gültige) ID ein leerer, noch nicht gespeicherter Vorgang."""
+    mailing_id = session.get(SESSION_KEY)
+    record = None
+    if mailing_id is not None:
+        record = db.query(MailingJob).filter(MailingJob.id == mailing_id, MailingJob.user_id == user_id).first()
+        if record is None:
+            session.pop(SESSION_KEY, None)
+    return MailingState(user_id, record)
+
+
+def discard_mailing(db: Session, session, mailing: MailingState) -> None:
+    """Löscht den Vorgang samt Vorschau-Einträgen (Neustart)."""
+    if mailing.record is not None:
+        db.delete(mailing.record)
+        db.commit()
+    session.pop(SESSION_KEY, None)
+
+
+def clear_review(db: Session, mailing: MailingState) -> None:
+    """Entfernt die Vorschau-Einträge eines Vorgangs (die erzeugten Dateien bleiben erhalten)."""
+    for key in ('reviewReady', 'combinedPdfWebPath', 'review_email_body', 'review_id'):
+        mailing.pop(key)
+    if mailing.record is not None:
+        db.query(MailingRecipient).filter(MailingRecipient.mailing_id == mailing.id).delete(synchronize_session=False)
+        db.commit()
+
+
+def store_review(mailing_id: int, entries: List[Dict[str, Any]], combined_pdf_web_path: Optional[str], email_body: str) -> None:
+    """
+    Speichert die Vorschau-Einträge eines Generierungs-Jobs direkt am Vorgang (wird im Hintergrund aufgerufen,
+    daher mit eigener Datenbank-Session). Der E-Mail-Text ist für alle Empfänger gleich und wird nur einmal abgelegt.
+    """
+    db = SessionLocal()
+    try:
+        record = db.query(MailingJob).filter(MailingJob.id == mailing_id).first()
+        if record is None:
+            return  # Vorgang wurde inzwischen zurückgesetzt
+        db.query(MailingRecipient).filter(MailingRecipient.mailing_id == mailing_id).delete(synchronize_session=False)
+        db.bulk_insert_mappings(MailingRecipient, [dict(entry, mailing_id=mailing_id, position=position)
+                                                   for position, entry in enumerate(entries)])
+        state = json.loads(record.state_json or '{}')
+        # Neue Kennung pro Vorschau: SQLite vergibt die IDs gelöschter Vorschau-Einträge erneut, die Kennung hält
+        # die Idempotenzschlüssel der Warteschlange (mail_queue.idempotency_key) trotzdem eindeutig
+        state.update({'reviewReady': True, 'combinedPdfWebPath': combined_pdf_web_path, 'review_email_body': email_body,
+                      'review_id': secrets.token_hex(8)})
+        record.state_json = json.dumps(state, default=str)
+        record.updated_at = datetime.utcnow()
+        db.commit()
+    finally:
+        db.close()
+
+
+def review_count(db: Session, mailing: MailingState) -> int:
+    if mailing.record is None:
+        return 0
+    return db.query(MailingRecipient).filter(MailingRecipient.mailing_id == mailing.id).count()
+
+
+def review_page(db: Session, mailing: MailingState, page: int = 1, page_size: int = DEFAULT_PAGE_SIZE,
+                sort_column: Optional[str] = None, descending: bool = False) -> Dict[str, Any]:
+    """Eine Seite der Vorschau-Einträge, im selben Format wie dataset_query.paginate_rows."""
+    total = review_count(db, mailing)
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    pages = max(1, -(-total // page_size))
+    page = max(1, min(page, pages))
+    query = db.query(MailingRecipient).filter(MailingRecipient.mailing_id == mailing.id)
+    sort_expression = REVIEW_SORT_COLUMNS.get(sort_column or '')
+    if sort_expression is not None:
+        query = query.order_by(sort_expression.desc() if descending else sort_expression, MailingRecipient.position)
+    else:
+        sort_column = None
+        query = query.order_by(MailingRecipient.position)
+    recipients = query.offset((page - 1) * page_size).limit(page_size).all() if total else []
+    return {
+        'page': page,
+        'page_size': page_size,
+        'pages': pages,
+        'total': total,
+        'sort': sort_column or '',
+        'order': 'desc' if descending else 'asc',
+        'rows': [{'index': recipient.position, 'row': {
+            'id': str(recipient.id),
+            'recipient_name': recipient.recipient_name,
+            'recipient_email': recipient.recipient_email,
+            'pdf_web_path': recipient.pdf_web_path,
+        }} for recipient in recipients],
+    }
+
+
+def review_recipients(db: Session, mailing: MailingState, selected_ids: Optional[Iterable[str]] = None,
+                      excluded_ids: Optional[Iterable[str]] = None) -> List[MailingRecipient]:
+    """Vorschau-Einträge in Tabellenreihenfolge, optional nur die ausgewählten bzw. ohne die abgewählten."""
+    if mailing.record is None:
+        return []
+    recipients = db.query(MailingRecipient).filter(MailingRecipient.mailing_id == mailing.id) \
+        .order_by(MailingRecipient.position).all()
+    if selected_ids is not None:
+        selected = set(selected_ids)
+        recipients = [recipient for recipient in recipients if str(recipient.id) in selected]
+    if excluded_ids is not None:
+        excluded = set(excluded_ids)
+        recipients = [recipient for recipient in recipients if str(recipient.id) not in excluded]
+    return recipients
+
+
+def delete_stale_mailings() -> int:
+    """Entfernt Vorgänge, die seit MAILING_MAX_AGE_HOURS nicht mehr geändert wurden."""
+    cutoff = datetime.utcnow() - timedelta(hours=MAILING_MAX_AGE_HOURS)
+    db = SessionLocal()
+    try:
+        stale = db.query(MailingJob).filter(MailingJob.updated_at < cutoff).all()
+        for record in stale:
+            excel_file_path = json.loads(record.state_json or '{}').get('excel_file_path')
+            if excel_file_path and os.path.exists(excel_file_path):
+                try:
+                    os.unlink(excel_file_path)
+                except OSError as e:
+                    print(f"WARNUNG (mailing_store.py): Tabelle '{excel_file_path}' konnte nicht gelöscht werden: {e}")
+            db.delete(record)
+        db.commit()
+        return len(stale)
+    finally:
+        db.close()
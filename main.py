@@ -5,9 +5,14 @@ from fastapi.staticfiles import StaticFiles
 from starlette.middleware.sessions import SessionMiddleware
 from passlib.context import CryptContext
 from fastapi.templating import Jinja2Templates
+import logging
 import traceback
 
 from database import create_db_and_tables
+from libreoffice_pool import shutdown_conversion_pool
+from job_manager import fail_interrupted_jobs
+from settings_manager import migrate_legacy_smtp_settings
+from artifact_store import start_sweeper, stop_sweeper
 from routers import auth as auth_router_module
 from routers import main_app as main_app_router_module
 from routers import settings as settings_router_module
@@ -15,6 +20,10 @@ from routers import settings as settings_router_module
 from dotenv import load_dotenv
 load_dotenv()
 
+# Meldungen der Module, die logging verwenden (z. B. settings_manager.py); LOG_LEVEL=DEBUG zeigt auch Detailmeldungen
+logging.basicConfig(level=getattr(logging, os.getenv("LOG_LEVEL", "WARNING").upper(), logging.WARNING),
+                    format="%(levelname)s (%(module)s.py): %(message)s")
+
 app = FastAPI(title="Serienbrief-Assistent")
 
 SESSION_SECRET_KEY = os.getenv("SESSION_SECRET_KEY", "super-secret-key-please-change")
@@ -34,7 +43,7 @@ for dir_path in [UPLOAD_DIR, os.path.join(UPLOAD_DIR, "word_templates"), PDF_GEN
     os.makedirs(dir_path, exist_ok=True)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
-app.mount(f"/{PDF_GENERATED_DIR}", StaticFiles(directory=PDF_GENERATED_DIR), name="generated_pdfs")
+# Erzeugte PDFs werden nicht mehr statisch ausgeliefert, sondern nur an ihren Besitzer (siehe routers/main_app.py)
 
 app.include_router(auth_router_module.router)
 app.include_router(main_app_router_module.router)
@@ -43,6 +52,18 @@ app.include_router(settings_router_module.router)
 @app.on_event("startup")
 async def startup_event():
     create_db_and_tables()
+    migrate_legacy_smtp_settings()
+    fail_interrupted_jobs()
+    # Versandvorgänge mit offener Ausgangs-Warteschlange werden dagegen fortgesetzt
+    main_app_router_module.resume_sending_jobs()
+    # Alte Dateien in generated_pdfs regelmäßig entfernen (TTL und Speicherquoten)
+    start_sweeper()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    stop_sweeper()
+    # Dauerhaft laufende LibreOffice-Instanzen sauber beenden
+    shutdown_conversion_pool()
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
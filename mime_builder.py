@@ -0,0 +1,105 @@
+import os
+import re
+import html
+import mmap
+import base64
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from email.mime.base import MIMEBase
+from typing import Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Obergrenze für zwischengespeicherte, bereits base64-kodierte Anhänge eines Versandvorgangs
+MIME_ATTACHMENT_CACHE_MB = float(os.environ.get("MIME_ATTACHMENT_CACHE_MB", "64"))
+# base64 kodiert 57 Bytes zu einer Zeile mit 76 Zeichen; Blöcke mit einem Vielfachen davon lassen sich
+# einzeln kodieren und ohne Nacharbeit aneinanderhängen
+BASE64_CHUNK_SIZE = 57 * 16384
+
+_BLOCK_END_PATTERN = re.compile(r'<br\s*/?>|</(?:p|div|h[1-6]|li|tr|table)\s*>', re.IGNORECASE)
+_TAG_PATTERN = re.compile(r'<[^>]+>')
+_SPACES_PATTERN = re.compile(r'[ \t\r\f\v]+')
+
+
+@lru_cache(maxsize=64)
+def html_to_plain_text(template_html: str) -> str:
+    """
+    Text-Alternative zu einem HTML-Text: Absätze und Zeilenumbrüche bleiben als Zeilen erhalten, Tags entfallen,
+    HTML-Entitäten werden aufgelöst. Wird auf die Vorlage angewendet (einmal pro Vorgang), Platzhalter bleiben stehen.
+    """
+    text = _BLOCK_END_PATTERN.sub('\n', template_html)
+    text = html.unescape(_TAG_PATTERN.sub('', text))
+    lines = [_SPACES_PATTERN.sub(' ', line).strip() for line in text.split('\n')]
+    return '\n'.join(line for line in lines if line)
+
+
+def encode_base64_file(path: str) -> str:
+    """
+    Kodiert eine Datei blockweise (per mmap, sonst per read) nach base64 mit 76 Zeichen pro Zeile.
+    Die Rohdaten liegen dabei nie vollständig im Speicher.
+    """
+    parts = []
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return ''
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for start in range(0, size, BASE64_CHUNK_SIZE):
+                    parts.append(base64.encodebytes(mapped[start:start + BASE64_CHUNK_SIZE]).decode('ascii'))
+        except (OSError, ValueError):
+            # z. B. Dateisysteme ohne mmap-Unterstützung
+            parts = []
+            f.seek(0)
+            while chunk := f.read(BASE64_CHUNK_SIZE):
+                parts.append(base64.encodebytes(chunk).decode('ascii'))
+    return ''.join(parts)
+
+
+class AttachmentCache:
+    """
+    Hält die base64-Form von Anhängen, die innerhalb eines Versandvorgangs mehrfach vorkommen (z. B. dieselbe
+    Infobroschüre für alle Empfänger). Eine Datei wird erst beim zweiten Auftreten aufgenommen, damit individuelle
+    Dokumente den Speicher nicht füllen. Thread-sicher, da die Pool-Worker parallel Nachrichten bauen.
+    """
+
+    def __init__(self, max_bytes: float = MIME_ATTACHMENT_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.hits = 0
+        self._entries: "OrderedDict[Tuple, str]" = OrderedDict()
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def encoded(self, path: str) -> str:
+        stat_result = os.stat(path)
+        key = (os.path.realpath(path), stat_result.st_size, stat_result.st_mtime_ns)
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return encoded
+            seen_before = key in self._seen
+            self._seen.add(key)
+        encoded = encode_base64_file(path)
+        if seen_before and len(encoded) <= self.max_bytes:
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = encoded
+                    self.size_bytes += len(encoded)
+                    while self.size_bytes > self.max_bytes:
+                        _, evicted = self._entries.popitem(last=False)
+                        self.size_bytes -= len(evicted)
+        return encoded
+
+
+def pdf_attachment_part(path: str, cache: Optional[AttachmentCache] = None) -> MIMEBase:
+    """MIME-Teil für einen PDF-Anhang mit bereits kodiertem Inhalt (wird beim Senden nicht erneut kodiert)."""
+    part = MIMEBase('application', 'pdf')
+    part.set_payload(cache.encoded(path) if cache is not None else encode_base64_file(path))
+    part['Content-Transfer-Encoding'] = 'base64'
+    part.add_header('Content-Disposition', 'attachment', filename=os.path.basename(path))
+    return part
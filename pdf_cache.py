@@ -0,0 +1,145 @@
+import os
+import time
+import shutil
+import hashlib
+import threading
+from typing import Dict, Iterable, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PDF_CACHE_ENABLED = os.environ.get("PDF_CACHE_ENABLED", "1") not in ("0", "false", "False", "")
+PDF_CACHE_MAX_MB = int(os.environ.get("PDF_CACHE_MAX_MB", "512"))
+PDF_CACHE_MAX_AGE_HOURS = float(os.environ.get("PDF_CACHE_MAX_AGE_HOURS", "72"))
+# Eine vollständige Aufräumrunde (Verzeichnis durchsuchen) höchstens einmal pro Intervall
+EVICTION_INTERVAL_SECONDS = 300
+
+
+def pdf_cache_key(template_digest: str, placeholders: Iterable[str], data_row: dict) -> str:
+    """
+    Schlüssel einer personalisierten PDF: Hash der Vorlage plus die Werte genau der Spalten,
+    die die Vorlage als Platzhalter verwendet. Andere Spalten (z.B. die E-Mail-Adresse) haben
+    keinen Einfluss auf das Dokument und damit auch nicht auf den Schlüssel.
+    """
+    digest = hashlib.sha256(template_digest.encode('utf-8'))
+    for key in sorted(placeholders):
+        if key in data_row:
+            value = data_row[key]
+            value_text = "v" + (str(value) if value is not None else "")
+        else:
+            value_text = "-"  # Platzhalter bleibt im Dokument stehen
+        digest.update(b"\x00" + key.encode('utf-8') + b"\x1f" + value_text.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _link_or_copy(source_path: str, target_path: str) -> None:
+    """Legt einen Hardlink an (keine zusätzliche Kopie auf der Platte), sonst wird kopiert."""
+    if os.path.exists(target_path):
+        os.unlink(target_path)
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copyfile(source_path, target_path)
+
+
+class PdfCache:
+    """
+    Inhaltsadressierter Ablageort für bereits erzeugte PDFs mit Verdrängung nach Alter und Gesamtgröße.
+    Die Änderungszeit einer Datei dient als Zeitpunkt der letzten Verwendung.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, max_age_seconds: float):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._last_eviction = 0.0
+        self._approx_bytes: Optional[int] = None
+
+    def _path_for(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.pdf")
+
+    def fetch(self, key: str, target_path: str) -> bool:
+        """
+        Stellt die PDF zum Schlüssel unter `target_path` bereit. Gibt False zurück, wenn sie nicht im Cache liegt.
+        """
+        cached_path = self._path_for(key)
+        try:
+            os.utime(cached_path)  # als zuletzt verwendet markieren
+            _link_or_copy(cached_path, target_path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return False
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def store(self, key: str, pdf_path: str) -> None:
+        """Übernimmt eine frisch erzeugte PDF in den Cache."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cached_path = self._path_for(key)
+        temp_path = f"{cached_path}.{os.urandom(4).hex()}.tmp"
+        try:
+            _link_or_copy(pdf_path, temp_path)
+            os.replace(temp_path, cached_path)
+        except OSError as e:
+            print(f"WARNUNG (pdf_cache.py): PDF konnte nicht im Cache abgelegt werden: {e}")
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            return
+        with self._lock:
+            self.stores += 1
+            if self._approx_bytes is not None:
+                self._approx_bytes += os.path.getsize(cached_path)
+            due = time.monotonic() - self._last_eviction > EVICTION_INTERVAL_SECONDS or \
+                (self._approx_bytes is not None and self._approx_bytes > self.max_bytes)
+        if due:
+            self.evict()
+
+    def evict(self) -> None:
+        """Entfernt abgelaufene Einträge und danach die am längsten unbenutzten, bis die Größengrenze passt."""
+        with self._lock:
+            self._last_eviction = time.monotonic()
+        entries = []
+        try:
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if entry.is_file() and entry.name.endswith(".pdf"):
+                        stat_result = entry.stat()
+                        entries.append((stat_result.st_mtime, stat_result.st_size, entry.path))
+        except FileNotFoundError:
+            return
+
+        now = time.time()
+        entries.sort()  # älteste zuerst
+        total_bytes = sum(size for _, size, _ in entries)
+        removed = 0
+        for mtime, size, path in entries:
+            if now - mtime <= self.max_age_seconds and total_bytes <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                removed += 1
+                total_bytes -= size
+            except OSError:
+                pass
+        with self._lock:
+            self.evictions += removed
+            self._approx_bytes = total_bytes
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "approx_bytes": self._approx_bytes or 0,
+            }
@@ -1,14 +1,22 @@
 import os
 import subprocess
-import zipfile
-from lxml import etree
-from io import BytesIO
-import re
 import shutil
+import queue
+import tempfile
+import threading
+from io import BytesIO
+from datetime import datetime
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Dict, Any, Optional, Callable
 from dotenv import load_dotenv
+from pypdf import PdfReader, PdfWriter
 
 load_dotenv()
-from helpers import replace_docx_placeholders_in_text
+from docx_template import get_compiled_template
+from pdf_cache import PdfCache, pdf_cache_key, PDF_CACHE_ENABLED, PDF_CACHE_MAX_MB, PDF_CACHE_MAX_AGE_HOURS
+from libreoffice_pool import get_conversion_pool, PDF_WORKERS # PDF_WORKERS bestimmt auch die Größe des Pools
 
 # --- Globale Konfiguration für Verzeichnisse ---
 DOCX_TEMP_DIR = "temp_docx_processed"
@@ -21,25 +29,127 @@ PDF_GENERATED_DIR = "generated_pdfs"
 LIBREOFFICE_PATH = os.environ.get("LIBREOFFICE_PATH", "/usr/bin/libreoffice")
 # ========= ANPASSUNG ENDE =========
 
+# Anzahl der Dokumente, die im Batch-Modus in einem einzigen LibreOffice-Aufruf konvertiert werden
+LIBREOFFICE_BATCH_SIZE = int(os.environ.get("LIBREOFFICE_BATCH_SIZE", "25"))
+LIBREOFFICE_TIMEOUT = 120
+
+# Bereits erzeugte PDFs werden inhaltsadressiert unter generated_pdfs/.cache wiederverwendet
+PDF_CACHE_DIR = os.path.join(PDF_GENERATED_DIR, ".cache")
+pdf_cache = PdfCache(PDF_CACHE_DIR, PDF_CACHE_MAX_MB * 1024 * 1024, PDF_CACHE_MAX_AGE_HOURS * 3600) if PDF_CACHE_ENABLED else None
+
+# Zusätzliche Zeit pro Empfänger, die die Konvertierung eines Sammeldokuments dauern darf (Sekunden)
+MERGED_TIMEOUT_PER_COPY = 2
+BASE_PDF_CACHE_SIZE = 8
+_base_pdf_cache: "OrderedDict[str, bytes]" = OrderedDict()
+_base_pdf_lock = threading.Lock()
+
+
+def _write_personalized_docx(original_docx_path: str, data_row: dict) -> str:
+    """
+    Erstellt eine temporäre, personalisierte Kopie der DOCX-Vorlage und gibt deren Pfad zurück.
+    Das Dokument wird im Speicher aus der einmalig kompilierten Vorlage zusammengesetzt
+    (siehe docx_template.py) und nur einmal für LibreOffice auf die Platte geschrieben.
+    """
+    temp_output_docx_path = os.path.join(DOCX_TEMP_DIR, f'temp_output_{os.urandom(8).hex()}.docx')
+
+    try:
+        compiled_template = get_compiled_template(original_docx_path)
+        docx_bytes = compiled_template.render_docx(data_row)
+        with open(temp_output_docx_path, 'wb') as f:
+            f.write(docx_bytes)
+        return temp_output_docx_path
+
+    except Exception as e:
+        if os.path.exists(temp_output_docx_path): os.unlink(temp_output_docx_path)
+        raise Exception(f"Fehler bei der DOCX-XML-Manipulation: {e}")
+
+
+def _libreoffice_error(e: Exception) -> Exception:
+    """
+    Übersetzt Fehler beim LibreOffice-Aufruf in die für die Oberfläche bestimmten Meldungen.
+    """
+    if isinstance(e, subprocess.TimeoutExpired):
+        return Exception("LibreOffice Konvertierung hat zu lange gedauert und wurde abgebrochen (Timeout).")
+    if isinstance(e, FileNotFoundError):
+        # Diese Fehlermeldung ist jetzt generischer und nicht mehr Windows-spezifisch.
+        return Exception(f"LibreOffice-Programm nicht gefunden unter dem Pfad '{LIBREOFFICE_PATH}'. "
+                         "Bitte überprüfen Sie die Konfiguration (lokal in .env, in der Cloud im Code).")
+    return Exception(f"Fehler bei LibreOffice-Aufruf: {e}")
+
+
+# Gleichzeitig laufende LibreOffice-Prozesse dürfen sich kein Benutzerprofil teilen, sonst übergibt
+# der zweite Prozess seinen Auftrag an den ersten. Jeder Aufruf leiht sich daher ein eigenes Profil.
+_profile_slots: "queue.Queue[str]" = queue.Queue()
+for _slot in range(max(1, PDF_WORKERS)):
+    _profile_slots.put(os.path.join(tempfile.gettempdir(), f"serienbrief_lo_profile_{_slot}"))
+
 
-# NEUE FUNKTION: Manipuliert die XML-Datei eines DOCX-Dokuments
-def _manipulate_docx_xml_content(xml_content_bytes: bytes, data_row: dict) -> bytes:
+def _run_libreoffice_convert(docx_paths: List[str], output_dir: str, timeout: Optional[int] = None) -> None:
     """
-    Sucht und ersetzt Platzhalter in einem XML-Inhalt (z.B. document.xml, header.xml).
+    Startet einen LibreOffice-Prozess, der alle übergebenen DOCX-Dateien nach PDF konvertiert.
     """
-    parser = etree.XMLParser(remove_blank_text=True)
-    root = etree.fromstring(xml_content_bytes, parser)
+    profile_dir = _profile_slots.get()
+    try:
+        libreoffice_command = [
+            LIBREOFFICE_PATH, # Verwendet jetzt die flexible Variable
+            f"-env:UserInstallation={Path(profile_dir).as_uri()}",
+            "--headless",
+            "--convert-to", "pdf",
+            "--outdir", output_dir,
+            *docx_paths
+        ]
+        # Der Startaufwand fällt einmal an, die Konvertierung selbst skaliert mit der Anzahl der Dateien
+        timeout = timeout or LIBREOFFICE_TIMEOUT + 30 * (len(docx_paths) - 1)
+        result = subprocess.run(libreoffice_command, capture_output=True, text=True, timeout=timeout)
+    finally:
+        _profile_slots.put(profile_dir)
+
+    if result.returncode != 0:
+        # Hier geben wir eine detailliertere Fehlermeldung aus
+        error_details = result.stderr or result.stdout
+        raise Exception(f"LibreOffice Konvertierungsfehler ({result.returncode}): {error_details}")
+
+
+def _pdf_path_for(docx_path: str, output_dir: str) -> str:
+    return os.path.join(output_dir, os.path.basename(docx_path).replace('.docx', '.pdf'))
+
+
+def _convert_docx_to_pdf(docx_path: str, output_dir: str, timeout: Optional[int] = None) -> str:
+    """
+    Konvertiert eine DOCX-Datei mit LibreOffice nach PDF und gibt den Pfad der PDF zurück.
+    Läuft der Worker-Pool, wird eine bereits gestartete Instanz verwendet, sonst ein eigener Prozess.
+    """
+    pdf_path = _pdf_path_for(docx_path, output_dir)
+
+    pool = get_conversion_pool(LIBREOFFICE_PATH)
+    if pool is not None:
+        return pool.convert(docx_path, pdf_path, timeout or LIBREOFFICE_TIMEOUT)
+
+    _run_libreoffice_convert([docx_path], output_dir, timeout)
+    if not os.path.exists(pdf_path):
+        raise Exception(f"LibreOffice Konvertierung fehlgeschlagen: PDF-Datei '{pdf_path}' nicht gefunden.")
+    return pdf_path
+
 
-    word_namespace = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
-    
-    for text_element in root.findall(f'.//{word_namespace}t'):
-        original_text = text_element.text
-        if original_text and '${' in original_text:
-            new_text = replace_docx_placeholders_in_text(original_text, data_row)
-            if new_text != original_text:
-                text_element.text = new_text
-    
-    return etree.tostring(root, pretty_print=True, encoding='UTF-8', xml_declaration=True)
+def _move_to_output(generated_pdf_path: str, output_pdf_filename: str) -> str:
+    final_pdf_path = os.path.join(PDF_GENERATED_DIR, output_pdf_filename)
+    if generated_pdf_path != final_pdf_path:
+        if os.path.exists(final_pdf_path):
+            os.unlink(final_pdf_path)
+        os.rename(generated_pdf_path, final_pdf_path)
+    return final_pdf_path
+
+
+def _store_in_cache(cache_key: str, pdf_path: str) -> None:
+    if pdf_cache is not None:
+        pdf_cache.store(cache_key, pdf_path)
+
+
+def _fetch_from_cache(cache_key: str, output_pdf_filename: str) -> Optional[str]:
+    if pdf_cache is None:
+        return None
+    final_pdf_path = os.path.join(PDF_GENERATED_DIR, output_pdf_filename)
+    return final_pdf_path if pdf_cache.fetch(cache_key, final_pdf_path) else None
 
 
 def generate_personalized_pdf(
@@ -50,82 +160,256 @@ def generate_personalized_pdf(
     """
     Ersetzt Platzhalter in einer DOCX-Vorlage durch direkte XML-Manipulation
     und konvertiert sie dann mit LibreOffice zu PDF.
-    Gibt den Pfad zur generierten PDF-Datei zurück.
+    Gibt den Pfad zur generierten PDF-Datei zurück. Wurde dasselbe Dokument bereits
+    erzeugt, wird die PDF aus dem Cache übernommen.
     """
     if not os.path.exists(original_docx_path):
         raise FileNotFoundError(f"DOCX-Vorlage nicht gefunden: {original_docx_path}")
 
-    temp_input_docx_path = os.path.join(DOCX_TEMP_DIR, f'temp_input_{os.urandom(8).hex()}.docx')
-    temp_output_docx_path = os.path.join(DOCX_TEMP_DIR, f'temp_output_{os.urandom(8).hex()}.docx')
-    
+    compiled_template = get_compiled_template(original_docx_path)
+    cache_key = pdf_cache_key(compiled_template.digest, compiled_template.placeholders, data_row)
+    cached_pdf_path = _fetch_from_cache(cache_key, output_pdf_filename)
+    if cached_pdf_path:
+        return cached_pdf_path
+
+    temp_output_docx_path = _write_personalized_docx(original_docx_path, data_row)
+
+    try:
+        generated_pdf_path = _convert_docx_to_pdf(temp_output_docx_path, PDF_GENERATED_DIR)
+        final_pdf_path = _move_to_output(generated_pdf_path, output_pdf_filename)
+    except Exception as e:
+        raise _libreoffice_error(e)
+    finally:
+        if os.path.exists(temp_output_docx_path):
+            os.unlink(temp_output_docx_path)
+
+    _store_in_cache(cache_key, final_pdf_path)
+    return final_pdf_path
+
+
+def get_base_pdf(original_docx_path: str) -> bytes:
+    """
+    Liefert die Vorlage mit leeren Platzhaltern als PDF (Briefbogen). Wird pro Vorlage nur
+    einmal konvertiert (im Speicher und über den PDF-Cache auch über Neustarts hinweg).
+    """
+    compiled_template = get_compiled_template(original_docx_path)
+    with _base_pdf_lock:
+        base_pdf = _base_pdf_cache.get(compiled_template.digest)
+        if base_pdf is not None:
+            _base_pdf_cache.move_to_end(compiled_template.digest)
+            return base_pdf
+
+    blank_row = {placeholder: "" for placeholder in compiled_template.placeholders}
+    temp_filename = f".briefbogen_{compiled_template.digest[:16]}_{os.urandom(4).hex()}.pdf"
+    base_pdf_path = generate_personalized_pdf(original_docx_path, blank_row, temp_filename)
     try:
-        shutil.copy(original_docx_path, temp_input_docx_path)
-
-        with zipfile.ZipFile(temp_input_docx_path, 'r') as zin:
-            with zipfile.ZipFile(temp_output_docx_path, 'w', zipfile.ZIP_DEFLATED) as zout:
-                for item in zin.infolist():
-                    file_content = zin.read(item.filename)
-
-                    if item.filename == 'word/document.xml' or \
-                       item.filename.startswith('word/header') and item.filename.endswith('.xml') or \
-                       item.filename.startswith('word/footer') and item.filename.endswith('.xml'):
-                        
-                        modified_content = _manipulate_docx_xml_content(file_content, data_row)
-                        zout.writestr(item, modified_content)
+        with open(base_pdf_path, "rb") as f:
+            base_pdf = f.read()
+    finally:
+        os.unlink(base_pdf_path)
+
+    with _base_pdf_lock:
+        _base_pdf_cache[compiled_template.digest] = base_pdf
+        while len(_base_pdf_cache) > BASE_PDF_CACHE_SIZE:
+            _base_pdf_cache.popitem(last=False)
+    return base_pdf
+
+
+def generate_personalized_pdfs_batch(
+    original_docx_path: str,
+    jobs: List[Tuple[dict, str]],
+    chunk_size: Optional[int] = None,
+    workers: Optional[int] = None,
+    progress_callback: Optional[Callable[[int, Dict[str, Any]], None]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Erstellt PDFs für mehrere Datenzeilen. Die personalisierten DOCX-Dateien werden in Blöcken
+    von `chunk_size` Dokumenten mit jeweils einem LibreOffice-Aufruf konvertiert; bis zu `workers`
+    Blöcke werden parallel bearbeitet.
+    `jobs` enthält Paare aus (data_row, output_pdf_filename). Zurückgegeben wird pro Job, in
+    derselben Reihenfolge, ein Dict mit 'pdf_path' oder 'error' (Fehlermeldung für diese Zeile)
+    sowie 'cached', wenn die PDF nicht neu konvertiert werden musste (Cache oder identische Zeile).
+    `progress_callback(index, result)` wird für jede fertige Zeile aufgerufen, ggf. aus Worker-Threads.
+    """
+    if not os.path.exists(original_docx_path):
+        raise FileNotFoundError(f"DOCX-Vorlage nicht gefunden: {original_docx_path}")
+
+    chunk_size = max(1, chunk_size or LIBREOFFICE_BATCH_SIZE)
+    workers = max(1, workers or PDF_WORKERS)
+    results: List[Dict[str, Any]] = [{'pdf_path': None, 'error': None, 'cached': False} for _ in jobs]
+    pending: List[int] = []  # Job-Indizes, die konvertiert werden müssen
+    cache_keys: Dict[int, str] = {}
+    # Zeilen mit identischem Dokumentinhalt werden nur einmal konvertiert
+    first_index_for_key: Dict[str, int] = {}
+    duplicates: Dict[int, List[int]] = {}
+
+    def report(index: int) -> None:
+        if progress_callback is not None:
+            progress_callback(index, results[index])
+
+    try:
+        compiled_template = get_compiled_template(original_docx_path)
+    except Exception as e:
+        return [{'pdf_path': None, 'error': f"Fehler bei der DOCX-XML-Manipulation: {e}", 'cached': False} for _ in jobs]
+
+    for index, (data_row, output_pdf_filename) in enumerate(jobs):
+        cache_key = pdf_cache_key(compiled_template.digest, compiled_template.placeholders, data_row)
+        if cache_key in first_index_for_key:
+            duplicates[first_index_for_key[cache_key]].append(index)
+            continue
+        try:
+            cached_pdf_path = _fetch_from_cache(cache_key, output_pdf_filename)
+        except OSError as e:
+            results[index]['error'] = f"Fehler beim Übernehmen der PDF aus dem Cache: {e}"
+            report(index)
+            continue
+        if cached_pdf_path:
+            results[index].update({'pdf_path': cached_pdf_path, 'cached': True})
+            report(index)
+            continue
+        first_index_for_key[cache_key] = index
+        duplicates[index] = []
+        cache_keys[index] = cache_key
+        pending.append(index)
+
+    pool = get_conversion_pool(LIBREOFFICE_PATH)
+    if pool is not None:
+        # Mehr parallele Blöcke als LibreOffice-Instanzen würden nur auf einen freien Worker warten
+        workers = min(workers, pool.size)
+
+    def process_chunk(chunk_indices: List[int]) -> None:
+        # Jeder Block schreibt nur in die Ergebnis-Einträge seiner eigenen Zeilen
+        chunk: List[Tuple[int, str]] = []
+        try:
+            for index in chunk_indices:
+                try:
+                    chunk.append((index, _write_personalized_docx(original_docx_path, jobs[index][0])))
+                except Exception as e:
+                    results[index]['error'] = str(e)
+                    report(index)
+
+            chunk_error = None
+            if pool is None and chunk:
+                try:
+                    _run_libreoffice_convert([docx_path for _, docx_path in chunk], PDF_GENERATED_DIR)
+                except Exception as e:
+                    # Auch wenn der Aufruf insgesamt fehlschlägt, können einzelne PDFs erzeugt worden sein
+                    chunk_error = _libreoffice_error(e)
+
+            for index, docx_path in chunk:
+                try:
+                    if pool is not None:
+                        generated_pdf_path = pool.convert(docx_path, _pdf_path_for(docx_path, PDF_GENERATED_DIR))
                     else:
-                        zout.writestr(item, file_content)
-        
+                        generated_pdf_path = _pdf_path_for(docx_path, PDF_GENERATED_DIR)
+                        if not os.path.exists(generated_pdf_path):
+                            raise chunk_error or Exception(
+                                f"LibreOffice Konvertierung fehlgeschlagen: PDF-Datei '{generated_pdf_path}' nicht gefunden.")
+                    results[index]['pdf_path'] = _move_to_output(generated_pdf_path, jobs[index][1])
+                    _store_in_cache(cache_keys[index], results[index]['pdf_path'])
+                except Exception as e:
+                    results[index]['error'] = str(e if e is chunk_error else _libreoffice_error(e))
+                report(index)
+        finally:
+            for _, docx_path in chunk:
+                if os.path.exists(docx_path):
+                    os.unlink(docx_path)
+
+    # Blöcke so schneiden, dass alle Worker beschäftigt sind, auch wenn es nur wenige Zeilen gibt
+    effective_chunk_size = max(1, min(chunk_size, -(-len(pending) // workers)))
+    chunks = [pending[start:start + effective_chunk_size] for start in range(0, len(pending), effective_chunk_size)]
+    if workers == 1 or len(chunks) <= 1:
+        for chunk_indices in chunks:
+            process_chunk(chunk_indices)
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pdf-worker") as executor:
+            # list() wartet auf alle Blöcke und reicht unerwartete Fehler weiter
+            list(executor.map(process_chunk, chunks))
+
+    for index, duplicate_indices in duplicates.items():
+        for duplicate_index in duplicate_indices:
+            if results[index]['error']:
+                results[duplicate_index]['error'] = results[index]['error']
+            else:
+                try:
+                    final_pdf_path = os.path.join(PDF_GENERATED_DIR, jobs[duplicate_index][1])
+                    if final_pdf_path != results[index]['pdf_path']:
+                        shutil.copyfile(results[index]['pdf_path'], final_pdf_path)
+                    results[duplicate_index].update({'pdf_path': final_pdf_path, 'cached': True})
+                except OSError as e:
+                    results[duplicate_index]['error'] = f"Fehler beim Kopieren der PDF: {e}"
+            report(duplicate_index)
+
+    return results
+
+
+def generate_merged_pdfs_batch(
+    original_docx_path: str,
+    jobs: List[Tuple[dict, str]],
+    progress_callback: Optional[Callable[[int, Dict[str, Any]], None]] = None,
+    combined_pdf_filename: Optional[str] = None
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Sammeldokument-Modus: Alle Empfänger werden in ein einziges DOCX geschrieben (ein Abschnitt pro
+    Empfänger), mit einem LibreOffice-Aufruf konvertiert und die PDF danach wieder in Einzeldateien
+    aufgeteilt. Die Seitenzahl pro Empfänger ergibt sich aus dem Briefbogen der Vorlage.
+    Gibt die Ergebnisse im Format von generate_personalized_pdfs_batch sowie den Pfad der
+    Gesamt-PDF (für den Postversand) zurück.
+    Weicht die Seitenzahl ab, weil einzelne Empfänger mehr Seiten belegen, werden die Einzel-PDFs
+    stattdessen pro Zeile erzeugt; die Gesamt-PDF bleibt trotzdem erhalten.
+    """
+    if not os.path.exists(original_docx_path):
+        raise FileNotFoundError(f"DOCX-Vorlage nicht gefunden: {original_docx_path}")
+    if not jobs:
+        return [], None
+
+    pages_per_copy = len(PdfReader(BytesIO(get_base_pdf(original_docx_path))).pages)
+
+    merged_docx_path = os.path.join(DOCX_TEMP_DIR, f'serienbrief_{os.urandom(8).hex()}.docx')
+    try:
+        compiled_template = get_compiled_template(original_docx_path)
+        with open(merged_docx_path, 'wb') as f:
+            f.write(compiled_template.render_merged_docx([data_row for data_row, _ in jobs]))
     except Exception as e:
-        if os.path.exists(temp_input_docx_path): os.unlink(temp_input_docx_path)
-        if os.path.exists(temp_output_docx_path): os.unlink(temp_output_docx_path)
-        raise Exception(f"Fehler bei der DOCX-XML-Manipulation: {e}")
+        if os.path.exists(merged_docx_path): os.unlink(merged_docx_path)
+        raise Exception(f"Fehler beim Zusammenstellen des Sammeldokuments: {e}")
 
-    pdf_path = os.path.join(PDF_GENERATED_DIR, output_pdf_filename)
-    
-    libreoffice_command = [
-        LIBREOFFICE_PATH, # Verwendet jetzt die flexible Variable
-        "--headless",
-        "--convert-to", "pdf",
-        "--outdir", PDF_GENERATED_DIR,
-        temp_output_docx_path
-    ]
-    
     try:
-        # HINWEIS: Hier wird jetzt der try-Block um den subprocess.run herumgebaut,
-        # um den FileNotFoundError spezifisch abzufangen, wie in Ihrem Originalcode.
-        result = subprocess.run(libreoffice_command, capture_output=True, text=True, timeout=120)
-        
-        if result.returncode != 0:
-            # Hier geben wir eine detailliertere Fehlermeldung aus
-            error_details = result.stderr or result.stdout
-            raise Exception(f"LibreOffice Konvertierungsfehler ({result.returncode}): {error_details}")
-        
-        generated_pdf_filename_by_lo = os.path.basename(temp_output_docx_path).replace('.docx', '.pdf')
-        actual_pdf_path_from_lo = os.path.join(PDF_GENERATED_DIR, generated_pdf_filename_by_lo)
-
-        if not os.path.exists(actual_pdf_path_from_lo):
-            raise Exception(f"LibreOffice Konvertierung fehlgeschlagen: PDF-Datei '{actual_pdf_path_from_lo}' nicht gefunden.")
-        
-        final_pdf_path = os.path.join(PDF_GENERATED_DIR, output_pdf_filename)
-        if actual_pdf_path_from_lo != final_pdf_path:
-            if os.path.exists(final_pdf_path):
-                os.unlink(final_pdf_path)
-            os.rename(actual_pdf_path_from_lo, final_pdf_path)
-        else:
-            final_pdf_path = actual_pdf_path_from_lo
-
-        return final_pdf_path
-
-    except subprocess.TimeoutExpired:
-        raise Exception("LibreOffice Konvertierung hat zu lange gedauert und wurde abgebrochen (Timeout).")
-    except FileNotFoundError:
-        # Diese Fehlermeldung ist jetzt generischer und nicht mehr Windows-spezifisch.
-        raise Exception(f"LibreOffice-Programm nicht gefunden unter dem Pfad '{LIBREOFFICE_PATH}'. "
-                        "Bitte überprüfen Sie die Konfiguration (lokal in .env, in der Cloud im Code).")
+        generated_pdf_path = _convert_docx_to_pdf(merged_docx_path, PDF_GENERATED_DIR,
+                                                  LIBREOFFICE_TIMEOUT + MERGED_TIMEOUT_PER_COPY * len(jobs))
+        combined_pdf_path = _move_to_output(
+            generated_pdf_path, combined_pdf_filename or f"Serienbrief_gesamt_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.pdf")
     except Exception as e:
-        raise Exception(f"Fehler bei LibreOffice-Aufruf: {e}")
+        raise _libreoffice_error(e)
     finally:
-        if os.path.exists(temp_input_docx_path):
-            os.unlink(temp_input_docx_path)
-        if os.path.exists(temp_output_docx_path):
-            os.unlink(temp_output_docx_path)
\ No newline at end of file
+        if os.path.exists(merged_docx_path):
+            os.unlink(merged_docx_path)
+
+    combined_pdf = PdfReader(combined_pdf_path)
+    if len(combined_pdf.pages) != pages_per_copy * len(jobs):
+        print(f"WARNUNG (pdf_generator.py): Sammeldokument hat {len(combined_pdf.pages)} Seiten, erwartet waren "
+              f"{pages_per_copy * len(jobs)}. Einzel-PDFs werden pro Zeile erzeugt.")
+        return generate_personalized_pdfs_batch(original_docx_path, jobs, progress_callback=progress_callback), combined_pdf_path
+
+    results: List[Dict[str, Any]] = []
+    for index, (_, output_pdf_filename) in enumerate(jobs):
+        result = {'pdf_path': None, 'error': None, 'cached': False}
+        try:
+            writer = PdfWriter()
+            for page_number in range(index * pages_per_copy, (index + 1) * pages_per_copy):
+                writer.add_page(combined_pdf.pages[page_number])
+            final_pdf_path = os.path.join(PDF_GENERATED_DIR, output_pdf_filename)
+            with open(final_pdf_path, 'wb') as f:
+                writer.write(f)
+            result['pdf_path'] = final_pdf_path
+        except Exception as e:
+            result['error'] = f"Fehler beim Aufteilen des Sammeldokuments: {e}"
+        results.append(result)
+        if progress_callback is not None:
+            progress_callback(index, result)
+    return results, combined_pdf_path
+
+
+def get_pdf_cache_stats() -> Dict[str, float]:
+    """Trefferzahlen des PDF-Caches seit dem Start des Prozesses."""
+    return pdf_cache.stats() if pdf_cache is not None else {}
@@ -0,0 +1,112 @@
+import os
+from io import BytesIO
+from typing import List, Tuple, Dict, Any, Optional, Callable
+from pypdf import PdfReader, PdfWriter
+from reportlab.pdfgen import canvas
+from reportlab.lib.units import mm
+
+from helpers import compile_placeholders
+from pdf_generator import get_base_pdf, PDF_GENERATED_DIR
+
+# Schnellmodus: Die Vorlage wird einmal (mit leeren Platzhaltern) als Briefbogen nach PDF konvertiert,
+# danach werden die Werte jedes Empfängers mit ReportLab direkt auf eine Kopie gestempelt.
+
+DEFAULT_FONT = "Helvetica"
+BOLD_FONT = "Helvetica-Bold"
+
+
+def parse_overlay_fields(definition: str) -> List[Dict[str, Any]]:
+    """
+    Liest die Feld-Positionen, eine Zeile pro Feld:
+        Text; Seite; X in mm; Y in mm [; Schriftgröße [; fett]]
+    X und Y werden von der linken oberen Ecke der Seite gemessen, der Text darf Platzhalter
+    enthalten, z.B. "${Vorname} ${Name}; 1; 25; 52; 11".
+    """
+    fields = []
+    for line_number, raw_line in enumerate((definition or "").splitlines(), start=1):
+        line = raw_line.strip()
+        if not line or line.startswith("#"):
+            continue
+        parts = [part.strip() for part in line.split(";")]
+        if len(parts) < 4:
+            raise ValueError(f"Feld-Position Zeile {line_number}: Erwartet 'Text; Seite; X; Y', gefunden '{line}'.")
+        try:
+            field = {
+                "text": parts[0],
+                "page": int(parts[1]),
+                "x_mm": float(parts[2].replace(",", ".")),
+                "y_mm": float(parts[3].replace(",", ".")),
+                "font_size": float(parts[4].replace(",", ".")) if len(parts) > 4 and parts[4] else 11.0,
+                "bold": len(parts) > 5 and parts[5].lower() in ("fett", "bold", "b", "ja"),
+            }
+        except ValueError:
+            raise ValueError(f"Feld-Position Zeile {line_number}: Seite, X, Y und Schriftgröße müssen Zahlen sein.")
+        if field["page"] < 1:
+            raise ValueError(f"Feld-Position Zeile {line_number}: Die Seitenzahl beginnt bei 1.")
+        fields.append(field)
+    if not fields:
+        raise ValueError("Für den Schnellmodus muss mindestens eine Feld-Position angegeben werden.")
+    return fields
+
+
+def _build_overlay(page_sizes: List[Tuple[float, float]], fields: List[Dict[str, Any]], data_row: dict) -> PdfReader:
+    """Zeichnet die Werte einer Datenzeile auf transparente Seiten in der Größe des Briefbogens."""
+    buffer = BytesIO()
+    overlay = canvas.Canvas(buffer, pagesize=page_sizes[0])
+    for page_index, (width, height) in enumerate(page_sizes):
+        overlay.setPageSize((width, height))
+        for field in fields:
+            if field["page"] != page_index + 1:
+                continue
+            text = compile_placeholders(field["text"]).render(data_row)
+            overlay.setFont(BOLD_FONT if field["bold"] else DEFAULT_FONT, field["font_size"])
+            overlay.drawString(field["x_mm"] * mm, height - field["y_mm"] * mm, text)
+        overlay.showPage()
+    overlay.save()
+    buffer.seek(0)
+    return PdfReader(buffer)
+
+
+def render_overlay_pdf(base_pdf: bytes, fields: List[Dict[str, Any]], data_row: dict, output_pdf_path: str) -> str:
+    writer = PdfWriter(clone_from=PdfReader(BytesIO(base_pdf)))
+    page_sizes = [(float(page.mediabox.width), float(page.mediabox.height)) for page in writer.pages]
+    overlay = _build_overlay(page_sizes, fields, data_row)
+    used_pages = {field["page"] - 1 for field in fields}
+    for page_index, page in enumerate(writer.pages):
+        if page_index in used_pages:
+            page.merge_page(overlay.pages[page_index])
+    with open(output_pdf_path, "wb") as f:
+        writer.write(f)
+    return output_pdf_path
+
+
+def generate_overlay_pdfs_batch(
+    original_docx_path: str,
+    jobs: List[Tuple[dict, str]],
+    fields: List[Dict[str, Any]],
+    progress_callback: Optional[Callable[[int, Dict[str, Any]], None]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Gegenstück zu pdf_generator.generate_personalized_pdfs_batch für den Schnellmodus,
+    mit gleichem Ergebnisformat (pro Job 'pdf_path' oder 'error', in Eingabereihenfolge).
+    """
+    if not os.path.exists(original_docx_path):
+        raise FileNotFoundError(f"DOCX-Vorlage nicht gefunden: {original_docx_path}")
+
+    base_pdf = get_base_pdf(original_docx_path)
+    page_count = len(PdfReader(BytesIO(base_pdf)).pages)
+    for field in fields:
+        if field["page"] > page_count:
+            raise ValueError(f"Feld '{field['text']}' liegt auf Seite {field['page']}, der Briefbogen hat nur {page_count} Seite(n).")
+
+    results: List[Dict[str, Any]] = []
+    for index, (data_row, output_pdf_filename) in enumerate(jobs):
+        result = {'pdf_path': None, 'error': None, 'cached': False}
+        try:
+            result['pdf_path'] = render_overlay_pdf(base_pdf, fields, data_row, os.path.join(PDF_GENERATED_DIR, output_pdf_filename))
+        except Exception as e:
+            result['error'] = f"Fehler beim Stempeln der PDF: {e}"
+        results.append(result)
+        if progress_callback is not None:
+            progress_callback(index, result)
+    return results
@@ -0,0 +1,121 @@
+import os
+import time
+import asyncio
+import smtplib
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- Anpassung der Senderate (über Umgebungsvariablen steuerbar) ---
+# Antwortcodes, mit denen Anbieter (z. B. Office 365, IONOS) zu schnelles Senden abweisen
+SMTP_THROTTLE_CODES = {421, 451}
+# Untergrenze der Senderate nach wiederholter Drosselung (E-Mails pro Minute)
+SMTP_RATE_MIN_PER_MINUTE = float(os.environ.get("SMTP_RATE_MIN_PER_MINUTE", "6"))
+# Bei Drosselung wird die Rate mit diesem Faktor multipliziert ...
+SMTP_RATE_DECREASE_FACTOR = float(os.environ.get("SMTP_RATE_DECREASE_FACTOR", "0.5"))
+# ... und steigt danach bei erfolgreichem Versand pro Minute um diesen Anteil der Ausgangsrate wieder an
+SMTP_RATE_RECOVERY_PER_MINUTE = float(os.environ.get("SMTP_RATE_RECOVERY_PER_MINUTE", "0.1"))
+# Mehrere gleichzeitig laufende Verbindungen melden eine Drosselung meist fast gleichzeitig: nur einmal reagieren
+SMTP_RATE_COOLDOWN_SECONDS = float(os.environ.get("SMTP_RATE_COOLDOWN_SECONDS", "5"))
+
+
+def is_throttling_error(error: Exception) -> bool:
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code in SMTP_THROTTLE_CODES
+
+
+class AdaptiveRateLimiter:
+    """
+    Token-Bucket für ein SMTP-Konto, dessen Rate sich an die Antworten des Servers anpasst (AIMD):
+    bei 421/451 wird die Rate halbiert, nach erfolgreichem Versand steigt sie langsam wieder bis zum
+    eingestellten Höchstwert. Ohne Höchstwert wird erst nach der ersten Drosselung begrenzt.
+    """
+
+    def __init__(self, max_per_minute: Optional[float] = None):
+        self.max_per_minute = max_per_minute
+        self.rate = max_per_minute # aktuelle Rate in E-Mails pro Minute, None = unbegrenzt
+        self.reference_rate = max_per_minute # Bezugsgröße für den Wiederanstieg
+        self.throttle_count = 0
+        self.tokens = 1.0
+        self._refilled_at = time.monotonic()
+        self._adjusted_at = time.monotonic()
+        self._last_decrease = 0.0
+        self._recent_successes: deque = deque()
+        self._lock = asyncio.Lock()
+
+    def configure(self, max_per_minute: Optional[float]) -> None:
+        """Übernimmt einen geänderten Höchstwert aus den SMTP-Einstellungen."""
+        if max_per_minute == self.max_per_minute:
+            return
+        self.max_per_minute = max_per_minute
+        if max_per_minute is not None and (self.rate is None or self.rate > max_per_minute):
+            self.rate = max_per_minute
+        self.reference_rate = max_per_minute or self.reference_rate
+
+    def _refill(self, now: float) -> None:
+        if self.rate is not None:
+            # Höchstens eine Sekunde Vorrat: gleichmäßiger Versand statt kurzer Schübe
+            capacity = max(1.0, self.rate / 60)
+            self.tokens = min(capacity, self.tokens + (now - self._refilled_at) * self.rate / 60)
+        self._refilled_at = now
+
+    async def acquire(self) -> None:
+        """Wartet, bis die nächste E-Mail gesendet werden darf."""
+        async with self._lock:
+            while True:
+                self._refill(time.monotonic())
+                if self.rate is None:
+                    return
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) * 60 / self.rate)
+
+    def observed_rate(self, now: float) -> float:
+        while self._recent_successes and now - self._recent_successes[0] > 60:
+            self._recent_successes.popleft()
+        return float(len(self._recent_successes))
+
+    def succeeded(self) -> None:
+        now = time.monotonic()
+        self._recent_successes.append(now)
+        if self.rate is not None and self.reference_rate:
+            self.rate += self.reference_rate * SMTP_RATE_RECOVERY_PER_MINUTE * (now - self._adjusted_at) / 60
+            if self.max_per_minute is not None:
+                self.rate = min(self.rate, self.max_per_minute)
+        self._adjusted_at = now
+
+    def throttled(self) -> None:
+        now = time.monotonic()
+        self._adjusted_at = now
+        if now - self._last_decrease < SMTP_RATE_COOLDOWN_SECONDS:
+            return
+        self._last_decrease = now
+        self.throttle_count += 1
+        current_rate = self.rate if self.rate is not None else self.observed_rate(now)
+        if self.max_per_minute is None:
+            self.reference_rate = max(current_rate, SMTP_RATE_MIN_PER_MINUTE)
+        self.rate = max(SMTP_RATE_MIN_PER_MINUTE, current_rate * SMTP_RATE_DECREASE_FACTOR)
+        self.tokens = 0.0
+
+    def record(self, error: Optional[Exception]) -> None:
+        if error is None:
+            self.succeeded()
+        elif is_throttling_error(error):
+            self.throttled()
+
+
+# Ein Limiter pro SMTP-Konto, damit sich gleichzeitige Versandvorgänge desselben Kontos die Rate teilen
+_limiters: Dict[Tuple[str, str], AdaptiveRateLimiter] = {}
+
+
+def rate_limiter_for(smtp_settings: Dict[str, Any]) -> AdaptiveRateLimiter:
+    key = (smtp_settings["host"].lower(), smtp_settings["user"].lower())
+    max_per_minute = smtp_settings.get("rate_limit_per_minute") or None
+    limiter = _limiters.get(key)
+    if limiter is None:
+        limiter = _limiters[key] = AdaptiveRateLimiter(max_per_minute)
+    else:
+        limiter.configure(max_per_minute)
+    return limiter
@@ -77,7 +77,8 @@ async def post_2fa_verify(request: Request, code: str = Form(...), db: Session =
     request.session["user_id"] = user.id
     request.session["username"] = user.username
     if smtp_settings := get_smtp_settings(db, user.id):
-        test_result = await test_smtp_connection_internal(test_recipient_email=user.email, send_test_email=False, **smtp_settings)
+        connection_settings = {key: smtp_settings[key] for key in ('host', 'user', 'password', 'port', 'secure')}
+        test_result = await test_smtp_connection_internal(test_recipient_email=user.email, send_test_email=False, **connection_settings)
         request.session["smtp_test_status"] = test_result["status"]
     db.delete(token_entry); db.commit()
     return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
@@ -1,23 +1,32 @@
 import os
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 import traceback
 import shutil
-import zipfile
 
 from fastapi import APIRouter, Request, Form, File, UploadFile, Depends, status, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse
-from starlette.background import BackgroundTask
+from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.orm import Session
 
 # Importiere lokale Module
-from database import SessionLocal, ProcessLogEntry, GeneratedFile
-from helpers import clean_for_json, replace_docx_placeholders_in_text, replace_html_placeholders_in_text
-from excel_processor import handle_excel_upload, read_excel_header, filter_excel_data, read_all_excel_data
-from pdf_generator import generate_personalized_pdf, PDF_GENERATED_DIR, DOCX_TEMP_DIR
-from email_sender import send_personalized_emails
+from database import SessionLocal, ProcessLogEntry, BackgroundJob
+from helpers import compile_placeholders
+from excel_processor import handle_excel_upload, read_excel_header, load_dataset, query_excel_row_ids, distinct_column_values
+from dataset_cache import DatasetRows
+from dataset_query import FILTER_OPERATORS, DEFAULT_PAGE_SIZE, parse_conditions, describe_conditions, paginate_rows
+from pdf_generator import generate_personalized_pdfs_batch, generate_merged_pdfs_batch, PDF_GENERATED_DIR, DOCX_TEMP_DIR, PDF_WORKERS, get_pdf_cache_stats
+from pdf_overlay import generate_overlay_pdfs_batch, parse_overlay_fields
+from docx_template import get_compiled_template
+from email_sender import send_queued_emails
+from mime_builder import html_to_plain_text
+from mail_queue import enqueue_mailing, idempotency_key, queue_counts, interrupted_processes
 from settings_manager import get_smtp_settings
+from job_manager import JobProgress, create_job, start_job, get_job, job_status, take_job_result, job_process_log
+from utils.zip_utils import stream_zip_files
+from artifact_store import job_output_dir, job_output_subdir, quota_error_message, user_usage_bytes, ARTIFACT_USER_QUOTA_MB
+from mailing_store import MailingState, load_mailing, discard_mailing, clear_review, store_review, review_count, review_page, review_recipients
 
 # Importiere Abhängigkeiten und gemeinsame Objekte aus anderen Modulen
 from routers.auth import get_current_user_id
@@ -34,32 +43,109 @@ def get_db():
 
 
 UPLOAD_DIR = "user_uploads"
-
-def cleanup_session_after_process(session):
+# PDFs sind bereits komprimiert; im ZIP-Download werden sie daher standardmäßig unverändert abgelegt
+ZIP_DOWNLOAD_COMPRESS = os.environ.get("ZIP_DOWNLOAD_COMPRESS", "0") in ("1", "true", "True")
+
+# Vorgangsdaten früherer Versionen, die noch direkt in der Session (Cookie) lagen
+LEGACY_SESSION_KEYS = [
+    'excel_file_path', 'excel_file_original_name', 'filteredData',
+    'isFiltered', 'filter_column', 'filter_value', 'filter_conditions', 'filter_combine', 'active_word_template',
+    'email_body', 'pdf_filename_format', 'email_subject', 'email_column',
+    'reviewFiles', 'from_name', 'no_attachment', 'isDetailsConfirmed',
+    'render_mode', 'overlay_fields', 'combinedPdfWebPath'
+]
+
+def cleanup_mailing_after_process(db: Session, mailing: MailingState):
     keys_to_unset = [
-        'filteredData', 'isFiltered', 'filter_column', 'filter_value',
-        'active_word_template', 'reviewFiles', 'no_attachment', 'isDetailsConfirmed'
+        'isFiltered', 'filter_column', 'filter_value', 'filter_conditions', 'filter_combine',
+        'active_word_template', 'no_attachment', 'isDetailsConfirmed'
     ]
     for key in keys_to_unset:
-        if key in session:
-            del session[key]
+        mailing.pop(key)
+    mailing.set_filtered_row_ids(None)
+    clear_review(db, mailing)
+
+def enqueue_review_recipients(user_id: int, mailing_id: int, review_id: str, excel_file_path: str,
+                              process_info: Dict[str, Any], recipients: List[Dict[str, Any]]) -> Tuple[Optional[int], Optional[int], bool]:
+    """
+    Personalisiert die E-Mail-Texte der ausgewählten Vorschau-Einträge, reiht sie in die Ausgangs-Warteschlange ein
+    und legt den Versand-Job an (läuft in einem Thread, daher mit eigener Datenbank-Session).
+    Gibt (Job-ID, Vorgangs-ID, neu angelegt) zurück; waren alle Einträge schon eingereiht, die des bestehenden Versands.
+    """
+    dataset = load_dataset(excel_file_path)
+    email_body_template = process_info['email_body_template']
+    # Die Text-Alternative wird einmal aus der Vorlage abgeleitet und dann nur noch personalisiert
+    html_body_template = compile_placeholders(email_body_template)
+    plain_body_template = compile_placeholders(html_to_plain_text(email_body_template))
+    items_to_send = []
+    for recipient in recipients:
+        data_row = dataset.row(recipient['row_id'])
+        items_to_send.append({
+            'idempotency_key': idempotency_key(mailing_id, review_id, recipient['id']), 'pdf_path': recipient['pdf_path'],
+            'recipient_email': recipient['recipient_email'], 'recipient_name': recipient['recipient_name'],
+            'subject': recipient['subject'],
+            'body': html_body_template.render_html(data_row),
+            'body_text': plain_body_template.render(data_row)
+        })
+    db = SessionLocal()
+    try:
+        # Jede E-Mail wird als Eintrag der Ausgangs-Warteschlange gespeichert, bevor der Versand beginnt
+        process, created = enqueue_mailing(db, user_id, process_info, items_to_send)
+        if process is None:
+            return None, None, False
+        if not created:
+            return process.job_id, process.id, False
+        job = create_job(db, user_id, 'send', process.total_recipients)
+        process.job_id = job.id
+        db.commit()
+        return job.id, process.id, True
+    finally:
+        db.close()
+
+def unknown_placeholder_hints(settings: Dict[str, Any]) -> List[str]:
+    """
+    Hinweise auf Platzhalter, zu denen es keine Spalte in der Tabelle gibt (sie blieben unverändert im Text stehen).
+    Kompiliert dabei Betreff, Text, Dateiname und Word-Vorlage bereits vorab.
+    """
+    excel_file_path = settings.get('excel_file_path')
+    if not excel_file_path or not os.path.exists(excel_file_path):
+        return []
+    header = read_excel_header(excel_file_path)
+    texts = [('im Betreff', settings.get('email_subject')), ('im E-Mail-Text', settings.get('email_body'))]
+    if not settings.get('no_attachment'):
+        texts.append(('im PDF-Dateinamen', settings.get('pdf_filename_format')))
+        if settings.get('render_mode') == 'overlay':
+            texts.append(('in den Feld-Positionen', settings.get('overlay_fields')))
+    hints = []
+    for label, text in texts:
+        unknown = compile_placeholders(text or '').unknown_placeholders(header)
+        if unknown:
+            hints.append((label, unknown))
+    active_word_template = settings.get('active_word_template')
+    if not settings.get('no_attachment') and active_word_template and settings.get('render_mode') != 'overlay':
+        try:
+            unknown = sorted(get_compiled_template(active_word_template).placeholders - set(header))
+        except Exception as e:
+            print(f"WARNUNG (main_app.py): Platzhalter der Vorlage '{active_word_template}' konnten nicht geprüft werden: {e}")
+            unknown = []
+        if unknown:
+            hints.append(('in der Word-Vorlage', unknown))
+    return [f"Hinweis: Unbekannte Platzhalter {label}: {', '.join(f'${{{name}}}' for name in unknown)}. "
+            f"Es gibt keine gleichnamige Spalte, sie bleiben unverändert stehen." for label, unknown in hints]
 
 @router.get("/reset_process", response_class=RedirectResponse)
-async def reset_process(request: Request, current_user_id: int = Depends(get_current_user_id)):
+async def reset_process(request: Request, current_user_id: int = Depends(get_current_user_id), db: Session = Depends(get_db)):
     session_data = request.session
-    if 'excel_file_path' in session_data and session_data.get('excel_file_path') and os.path.exists(session_data['excel_file_path']):
+    mailing = load_mailing(db, session_data, current_user_id)
+    excel_file_path = mailing.get('excel_file_path')
+    if excel_file_path and os.path.exists(excel_file_path):
         try:
-            os.unlink(session_data['excel_file_path'])
+            os.unlink(excel_file_path)
         except OSError as e:
-            print(f"Error deleting file {session_data['excel_file_path']}: {e}")
+            print(f"Error deleting file {excel_file_path}: {e}")
+    discard_mailing(db, session_data, mailing)
 
-    keys_to_unset = [
-        'excel_file_path', 'excel_file_original_name', 'filteredData',
-        'isFiltered', 'filter_column', 'filter_value', 'active_word_template',
-        'email_body', 'pdf_filename_format', 'email_subject', 'email_column',
-        'reviewFiles', 'from_name', 'no_attachment', 'isDetailsConfirmed'
-    ]
-    for key in keys_to_unset:
+    for key in LEGACY_SESSION_KEYS:
         if key in session_data:
             del session_data[key]
     return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
@@ -67,20 +153,21 @@ async def reset_process(request: Request, current_user_id: int = Depends(get_cur
 @router.get("/", response_class=HTMLResponse)
 async def read_root(request: Request, db: Session = Depends(get_db), current_user_id: int = Depends(get_current_user_id)):
     session_data = request.session
+    mailing = load_mailing(db, session_data, current_user_id)
 
-    excel_file_path = session_data.get('excel_file_path')
-    active_word_template = session_data.get('active_word_template', '')
-    no_attachment = session_data.get('no_attachment', False)
-    is_filtered = session_data.get('isFiltered', False)
+    excel_file_path = mailing.get('excel_file_path')
+    active_word_template = mailing.get('active_word_template', '')
+    no_attachment = mailing.get('no_attachment', False)
+    is_filtered = mailing.get('isFiltered', False)
 
     header = []
     if excel_file_path and os.path.exists(excel_file_path):
         try:
-            header = read_excel_header(excel_file_path)
+            header = await run_in_threadpool(read_excel_header, excel_file_path)
         except Exception as e:
             session_data["fatalError"] = f"Kritischer Fehler beim Lesen der Kopfzeile der Excel-Datei: {e}"
 
-    pdf_filename_format = session_data.get('pdf_filename_format')
+    pdf_filename_format = mailing.get('pdf_filename_format')
     if pdf_filename_format is None:
         if header:
             preferred_name_columns = ["Nummer", "Kundennummer", "ID", "Name", "Nachname", "Vorname"]
@@ -98,45 +185,311 @@ async def read_root(request: Request, db: Session = Depends(get_db), current_use
         else:
             pdf_filename_format = "Dokument.pdf"
 
-    is_details_confirmed = session_data.get('isDetailsConfirmed', False)
+    is_details_confirmed = mailing.get('isDetailsConfirmed', False)
     isReadyForStep4 = is_filtered and is_details_confirmed
 
     current_step = 'upload_excel'
-    if session_data.get('reviewFiles') is not None: # Check if key exists, even with empty list
+    if mailing.get('reviewReady'): # Vorschau erstellt, auch wenn sie leer ist
         current_step = 'review'
     elif excel_file_path:
         current_step = 'main_form'
 
+    filter_conditions = mailing.get('filter_conditions') or [{'column': '', 'operator': 'eq', 'value': '', 'value2': ''}]
+
+    process_log = session_data.pop("processLog", [])
+    log_job_id = session_data.pop("processLogJobId", None)
+    if log_job_id is not None:
+        log_job = get_job(db, log_job_id, current_user_id)
+        if log_job is not None:
+            process_log = job_process_log(log_job)
+
     context = {
         "request": request,
         "username": session_data.get("username", "Gast"),
         "fatalError": session_data.pop("fatalError", None),
-        "processLog": session_data.pop("processLog", []),
+        "processLog": process_log,
         "uploadError": session_data.pop("uploadError", None),
         "excelFilePath": excel_file_path,
-        "originalExcelFilename": session_data.get('excel_file_original_name', 'Keine Datei ausgewählt'),
+        "originalExcelFilename": mailing.get('excel_file_original_name', 'Keine Datei ausgewählt'),
         "activeWordTemplate": active_word_template,
         "displayedWordTemplateName": os.path.basename(active_word_template) if active_word_template else "",
-        "emailBody": session_data.get('email_body', '<p>Sehr geehrte/r ${Anrede} ${Name},</p><p>anbei erhalten Sie Ihr Dokument.</p>'),
+        "emailBody": mailing.get('email_body', '<p>Sehr geehrte/r ${Anrede} ${Name},</p><p>anbei erhalten Sie Ihr Dokument.</p>'),
         "pdfFilenameFormat": pdf_filename_format,
-        "emailSubject": session_data.get('email_subject', 'Ihr Dokument'),
-        "fromName": session_data.get('from_name', ''),
-        "emailColumn": session_data.get('email_column', ''),
-        "selectedColumnName": session_data.get('filter_column', ''),
-        "filterValue": session_data.get('filter_value', ''),
+        "emailSubject": mailing.get('email_subject', 'Ihr Dokument'),
+        "fromName": mailing.get('from_name', ''),
+        "emailColumn": mailing.get('email_column', ''),
+        "selectedColumnName": mailing.get('filter_column', ''),
+        "filterValue": mailing.get('filter_value', ''),
+        "filterConditions": filter_conditions,
+        "filterCombine": mailing.get('filter_combine', 'and'),
+        "filterOperators": FILTER_OPERATORS,
         "isFiltered": is_filtered,
         "isDetailsConfirmed": is_details_confirmed,
         "isReadyForStep4": isReadyForStep4,
-        "filteredData": session_data.get('filteredData', []),
+        # Die Zeilen selbst lädt die Seite seitenweise über /api/preview bzw. /api/review
+        "filteredCount": len(mailing.filtered_row_ids or []),
         "header": header,
-        "reviewFiles": session_data.get('reviewFiles', []),
+        "reviewCount": review_count(db, mailing),
+        "pageSize": DEFAULT_PAGE_SIZE,
+        "combinedPdfWebPath": mailing.get('combinedPdfWebPath'),
         "currentStep": current_step,
         "isSmtpConfiguredOk": session_data.get("smtp_test_status") == 'success',
-        "no_attachment": no_attachment
+        "no_attachment": no_attachment,
+        "renderMode": mailing.get('render_mode', 'docx'),
+        "overlayFields": mailing.get('overlay_fields', '')
     }
     return templates.TemplateResponse("index.html", context)
 
 
+async def run_generation_job(user_id: int, mailing_id: int, row_ids: List[int], settings: Dict[str, Any], progress: JobProgress) -> Dict[str, Any]:
+    """
+    Erzeugt PDFs und Vorschau-Einträge für die gefilterten Datensätze (läuft als Hintergrund-Job).
+    Die PDFs landen im eigenen Verzeichnis des Jobs (generated_pdfs/<user_id>/<job_id>/), die Vorschau-Einträge
+    werden direkt am Vorgang gespeichert. Gibt das Protokoll für die Session zurück.
+    """
+    dataset = await run_in_threadpool(load_dataset, settings.get('excel_file_path'))
+    filtered_data = DatasetRows(dataset, row_ids)
+    review_files = []
+    generation_log = []
+    total_rows = len(filtered_data)
+    no_attachment_mode = settings.get('no_attachment') or False
+
+    def report_pdf_progress(index: int, result: Dict[str, Any]) -> None:
+        if result.get('error'):
+            progress.advance(1, f"FEHLER in Zeile {index + 2}: {result['error']}")
+        else:
+            progress.advance(1, f"[{progress.processed + 1}/{total_rows}] {os.path.basename(result['pdf_path'])} erstellt.")
+
+    # PDFs werden gesammelt erzeugt, damit LibreOffice mehrere Dokumente pro Aufruf konvertiert
+    pdf_results = [{'pdf_path': None, 'error': None} for _ in filtered_data]
+    combined_pdf_path = None
+    if not no_attachment_mode:
+        filename_template = compile_placeholders(settings.get('pdf_filename_format') or 'Dokument.pdf')
+        job_output_dir(user_id, progress.job_id)
+        output_subdir = job_output_subdir(user_id, progress.job_id)
+        pdf_jobs = []
+        for index, row_data in enumerate(filtered_data):
+            # Platzhalter im Dateinamen ersetzen
+            output_filename_raw = filename_template.render(row_data)
+            # Dateinamen für das Dateisystem sicher machen
+            output_filename_safe = "".join(c for c in output_filename_raw if c.isalnum() or c in ['-', '_', '.']).strip()
+            if not output_filename_safe:
+                output_filename_safe = f"dokument_{index+1}.pdf"
+            pdf_jobs.append((row_data, f"{output_subdir}/{output_filename_safe}"))
+        try:
+            # Läuft in einem Thread, damit die Generierung andere Anfragen nicht blockiert
+            if settings.get('render_mode') == 'overlay':
+                # Schnellmodus: Vorlage nur einmal konvertieren, Werte direkt auf die PDF stempeln
+                pdf_results = await run_in_threadpool(
+                    generate_overlay_pdfs_batch,
+                    original_docx_path=settings.get('active_word_template'),
+                    jobs=pdf_jobs,
+                    fields=parse_overlay_fields(settings.get('overlay_fields') or ''),
+                    progress_callback=report_pdf_progress
+                )
+            elif settings.get('render_mode') == 'merged':
+                # Sammeldokument: eine Konvertierung für alle Empfänger, danach Aufteilung in Einzel-PDFs
+                pdf_results, combined_pdf_path = await run_in_threadpool(
+                    generate_merged_pdfs_batch,
+                    original_docx_path=settings.get('active_word_template'),
+                    jobs=pdf_jobs,
+                    progress_callback=report_pdf_progress,
+                    combined_pdf_filename=f"{output_subdir}/Serienbrief_gesamt_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.pdf"
+                )
+            else:
+                pdf_results = await run_in_threadpool(
+                    generate_personalized_pdfs_batch,
+                    original_docx_path=settings.get('active_word_template'),
+                    jobs=pdf_jobs,
+                    workers=PDF_WORKERS,
+                    progress_callback=report_pdf_progress
+                )
+        except Exception as e:
+            pdf_results = [{'pdf_path': None, 'error': str(e)} for _ in filtered_data]
+    else:
+        progress.advance(total_rows, "Vorschau ohne PDF-Anhänge erstellt.")
+
+    subject_template = compile_placeholders(settings.get('email_subject') or '')
+    for index, row_data in enumerate(filtered_data):
+        try:
+            pdf_path, pdf_web_path = None, None
+            if not no_attachment_mode:
+                if pdf_results[index]['error']:
+                    raise Exception(pdf_results[index]['error'])
+                pdf_path = pdf_results[index]['pdf_path']
+                pdf_web_path = f"/{PDF_GENERATED_DIR}/{os.path.relpath(pdf_path, PDF_GENERATED_DIR)}"
+
+            recipient_email = row_data.get(settings.get('email_column') or '', 'N/A')
+            review_files.append({
+                'row_id': row_ids[index],
+                'pdf_path': pdf_path, 'pdf_web_path': pdf_web_path,
+                'recipient_email': str(recipient_email) if recipient_email is not None else '',
+                'recipient_name': f"{row_data.get('Vorname', '') or ''} {row_data.get('Name', '') or ''}".strip() or f'Empfänger {index+1}',
+                'subject': subject_template.render(row_data)
+            })
+        except Exception as e:
+            # Wenn eine Zeile fehlschlägt, wird dies protokolliert und die Schleife fortgesetzt
+            error_recipient = row_data.get(settings.get('email_column') or '', f'Unbekannt in Zeile {index + 2}')
+            generation_log.append({'status': 'error', 'message': f"Fehler bei Erstellung für '{error_recipient}': {e}"})
+            continue
+
+    success_count = len(review_files)
+    if success_count > 0:
+        generation_log.insert(0, {'status': 'success', 'message': f"{success_count} von {total_rows} E-Mails erfolgreich zur Vorschau erstellt."})
+
+    cached_count = sum(1 for result in pdf_results if result.get('cached'))
+    if cached_count > 0:
+        generation_log.append({'status': 'info', 'message': f"{cached_count} PDF(s) unverändert aus früheren Durchläufen übernommen (ohne erneute Konvertierung)."})
+
+    if combined_pdf_path:
+        generation_log.append({'status': 'info', 'message': f"Gesamt-PDF für den Postversand erstellt: {os.path.basename(combined_pdf_path)}"})
+
+    error_count = total_rows - success_count
+    if error_count > 0:
+        generation_log.append({'status': 'info', 'message': f"WICHTIG: {error_count} E-Mail(s) konnten wegen Fehlern nicht erstellt werden (Details siehe oben)."})
+
+    if not generation_log:
+         generation_log.append({'status': 'info', 'message': 'Keine Daten zum Verarbeiten gefunden.'})
+
+    combined_pdf_web_path = f"/{PDF_GENERATED_DIR}/{os.path.relpath(combined_pdf_path, PDF_GENERATED_DIR)}" if combined_pdf_path else None
+    await run_in_threadpool(store_review, mailing_id, review_files, combined_pdf_web_path, settings.get('email_body') or '')
+    return {
+        'processLog': generation_log,
+        'summary': f"{success_count} von {total_rows} E-Mails zur Vorschau erstellt."
+    }
+
+
+async def run_sending_job(user_id: int, process_id: int, progress: JobProgress) -> Dict[str, Any]:
+    """
+    Arbeitet die Ausgangs-Warteschlange eines Vorgangs ab (läuft als Hintergrund-Job, nach einem Neustart
+    wird er fortgesetzt, siehe resume_sending_jobs). Der Versand blockiert die Event-Loop nicht (siehe smtp_pool.py).
+    """
+    def report_send_progress(entry: Dict[str, Any], finished: bool) -> None:
+        message = entry['message'] if entry['status'] != 'error' else f"FEHLER: {entry['message']}"
+        progress.advance(1 if finished else 0, message)
+
+    db = SessionLocal()
+    try:
+        already_done = sum(count for state, count in queue_counts(db, process_id).items() if state in ('success', 'failed'))
+        if already_done:
+            progress.advance(already_done, f"Versand wird fortgesetzt ({already_done} E-Mails bereits bearbeitet).")
+        mail_send_log = await send_queued_emails(db, user_id, process_id, progress_callback=report_send_progress)
+        total = queue_counts(db, process_id)
+    finally:
+        db.close()
+
+    sent_count = total.get('success', 0)
+    return {'processLog': mail_send_log, 'summary': f"{sent_count} von {sum(total.values())} E-Mails versendet."}
+
+
+def resume_sending_jobs() -> None:
+    """
+    Beim Start: Versandvorgänge, deren Warteschlange noch offene Einträge hat, unter ihrer bisherigen Job-ID
+    fortsetzen (läuft nach job_manager.fail_interrupted_jobs und setzt deren Status zurück).
+    """
+    db = SessionLocal()
+    try:
+        for process in interrupted_processes():
+            job = db.query(BackgroundJob).filter(BackgroundJob.id == process['job_id']).first() if process['job_id'] else None
+            if job is None:
+                job = create_job(db, process['user_id'], 'send', process['total'])
+                db.query(ProcessLogEntry).filter(ProcessLogEntry.id == process['process_id']).update({'job_id': job.id})
+            job.status = 'queued'
+            job.processed_items = 0
+            job.finished_at = None
+            job.result_applied = False
+            job.last_message = "Versand wird nach einem Neustart des Servers fortgesetzt."
+            db.commit()
+            start_job(job.id, lambda progress, user_id=process['user_id'], process_id=process['process_id']:
+                      run_sending_job(user_id, process_id, progress))
+    finally:
+        db.close()
+
+
+@router.get("/generated_pdfs/{user_id}/{job_id}/{filename}")
+async def serve_generated_pdf(user_id: int, job_id: int, filename: str, current_user_id: int = Depends(get_current_user_id)):
+    # Erzeugte Dateien sind nur für ihren Besitzer abrufbar
+    if user_id != current_user_id or os.path.basename(filename) != filename:
+        raise HTTPException(status_code=404, detail="Datei nicht gefunden.")
+    file_path = os.path.join(PDF_GENERATED_DIR, str(user_id), str(job_id), filename)
+    if not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="Datei nicht gefunden.")
+    return FileResponse(path=file_path, media_type="application/pdf")
+
+
+@router.get("/api/column_values", response_class=JSONResponse)
+async def column_values_api(request: Request, column: str, limit: int = 200, db: Session = Depends(get_db),
+                            current_user_id: int = Depends(get_current_user_id)):
+    """Verschiedene Werte einer Spalte der aktuellen Tabelle mit Anzahl (Vorschläge für den Filter)."""
+    excel_file_path = load_mailing(db, request.session, current_user_id).get('excel_file_path')
+    if not excel_file_path or not os.path.exists(excel_file_path):
+        raise HTTPException(status_code=404, detail="Keine Tabelle hochgeladen.")
+    try:
+        result = await run_in_threadpool(distinct_column_values, excel_file_path, column, max(1, min(limit, 1000)))
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return JSONResponse(content=result)
+
+
+@router.get("/api/preview", response_class=JSONResponse)
+async def preview_page_api(request: Request, page: int = 1, page_size: int = DEFAULT_PAGE_SIZE, sort: str = '', order: str = 'asc',
+                           db: Session = Depends(get_db), current_user_id: int = Depends(get_current_user_id)):
+    """Eine Seite der gefilterten Daten (Vorschau unter Schritt 2), optional sortiert nach Spalte `sort`."""
+    mailing = load_mailing(db, request.session, current_user_id)
+    excel_file_path = mailing.get('excel_file_path')
+    if not excel_file_path or not os.path.exists(excel_file_path) or mailing.filtered_row_ids is None:
+        raise HTTPException(status_code=404, detail="Keine gefilterten Daten vorhanden.")
+    dataset = await run_in_threadpool(load_dataset, excel_file_path)
+    result = await run_in_threadpool(paginate_rows, DatasetRows(dataset, mailing.filtered_row_ids), page, page_size, sort or None, order == 'desc')
+    # Datumswerte liegen im Datensatz bereits als Text vor (siehe table_readers.py)
+    return JSONResponse(content=result)
+
+
+@router.get("/api/review", response_class=JSONResponse)
+async def review_page_api(request: Request, page: int = 1, page_size: int = DEFAULT_PAGE_SIZE, sort: str = '', order: str = 'asc',
+                          db: Session = Depends(get_db), current_user_id: int = Depends(get_current_user_id)):
+    """Eine Seite der erstellten E-Mails (Schritt 5); Text und Datenzeile bleiben auf dem Server."""
+    mailing = load_mailing(db, request.session, current_user_id)
+    return JSONResponse(content=review_page(db, mailing, page, page_size, sort or None, order == 'desc'))
+
+
+@router.get("/api/storage", response_class=JSONResponse)
+async def storage_usage_api(current_user_id: int = Depends(get_current_user_id)):
+    used_bytes = await run_in_threadpool(user_usage_bytes, current_user_id)
+    # Trefferzahlen des (prozessweiten) PDF-Caches seit dem Start, um seine Wirkung zu sehen
+    return JSONResponse(content={'used_bytes': used_bytes, 'quota_bytes': ARTIFACT_USER_QUOTA_MB * 1024 * 1024,
+                                 'pdf_cache': get_pdf_cache_stats()})
+
+
+@router.get("/jobs/{job_id}", response_class=HTMLResponse)
+async def job_status_page(request: Request, job_id: int, db: Session = Depends(get_db), current_user_id: int = Depends(get_current_user_id)):
+    job = get_job(db, job_id, current_user_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Vorgang nicht gefunden.")
+    return templates.TemplateResponse("status.html", {"request": request, "job_id": job.id, "job_kind": job.kind})
+
+
+@router.get("/api/jobs/{job_id}", response_class=JSONResponse)
+async def job_status_api(job_id: int, db: Session = Depends(get_db), current_user_id: int = Depends(get_current_user_id)):
+    job = get_job(db, job_id, current_user_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Vorgang nicht gefunden.")
+    return JSONResponse(content=job_status(job))
+
+
+@router.get("/jobs/{job_id}/result", response_class=RedirectResponse)
+async def apply_job_result(request: Request, job_id: int, db: Session = Depends(get_db), current_user_id: int = Depends(get_current_user_id)):
+    job = get_job(db, job_id, current_user_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Vorgang nicht gefunden.")
+    if take_job_result(db, job) is not None:
+        # Vorschau-Einträge hat der Job bereits direkt am Vorgang gespeichert. Das Protokoll (beim Versand ein Eintrag
+        # pro Empfänger) bleibt im Job-Ergebnis, die Session merkt sich nur die Job-ID
+        request.session.pop("processLog", None)
+        request.session["processLogJobId"] = job.id
+    return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
+
+
 @router.post("/", response_class=RedirectResponse)
 async def handle_form_post(request: Request, action: Optional[str] = Form(None),
                            excel_file: Optional[UploadFile] = File(None),
@@ -149,45 +502,69 @@ async def handle_form_post(request: Request, action: Optional[str] = Form(None),
                            from_name: Optional[str] = Form(None),
                            email_body: Optional[str] = Form(None),
                            no_attachment: bool = Form(False),
+                           render_mode: Optional[str] = Form(None),
+                           overlay_fields: Optional[str] = Form(None),
                            current_user_id: int = Depends(get_current_user_id),
                            db: Session = Depends(get_db)):
     session_data = request.session
     form_data = await request.form()
 
     if action == 'upload_excel':
-        await reset_process(request, current_user_id)
+        await reset_process(request, current_user_id, db)
+        mailing = load_mailing(db, session_data, current_user_id)
         upload_result = await handle_excel_upload(excel_file, current_user_id)
         if "error" in upload_result:
             session_data["fatalError"] = upload_result["error"]
         else:
-            session_data['excel_file_path'] = upload_result["file_path"]
-            session_data['excel_file_original_name'] = upload_result["original_name"]
-            session_data["processLog"] = [{'status': 'success', 'message': f"Tabelle '{upload_result['original_name']}' erfolgreich hochgeladen."}]
+            try:
+                # Tabelle direkt einlesen; Kopfzeile, Filter und Vorschau nutzen danach den zwischengespeicherten Datensatz
+                dataset = await run_in_threadpool(load_dataset, upload_result["file_path"])
+                mailing['excel_file_path'] = upload_result["file_path"]
+                mailing['excel_file_original_name'] = upload_result["original_name"]
+                session_data["processLog"] = [{'status': 'success', 'message': f"Tabelle '{upload_result['original_name']}' erfolgreich hochgeladen ({dataset.row_count} Datensätze)."}]
+            except Exception as e:
+                os.unlink(upload_result["file_path"])
+                session_data["fatalError"] = f"Kritischer Fehler beim Lesen der Tabelle: {e}"
+        mailing.save(db, session_data)
+        return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
+
+    mailing = load_mailing(db, session_data, current_user_id)
 
-    elif action == 'apply_filter':
-        excel_file_path = session_data.get('excel_file_path')
+    if action == 'apply_filter':
+        excel_file_path = mailing.get('excel_file_path')
         if not excel_file_path or not os.path.exists(excel_file_path):
             session_data["fatalError"] = "Bitte zuerst eine gültige Excel-Datei hochladen."
         else:
             try:
-                if not column or not value:
-                    processed_data = read_all_excel_data(excel_file_path)
-                    session_data.update({'filter_column': 'Alle', 'filter_value': 'Alle'})
-                    session_data["processLog"] = [{'status': 'success', 'message': f"Alle {len(processed_data)} Datensätze aus der Tabelle geladen."}]
+                filter_combine = 'or' if form_data.get('filter_combine') == 'or' else 'and'
+                if form_data.getlist('filter_column[]'):
+                    conditions = parse_conditions(form_data.getlist('filter_column[]'), form_data.getlist('filter_operator[]'),
+                                                  form_data.getlist('filter_value[]'), form_data.getlist('filter_value2[]'))
                 else:
-                    processed_data = filter_excel_data(excel_file_path, column, value)
-                    session_data.update({'filter_column': column, 'filter_value': value})
-                    session_data["processLog"] = [{'status': 'success', 'message': f"Für den Filter '{value}' in Spalte '{column}' wurden {len(processed_data)} Einträge gefunden."}]
-                session_data['filteredData'] = processed_data
-                session_data['isFiltered'] = True
+                    # Einfacher Filter (eine Spalte, ein Wert) wie bisher
+                    conditions = [{'column': column, 'operator': 'eq', 'value': value, 'value2': ''}] if column and value else []
+                # Gespeichert werden nur die Zeilennummern; die Zeilen selbst liefert der zwischengespeicherte Datensatz
+                row_ids = await run_in_threadpool(query_excel_row_ids, excel_file_path, conditions, filter_combine)
+                if not conditions:
+                    mailing.update({'filter_column': 'Alle', 'filter_value': 'Alle', 'filter_conditions': [], 'filter_combine': filter_combine})
+                    session_data["processLog"] = [{'status': 'success', 'message': f"Alle {len(row_ids)} Datensätze aus der Tabelle geladen."}]
+                else:
+                    description = describe_conditions(conditions, filter_combine)
+                    mailing.update({'filter_column': conditions[0]['column'], 'filter_value': description,
+                                    'filter_conditions': conditions, 'filter_combine': filter_combine})
+                    session_data["processLog"] = [{'status': 'success', 'message': f"Für den Filter {description} wurden {len(row_ids)} Einträge gefunden."}]
+                mailing.set_filtered_row_ids(row_ids)
+                mailing['isFiltered'] = True
             except Exception as e:
                 session_data["fatalError"] = f"Kritischer Fehler bei der Datenverarbeitung: {e}"
 
     elif action == 'confirm_details':
-        session_data.update({
+        mailing.update({
             'email_body': email_body, 'pdf_filename_format': pdf_filename_format,
             'email_subject': email_subject, 'from_name': from_name,
             'email_column': email_column, 'no_attachment': no_attachment,
+            'render_mode': render_mode if render_mode in ('overlay', 'merged') else 'docx',
+            'overlay_fields': overlay_fields or '',
             'isDetailsConfirmed': False # Zurücksetzen, falls erneut bestätigt wird
         })
         upload_error_msg = None
@@ -200,116 +577,107 @@ async def handle_form_post(request: Request, action: Optional[str] = Form(None),
                 new_template_path = os.path.join(template_dir, unique_filename)
                 with open(new_template_path, "wb") as buffer:
                     shutil.copyfileobj(word_template.file, buffer)
-                session_data['active_word_template'] = new_template_path
+                mailing['active_word_template'] = new_template_path
             except Exception as e:
                 upload_error_msg = f"Fehler beim Speichern der Vorlage: {e}"
-        elif not no_attachment and not session_data.get('active_word_template'):
+        elif not no_attachment and not mailing.get('active_word_template'):
              upload_error_msg = "Keine Vorlage ausgewählt. Bitte eine .docx-Vorlage hochladen."
-        
+        if not upload_error_msg and not no_attachment and mailing['render_mode'] == 'overlay':
+            try:
+                parse_overlay_fields(mailing['overlay_fields'])
+            except ValueError as e:
+                upload_error_msg = f"Schnellmodus: {e}"
+
         if upload_error_msg:
             session_data["uploadError"] = upload_error_msg
         else:
             session_data.pop("uploadError", None)
             session_data["processLog"] = [{'status': 'success', 'message': "Vorlagen- und Inhalts-Details erfolgreich übernommen."}]
+            try:
+                placeholder_hints = await run_in_threadpool(unknown_placeholder_hints, mailing.data)
+            except Exception as e:
+                placeholder_hints = [f"Die Platzhalter konnten nicht geprüft werden: {e}"]
+            session_data["processLog"].extend({'status': 'info', 'message': hint} for hint in placeholder_hints)
             # Nur wenn alle Pflichtfelder ausgefüllt sind, wird der Schritt als bestätigt markiert
-            if email_column and email_subject and from_name and (no_attachment or session_data.get('active_word_template')):
-                 session_data['isDetailsConfirmed'] = True
+            if email_column and email_subject and from_name and (no_attachment or mailing.get('active_word_template')):
+                 mailing['isDetailsConfirmed'] = True
 
-    # === NEUER, ROBUSTERER GENERIERUNGS-BLOCK ===
-    elif action == 'generate_for_review':
-        filtered_data = session_data.get('filteredData', [])
-        session_data['reviewFiles'] = [] # Alte Vorschau immer zuerst leeren
+    # === GENERIERUNG ALS HINTERGRUND-JOB ===
+    elif action in ('generate_for_review', 'start_generation'):
+        row_ids = mailing.filtered_row_ids or []
+        clear_review(db, mailing) # Alte Vorschau immer zuerst leeren
 
-        if not filtered_data:
+        quota_error = None if mailing.get('no_attachment') else await run_in_threadpool(quota_error_message, current_user_id)
+        if not row_ids:
             session_data["processLog"] = [{'status': 'error', 'message': "Keine Daten zur Verarbeitung gefunden. Bitte filtern Sie zuerst."}]
+        elif quota_error:
+            session_data["processLog"] = [{'status': 'error', 'message': quota_error}]
         else:
-            review_files = []
-            generation_log = []
-            total_rows = len(filtered_data)
-
-            for index, row_data in enumerate(filtered_data):
-                try:
-                    pdf_path, pdf_web_path = None, None
-                    if not session_data.get('no_attachment', False):
-                        filename_template = session_data.get('pdf_filename_format', 'Dokument.pdf')
-                        # Platzhalter im Dateinamen ersetzen
-                        output_filename_raw = replace_docx_placeholders_in_text(filename_template, row_data)
-                        # Dateinamen für das Dateisystem sicher machen
-                        output_filename_safe = "".join(c for c in output_filename_raw if c.isalnum() or c in ['-', '_', '.']).strip()
-                        if not output_filename_safe:
-                            output_filename_safe = f"dokument_{index+1}.pdf"
-
-                        pdf_path = generate_personalized_pdf(
-                            original_docx_path=session_data.get('active_word_template'),
-                            data_row=row_data,
-                            output_pdf_filename=output_filename_safe
-                        )
-                        pdf_web_path = f"/{PDF_GENERATED_DIR}/{os.path.basename(pdf_path)}"
-
-                    review_files.append({
-                        'pdf_path': pdf_path, 'pdf_web_path': pdf_web_path,
-                        'recipient_email': row_data.get(session_data.get('email_column', ''), 'N/A'),
-                        'recipient_name': f"{row_data.get('Vorname', '')} {row_data.get('Name', '')}".strip() or row_data.get('Name', f'Empfänger {index+1}'),
-                        'subject': replace_docx_placeholders_in_text(session_data.get('email_subject', ''), row_data),
-                        'body': session_data.get('email_body', ''),
-                        'data_row': row_data
-                    })
-                except Exception as e:
-                    # Wenn eine Zeile fehlschlägt, wird dies protokolliert und die Schleife fortgesetzt
-                    error_recipient = row_data.get(session_data.get('email_column', ''), f'Unbekannt in Zeile {index + 2}')
-                    generation_log.append({'status': 'error', 'message': f"Fehler bei Erstellung für '{error_recipient}': {e}"})
-                    continue
-            
-            # Nach der Schleife werden die Ergebnisse in der Session gespeichert
-            session_data['reviewFiles'] = review_files
-            
-            success_count = len(review_files)
-            if success_count > 0:
-                generation_log.insert(0, {'status': 'success', 'message': f"{success_count} von {total_rows} E-Mails erfolgreich zur Vorschau erstellt."})
-            
-            error_count = total_rows - success_count
-            if error_count > 0:
-                generation_log.append({'status': 'info', 'message': f"WICHTIG: {error_count} E-Mail(s) konnten wegen Fehlern nicht erstellt werden (Details siehe oben)."})
-
-            if not generation_log:
-                 generation_log.append({'status': 'info', 'message': 'Keine Daten zum Verarbeiten gefunden.'})
-
-            session_data["processLog"] = generation_log
+            # Der Job liest die Einstellungen aus dieser Momentaufnahme und schreibt die Vorschau direkt an den Vorgang
+            generation_settings = {key: mailing.get(key) for key in (
+                'excel_file_path', 'no_attachment', 'pdf_filename_format', 'active_word_template', 'email_column',
+                'email_subject', 'email_body', 'render_mode', 'overlay_fields')}
+            mailing.save(db, session_data)
+            mailing_id = mailing.id
+            job = create_job(db, current_user_id, 'generate', len(row_ids))
+            start_job(job.id, lambda progress: run_generation_job(current_user_id, mailing_id, row_ids, generation_settings, progress))
+            return RedirectResponse(url=f"/jobs/{job.id}", status_code=status.HTTP_302_FOUND)
 
     elif action == 'send_selected':
-        selected_identifiers = form_data.getlist('selected_files[]')
-        all_review_files = session_data.get('reviewFiles', [])
-        items_to_send = [item for i, item in enumerate(all_review_files) if (item.get('pdf_path') or f'no-pdf-{i+1}') in selected_identifiers]
+        if form_data.get('selection_mode') == 'exclude':
+            # Die Vorschau ist seitenweise; übermittelt werden daher nur die abgewählten Einträge
+            recipients = review_recipients(db, mailing, excluded_ids=form_data.getlist('excluded_files[]'))
+        else:
+            recipients = review_recipients(db, mailing, selected_ids=form_data.getlist('selected_files[]'))
 
-        if not items_to_send:
+        if not recipients:
             session_data["processLog"] = [{'status': 'error', 'message': 'Keine E-Mails zum Senden ausgewählt.'}]
         else:
             smtp_settings = get_smtp_settings(db, current_user_id)
             if not smtp_settings:
                 session_data["processLog"] = [{'status': 'error', 'message': "Fehler: Keine SMTP-Einstellungen gefunden."}]
             else:
-                for item in items_to_send:
-                    item['body'] = replace_html_placeholders_in_text(item['body'], item['data_row'])
-                mail_send_log = await send_personalized_emails(db, current_user_id, items_to_send, smtp_settings['user'])
-                session_data["processLog"] = mail_send_log
-                # DB-Logging (unverändert) ...
-                cleanup_session_after_process(session_data) # Session nach erfolgreichem Versand aufräumen
-                return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
+                active_word_template = mailing.get('active_word_template')
+                process_info = {
+                    'excel_file_original_name': mailing.get('excel_file_original_name') or '',
+                    'word_template_original_name': os.path.basename(active_word_template) if active_word_template else '',
+                    'filter_column': mailing.get('filter_column'), 'filter_value': mailing.get('filter_value'),
+                    'email_subject_template': mailing.get('email_subject') or '',
+                    'email_body_template': mailing.get('review_email_body') or '', 'from_name': mailing.get('from_name') or None,
+                }
+                recipient_rows = [{'id': recipient.id, 'row_id': recipient.row_id, 'pdf_path': recipient.pdf_path,
+                                   'recipient_email': recipient.recipient_email, 'recipient_name': recipient.recipient_name,
+                                   'subject': recipient.subject} for recipient in recipients]
+                # Texte personalisieren und einreihen kostet bei vielen Empfängern Zeit und läuft daher in einem Thread
+                job_id, process_id, created = await run_in_threadpool(
+                    enqueue_review_recipients, current_user_id, mailing.id, mailing.get('review_id') or '',
+                    mailing['excel_file_path'], process_info, recipient_rows)
+                if created:
+                    start_job(job_id, lambda progress: run_sending_job(current_user_id, process_id, progress))
+                else:
+                    session_data["processLog"] = [{'status': 'info', 'message': "Diese E-Mails wurden bereits zum Versand übergeben."}]
+                cleanup_mailing_after_process(db, mailing) # Vorgang direkt aufräumen, damit nicht doppelt versendet wird
+                mailing.save(db, session_data)
+                if job_id is None:
+                    return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
+                # Bei doppelt abgeschicktem Formular ist das der bereits laufende Versand
+                return RedirectResponse(url=f"/jobs/{job_id}", status_code=status.HTTP_302_FOUND)
 
     elif action == 'download_zip':
-        review_files = session_data.get('reviewFiles', [])
-        pdf_files = [f['pdf_path'] for f in review_files if f.get('pdf_path') and os.path.exists(f['pdf_path'])]
+        pdf_files = [recipient.pdf_path for recipient in review_recipients(db, mailing)
+                     if recipient.pdf_path and os.path.exists(recipient.pdf_path)]
         if not pdf_files:
             session_data["processLog"] = [{'status': 'error', 'message': 'Keine PDF-Dateien zum Zippen gefunden.'}]
         else:
-            zip_filename = os.path.join(PDF_GENERATED_DIR, f"Serienbriefe_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.zip")
-            with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zf:
-                for pdf_path in pdf_files: zf.write(pdf_path, os.path.basename(pdf_path))
-            def cleanup_zip(file_path):
-                try: os.unlink(file_path)
-                except OSError as e: print(f"Error deleting zip file {file_path}: {e}")
-            
-            cleanup_session_after_process(session_data) # Session auch nach dem Download aufräumen
-            return FileResponse(path=zip_filename, filename=os.path.basename(zip_filename), media_type="application/zip", background=BackgroundTask(cleanup_zip, file_path=zip_filename))
-
-    return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
\ No newline at end of file
+            zip_filename = f"Serienbriefe_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.zip"
+            # Das Archiv wird beim Senden erzeugt, es entsteht keine temporäre Datei
+            zip_stream = stream_zip_files([(pdf_path, os.path.basename(pdf_path)) for pdf_path in pdf_files],
+                                          compress=ZIP_DOWNLOAD_COMPRESS)
+
+            cleanup_mailing_after_process(db, mailing) # Vorgang auch nach dem Download aufräumen
+            mailing.save(db, session_data)
+            return StreamingResponse(zip_stream, media_type="application/zip",
+                                     headers={"Content-Disposition": f'attachment; filename="{zip_filename}"'})
+
+    mailing.save(db, session_data)
+    return RedirectResponse(url="/", status_code=status.HTTP_302_FOUND)
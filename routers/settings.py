@@ -1,3 +1,4 @@
+from typing import Optional
 from fastapi import APIRouter, Request, Form, Depends, status
 from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
 from sqlalchemy.orm import Session
@@ -23,15 +24,35 @@ async def get_settings_form(request: Request, db: Session = Depends(get_db), cur
         "smtp_pass": settings.get("password", ""),
         "smtp_port": settings.get("port", "587"),
         "smtp_secure": settings.get("secure", "tls"),
+        "rate_limit_per_minute": settings.get("rate_limit_per_minute") or "",
+        "messages_per_connection": settings.get("messages_per_connection") or "",
+        "daily_limit": settings.get("daily_limit") or "",
         "successMessage": request.session.pop("successMessage", None),
         "errorMessage": request.session.pop("errorMessage", None),
     }
     return templates.TemplateResponse("settings.html", context)
 
+def parse_limit(value: Optional[str], label: str) -> Optional[int]:
+    """Leeres Feld = keine Begrenzung; sonst eine positive ganze Zahl."""
+    if value is None or not value.strip():
+        return None
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError(f"{label} muss eine ganze Zahl sein.")
+    if limit < 1:
+        raise ValueError(f"{label} muss größer als 0 sein.")
+    return limit
+
 @router.post("/settings", response_class=RedirectResponse)
-async def post_settings(request: Request, smtp_host: str = Form(...), smtp_user: str = Form(...), smtp_pass: str = Form(...), smtp_port: str = Form(...), smtp_secure: str = Form(...), db: Session = Depends(get_db), current_user_id: int = Depends(get_current_user_id)):
+async def post_settings(request: Request, smtp_host: str = Form(...), smtp_user: str = Form(...), smtp_pass: str = Form(...), smtp_port: str = Form(...), smtp_secure: str = Form(...),
+                        rate_limit_per_minute: Optional[str] = Form(None), messages_per_connection: Optional[str] = Form(None), daily_limit: Optional[str] = Form(None),
+                        db: Session = Depends(get_db), current_user_id: int = Depends(get_current_user_id)):
     try:
-        save_smtp_settings(db, current_user_id, smtp_host, smtp_user, smtp_pass, smtp_port, smtp_secure)
+        save_smtp_settings(db, current_user_id, smtp_host, smtp_user, smtp_pass, smtp_port, smtp_secure,
+                           rate_limit_per_minute=parse_limit(rate_limit_per_minute, "E-Mails pro Minute"),
+                           messages_per_connection=parse_limit(messages_per_connection, "E-Mails pro Verbindung"),
+                           daily_limit=parse_limit(daily_limit, "Tageslimit"))
         
         # === HIER IST DIE KORREKTUR: smtp_user wird als Test-Empfänger übergeben ===
         test_result = await test_smtp_connection_internal(host=smtp_host, user=smtp_user, password=smtp_pass, port=smtp_port, secure=smtp_secure, test_recipient_email=smtp_user, send_test_email=True)
@@ -1,19 +1,66 @@
 import os
-from typing import Dict, Any, Optional
+import json
+import time
+import logging
+import threading
+from typing import Dict, Any, Optional, Tuple
 from sqlalchemy.orm import Session
-from database import SmtpSettings
+from database import SessionLocal, SmtpSettings
 from security import encrypt_data, decrypt_data
 from dotenv import load_dotenv
 
 # Lade Umgebungsvariablen aus .env-Datei
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 ENCRYPTION_KEY = os.getenv('ENCRYPTION_KEY')
+# Entschlüsselte Einstellungen werden so viele Sekunden im Prozess vorgehalten (0 = kein Cache). Speichern leert den
+# Eintrag sofort; andere Worker-Prozesse sehen geänderte Einstellungen spätestens nach Ablauf dieser Zeit.
+SMTP_SETTINGS_CACHE_TTL = float(os.environ.get("SMTP_SETTINGS_CACHE_TTL", "60"))
+# Diese Felder liegen gemeinsam verschlüsselt in SmtpSettings.encrypted_settings
+CONNECTION_FIELDS = ("host", "user", "password", "port", "secure")
 
 if not ENCRYPTION_KEY:
-    print("WARNUNG (settings_manager.py): ENCRYPTION_KEY nicht in .env gefunden. SMTP-Einstellungen können nicht verarbeitet werden.")
+    logger.warning("ENCRYPTION_KEY nicht in .env gefunden. SMTP-Einstellungen können nicht verarbeitet werden.")
 else:
-    print("DEBUG (settings_manager.py): ENCRYPTION_KEY erfolgreich geladen.") # NEU: Bestätigung, dass der Schlüssel geladen wurde
+    logger.debug("ENCRYPTION_KEY erfolgreich geladen.")
+
+_settings_cache: Dict[int, Tuple[float, Dict[str, Any]]] = {}
+_cache_lock = threading.Lock()
+
+
+def invalidate_smtp_settings_cache(user_id: Optional[int] = None) -> None:
+    """Entfernt die zwischengespeicherten Einstellungen eines Benutzers (ohne user_id: aller Benutzer)."""
+    with _cache_lock:
+        if user_id is None:
+            _settings_cache.clear()
+        else:
+            _settings_cache.pop(user_id, None)
+
+
+def _encrypt_connection(connection: Dict[str, str]) -> str:
+    return encrypt_data(json.dumps({field: connection[field] for field in CONNECTION_FIELDS}), ENCRYPTION_KEY)
+
+
+def _decrypt_connection(settings: SmtpSettings) -> Dict[str, str]:
+    if settings.encrypted_settings:
+        return json.loads(decrypt_data(settings.encrypted_settings, ENCRYPTION_KEY))
+    # Ältere Einträge: jedes Feld einzeln verschlüsselt
+    return {
+        "host": decrypt_data(settings.encrypted_host, ENCRYPTION_KEY),
+        "user": decrypt_data(settings.encrypted_user, ENCRYPTION_KEY),
+        "password": decrypt_data(settings.encrypted_pass, ENCRYPTION_KEY),
+        "port": decrypt_data(settings.encrypted_port, ENCRYPTION_KEY),
+        "secure": decrypt_data(settings.encrypted_secure, ENCRYPTION_KEY),
+    }
+
+
+def _store_connection(settings: SmtpSettings, connection: Dict[str, str]) -> None:
+    settings.encrypted_settings = _encrypt_connection(connection)
+    # Die alten Einzelspalten sind NOT NULL und werden nicht mehr gelesen
+    settings.encrypted_host = settings.encrypted_user = settings.encrypted_pass = ''
+    settings.encrypted_port = settings.encrypted_secure = ''
 
 
 def save_smtp_settings(
@@ -23,72 +70,85 @@ def save_smtp_settings(
     user: str,
     password: str,
     port: str,
-    secure: str
+    secure: str,
+    rate_limit_per_minute: Optional[int] = None,
+    messages_per_connection: Optional[int] = None,
+    daily_limit: Optional[int] = None
 ) -> None:
-    # Debug-Ausgabe beim Speichern
-    print(f"DEBUG (settings_manager.py): save_smtp_settings aufgerufen für user_id={user_id}. Host={host}, User={user}") # NEU
+    logger.debug("save_smtp_settings aufgerufen für user_id=%s. Host=%s, User=%s", user_id, host, user)
     if not ENCRYPTION_KEY:
         raise ValueError("ENCRYPTION_KEY nicht verfügbar. Kann SMTP-Einstellungen nicht speichern.")
 
-    encrypted_host = encrypt_data(host, ENCRYPTION_KEY)
-    encrypted_user = encrypt_data(user, ENCRYPTION_KEY)
-    encrypted_pass = encrypt_data(password, ENCRYPTION_KEY)
-    encrypted_port = encrypt_data(port, ENCRYPTION_KEY)
-    encrypted_secure = encrypt_data(secure, ENCRYPTION_KEY)
-
+    connection = {"host": host, "user": user, "password": password, "port": port, "secure": secure}
     settings = db.query(SmtpSettings).filter(SmtpSettings.user_id == user_id).first()
     if settings:
-        print(f"DEBUG (settings_manager.py): Bestehende SMTP-Einstellungen für user_id={user_id} aktualisiert.") # NEU
-        settings.encrypted_host = encrypted_host
-        settings.encrypted_user = encrypted_user
-        settings.encrypted_pass = encrypted_pass
-        settings.encrypted_port = encrypted_port
-        settings.encrypted_secure = encrypted_secure
+        logger.debug("Bestehende SMTP-Einstellungen für user_id=%s aktualisiert.", user_id)
     else:
-        print(f"DEBUG (settings_manager.py): Neue SMTP-Einstellungen für user_id={user_id} erstellt.") # NEU
-        settings = SmtpSettings(
-            user_id=user_id,
-            encrypted_host=encrypted_host,
-            encrypted_user=encrypted_user,
-            encrypted_pass=encrypted_pass,
-            encrypted_port=encrypted_port,
-            encrypted_secure=encrypted_secure
-        )
+        logger.debug("Neue SMTP-Einstellungen für user_id=%s erstellt.", user_id)
+        settings = SmtpSettings(user_id=user_id)
         db.add(settings)
+    _store_connection(settings, connection)
+    settings.rate_limit_per_minute = rate_limit_per_minute
+    settings.messages_per_connection = messages_per_connection
+    settings.daily_limit = daily_limit
     db.commit()
-    print(f"DEBUG (settings_manager.py): SMTP-Einstellungen für user_id={user_id} in DB committet.") # NEU
+    invalidate_smtp_settings_cache(user_id)
+    logger.debug("SMTP-Einstellungen für user_id=%s in DB committet.", user_id)
 
-def get_smtp_settings(db: Session, user_id: int) -> Optional[Dict[str, str]]:
-    print(f"DEBUG (settings_manager.py): get_smtp_settings aufgerufen für user_id={user_id}.") # NEU
+def get_smtp_settings(db: Session, user_id: int) -> Optional[Dict[str, Any]]:
     if not ENCRYPTION_KEY:
-        print("FEHLER (settings_manager.py): ENCRYPTION_KEY nicht verfügbar. Kann SMTP-Einstellungen nicht entschlüsseln.") # NEU
+        logger.error("ENCRYPTION_KEY nicht verfügbar. Kann SMTP-Einstellungen nicht entschlüsseln.")
         return None
 
+    with _cache_lock:
+        cached = _settings_cache.get(user_id)
+    if cached is not None and cached[0] > time.monotonic():
+        return dict(cached[1])
+
     settings = db.query(SmtpSettings).filter(SmtpSettings.user_id == user_id).first()
     if settings:
-        print(f"DEBUG (settings_manager.py): SMTP-Einstellungen für user_id={user_id} in DB gefunden. Versuche zu entschlüsseln.") # NEU
         try:
-            # Hier können wir print-Statements hinzufügen, um die verschlüsselten Werte zu sehen
-            # print(f"DEBUG: Verschlüsselt: host={settings.encrypted_host[:10]}..., user={settings.encrypted_user[:10]}...") # Nur die ersten paar Zeichen
-
-            decrypted_host = decrypt_data(settings.encrypted_host, ENCRYPTION_KEY)
-            decrypted_user = decrypt_data(settings.encrypted_user, ENCRYPTION_KEY)
-            decrypted_pass = decrypt_data(settings.encrypted_pass, ENCRYPTION_KEY)
-            decrypted_port = decrypt_data(settings.encrypted_port, ENCRYPTION_KEY)
-            decrypted_secure = decrypt_data(settings.encrypted_secure, ENCRYPTION_KEY)
-
-            print(f"DEBUG (settings_manager.py): SMTP-Daten erfolgreich entschlüsselt für user_id={user_id}. Host={decrypted_host}, User={decrypted_user}") # NEU
-            return {
-                "host": decrypted_host,
-                "user": decrypted_user,
-                "password": decrypted_pass,
-                "port": decrypted_port,
-                "secure": decrypted_secure
-            }
+            connection = _decrypt_connection(settings)
         except Exception as e:
-            print(f"FEHLER (settings_manager.py): Entschlüsselung der SMTP-Einstellungen fehlgeschlagen für user_id={user_id}: {e}") # NEU
             # Wenn Entschlüsselung fehlschlägt, ist der ENCRYPTION_KEY möglicherweise anders als der beim Speichern
             # Oder die Daten sind korrupt
+            logger.error("Entschlüsselung der SMTP-Einstellungen fehlgeschlagen für user_id=%s: %s", user_id, e)
             return None
-    print(f"DEBUG (settings_manager.py): Keine SMTP-Einstellungen für user_id={user_id} in DB gefunden.") # NEU
-    return None
\ No newline at end of file
+        logger.debug("SMTP-Daten entschlüsselt für user_id=%s. Host=%s, User=%s", user_id, connection["host"], connection["user"])
+        result = {
+            **connection,
+            # Versandgrenzen sind nicht geheim und werden unverschlüsselt gespeichert
+            "rate_limit_per_minute": settings.rate_limit_per_minute,
+            "messages_per_connection": settings.messages_per_connection,
+            "daily_limit": settings.daily_limit
+        }
+        if SMTP_SETTINGS_CACHE_TTL > 0:
+            with _cache_lock:
+                _settings_cache[user_id] = (time.monotonic() + SMTP_SETTINGS_CACHE_TTL, result)
+        return dict(result)
+    logger.debug("Keine SMTP-Einstellungen für user_id=%s in DB gefunden.", user_id)
+    return None
+
+
+def migrate_legacy_smtp_settings() -> int:
+    """
+    Überführt Einstellungen, die noch feldweise verschlüsselt sind, in den gemeinsamen verschlüsselten Block
+    (beim Start aufgerufen). Nicht entschlüsselbare Einträge bleiben unverändert. Gibt die Anzahl zurück.
+    """
+    if not ENCRYPTION_KEY:
+        return 0
+    db = SessionLocal()
+    try:
+        migrated = 0
+        for settings in db.query(SmtpSettings).filter(SmtpSettings.encrypted_settings.is_(None)).all():
+            try:
+                _store_connection(settings, _decrypt_connection(settings))
+                migrated += 1
+            except Exception as e:
+                logger.warning("SMTP-Einstellungen von user_id=%s konnten nicht umgestellt werden: %s", settings.user_id, e)
+        db.commit()
+        if migrated:
+            logger.info("%s SMTP-Einstellung(en) auf einen verschlüsselten Block umgestellt.", migrated)
+        return migrated
+    finally:
+        db.close()
@@ -0,0 +1,209 @@
+import os
+import time
+import asyncio
+import smtplib
+from email.message import Message
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+from dotenv import load_dotenv
+
+from rate_limiter import AdaptiveRateLimiter
+
+load_dotenv()
+
+# --- Konfiguration des Versands (über Umgebungsvariablen steuerbar) ---
+# Anzahl gleichzeitig geöffneter, angemeldeter SMTP-Verbindungen pro Versandvorgang
+SMTP_POOL_SIZE = int(os.environ.get("SMTP_POOL_SIZE", "4"))
+# Nach so vielen Nachrichten wird eine Verbindung geschlossen und neu aufgebaut
+# (viele Anbieter begrenzen die Anzahl Nachrichten pro Verbindung)
+SMTP_MESSAGES_PER_CONNECTION = int(os.environ.get("SMTP_MESSAGES_PER_CONNECTION", "100"))
+SMTP_TIMEOUT = int(os.environ.get("SMTP_TIMEOUT", "30"))
+# Verbindungen, die länger ungenutzt waren, werden vor dem nächsten Senden mit NOOP geprüft
+SMTP_IDLE_CHECK_SECONDS = float(os.environ.get("SMTP_IDLE_CHECK_SECONDS", "20"))
+
+# Fehler, nach denen die Verbindung unbrauchbar ist (der Server hat sie geschlossen oder antwortet nicht mehr)
+CONNECTION_LOST_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+
+def open_smtp_connection(smtp_settings: Dict[str, Any], timeout: int = SMTP_TIMEOUT) -> smtplib.SMTP:
+    """Baut eine Verbindung gemäß den SMTP-Einstellungen auf (TLS, SSL oder unverschlüsselt) und meldet sich an."""
+    host = smtp_settings["host"]
+    port = int(smtp_settings["port"])
+    if smtp_settings["secure"] == 'ssl':
+        server = smtplib.SMTP_SSL(host, port, timeout=timeout)
+    else:
+        server = smtplib.SMTP(host, port, timeout=timeout)
+        if smtp_settings["secure"] == 'tls':
+            server.starttls()
+    try:
+        server.login(smtp_settings["user"], smtp_settings["password"])
+    except Exception:
+        server.close()
+        raise
+    return server
+
+
+class SmtpSession:
+    """
+    Eine angemeldete SMTP-Sitzung (z. B. eines Pool-Workers). Baut die Verbindung bei Bedarf auf, erneuert sie nach
+    `max_messages` Nachrichten und erkennt abgebrochene oder veraltete Verbindungen: Sie wird dann neu aufgebaut,
+    erneut angemeldet und die gerade übertragene Nachricht genau einmal wiederholt.
+    Alle Methoden blockieren und laufen daher in einem Thread.
+    """
+
+    def __init__(self, smtp_settings: Dict[str, Any], max_messages: int = SMTP_MESSAGES_PER_CONNECTION):
+        self.smtp_settings = smtp_settings
+        self.max_messages = max_messages
+        self.server: Optional[smtplib.SMTP] = None
+        self.sent_on_connection = 0
+        self.connections_opened = 0
+        self.reconnects = 0 # nach Abbruch oder Zeitüberschreitung wiederhergestellte Verbindungen
+        self.handshake_seconds: List[float] = [] # Dauer von Verbindungsaufbau und Anmeldung
+        self._last_used = 0.0
+
+    def connect(self) -> None:
+        self.close()
+        started = time.monotonic()
+        self.server = open_smtp_connection(self.smtp_settings)
+        self.handshake_seconds.append(time.monotonic() - started)
+        self.sent_on_connection = 0
+        self.connections_opened += 1
+        self._last_used = time.monotonic()
+
+    def _reconnect(self) -> None:
+        self.reconnects += 1
+        self.connect()
+
+    def _ensure_connected(self) -> None:
+        if self.server is None or self.sent_on_connection >= self.max_messages:
+            self.connect()
+        elif time.monotonic() - self._last_used > SMTP_IDLE_CHECK_SECONDS:
+            # Länger unbenutzte Verbindungen hat der Server womöglich schon geschlossen
+            try:
+                alive = self.server.noop()[0] == 250
+            except (smtplib.SMTPException, OSError):
+                alive = False
+            if not alive:
+                self._reconnect()
+
+    def send(self, message: Message) -> None:
+        self._ensure_connected()
+        try:
+            self.server.send_message(message)
+        except CONNECTION_LOST_ERRORS:
+            # Verbindung während der Übertragung verloren: neu anmelden und die Nachricht einmal wiederholen
+            self._reconnect()
+            self._send_once(message)
+        except smtplib.SMTPResponseException as e:
+            if e.smtp_code == 421:
+                # 421: der Server beendet die Verbindung (meist wegen Drosselung)
+                self.close()
+            raise
+        self.sent_on_connection += 1
+        self._last_used = time.monotonic()
+
+    def _send_once(self, message: Message) -> None:
+        try:
+            self.server.send_message(message)
+        except CONNECTION_LOST_ERRORS:
+            # Auch die neue Verbindung ist unbrauchbar; die nächste Nachricht baut wieder eine auf
+            self.close()
+            raise
+
+    def close(self) -> None:
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except Exception:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+        self.server = None
+
+
+class SmtpConnectionPool:
+    """
+    Versendet Nachrichten parallel über mehrere SMTP-Sitzungen, ohne die Event-Loop zu blockieren:
+    jeder Worker besitzt eine eigene Sitzung und führt smtplib über asyncio.to_thread aus.
+    Der Pool kann über mehrere Durchläufe (z. B. erneute Versuche) hinweg verwendet werden.
+    """
+
+    def __init__(self, smtp_settings: Dict[str, Any], size: int = SMTP_POOL_SIZE,
+                 messages_per_connection: Optional[int] = None, rate_limiter: Optional[AdaptiveRateLimiter] = None):
+        self.smtp_settings = smtp_settings
+        self.size = max(1, size)
+        # Pro Konto einstellbar (SMTP-Einstellungen), sonst SMTP_MESSAGES_PER_CONNECTION
+        self.messages_per_connection = max(1, messages_per_connection or smtp_settings.get("messages_per_connection")
+                                           or SMTP_MESSAGES_PER_CONNECTION)
+        self.rate_limiter = rate_limiter
+        self.sessions: List[SmtpSession] = []
+
+    def _session(self, index: int) -> SmtpSession:
+        while len(self.sessions) <= index:
+            self.sessions.append(SmtpSession(self.smtp_settings, self.messages_per_connection))
+        return self.sessions[index]
+
+    async def open(self) -> SmtpSession:
+        """
+        Stellt sicher, dass die erste Sitzung angemeldet ist. Schlägt die Anmeldung fehl, wird der Versand
+        gar nicht erst begonnen.
+        """
+        session = self._session(0)
+        if session.server is None:
+            await asyncio.to_thread(session.connect)
+        return session
+
+    async def deliver(self, items: Sequence[Any], send_item: Callable[[SmtpSession, Any], None],
+                      on_result: Callable[[int, Optional[Exception], float], Awaitable[None]]) -> None:
+        """
+        Ruft für jedes Element `send_item(session, item)` in einem Thread auf (höchstens `size` gleichzeitig,
+        mit Ratenbegrenzung höchstens so schnell, wie der Limiter es zulässt).
+        `on_result(index, fehler_oder_None, dauer_in_sekunden)` wird nach jedem Element abgewartet, bevor der Worker
+        das nächste Element übernimmt.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        for index, item in enumerate(items):
+            queue.put_nowait((index, item))
+
+        async def worker(session: SmtpSession) -> None:
+            while True:
+                try:
+                    index, item = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                if self.rate_limiter is not None:
+                    await self.rate_limiter.acquire()
+                started = time.monotonic()
+                error = None
+                try:
+                    await asyncio.to_thread(send_item, session, item)
+                except Exception as e:
+                    error = e
+                if self.rate_limiter is not None:
+                    self.rate_limiter.record(error)
+                await on_result(index, error, time.monotonic() - started)
+
+        # Bereits angemeldete Sitzungen (siehe open) zuerst verwenden
+        worker_count = min(self.size, len(items))
+        await asyncio.gather(*(worker(self._session(index)) for index in range(worker_count)))
+
+    async def send(self, message: Message) -> None:
+        """Sendet eine einzelne Nachricht (z. B. das Sendeprotokoll) über die erste, bereits angemeldete Sitzung."""
+        await asyncio.to_thread(self._session(0).send, message)
+
+    async def close(self) -> None:
+        """Schließt alle Verbindungen; die Sitzungen bauen sie bei der nächsten Verwendung neu auf."""
+        await asyncio.gather(*(asyncio.to_thread(session.close) for session in self.sessions))
+
+    @property
+    def connections_opened(self) -> int:
+        return sum(session.connections_opened for session in self.sessions)
+
+    @property
+    def reconnects(self) -> int:
+        return sum(session.reconnects for session in self.sessions)
+
+    @property
+    def handshake_seconds(self) -> List[float]:
+        return [seconds for session in self.sessions for seconds in session.handshake_seconds]
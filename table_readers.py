@@ -0,0 +1,217 @@
+import os
+import csv
+import zipfile
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+import chardet
+import openpyxl
+from lxml import etree
+
+from helpers import clean_for_json
+
+# Jeder Leser liefert die Zeilen des ersten bzw. aktiven Tabellenblatts als Tupel von Zellwerten,
+# beginnend mit der Kopfzeile. read_table_columns() macht daraus für alle Formate dieselbe Spaltenform.
+
+CSV_SNIFF_BYTES = 64 * 1024
+CSV_DELIMITERS = ";,\t|"
+# chardet kann westeuropäische Einbyte-Kodierungen an kurzen Stichproben kaum unterscheiden
+# (deutsche Exporte werden z.B. gern als ISO-8859-9 erkannt); cp1252 deckt sie für unsere Daten ab.
+CSV_WESTERN_ENCODINGS = {'ascii', 'iso-8859-1', 'iso-8859-9', 'iso-8859-15', 'latin-1', 'windows-1252', 'windows-1254'}
+ODS_NAMESPACES = {
+    'table': 'urn:oasis:names:tc:opendocument:xmlns:table:1.0',
+    'office': 'urn:oasis:names:tc:opendocument:xmlns:office:1.0',
+    'text': 'urn:oasis:names:tc:opendocument:xmlns:text:1.0',
+}
+_TABLE = '{%s}' % ODS_NAMESPACES['table']
+_OFFICE = '{%s}' % ODS_NAMESPACES['office']
+_TEXT = '{%s}' % ODS_NAMESPACES['text']
+
+
+# --- Excel (.xlsx) ---
+
+def iter_xlsx_rows(file_path: str) -> Iterator[tuple]:
+    workbook = openpyxl.load_workbook(file_path, read_only=True)
+    try:
+        sheet = workbook.active
+        # Die in der Datei gespeicherten Abmessungen sind nicht immer korrekt (z.B. bei exportierten Dateien);
+        # ohne sie liest iter_rows einfach bis zur letzten vorhandenen Zeile.
+        sheet.reset_dimensions()
+        yield from sheet.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+# --- CSV ---
+
+def _detect_csv_encoding(sample: bytes) -> str:
+    if sample.startswith(b'\xef\xbb\xbf'):
+        return 'utf-8-sig'
+    try:
+        # Eine am Ende abgeschnittene Multibyte-Sequenz ist kein Gegenbeweis
+        sample.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError as e:
+        if e.start >= len(sample) - 3:
+            return 'utf-8'
+    encoding = (chardet.detect(sample).get('encoding') or 'cp1252').lower()
+    return 'cp1252' if encoding in CSV_WESTERN_ENCODINGS else encoding
+
+
+def _detect_csv_dialect(sample_text: str):
+    try:
+        return csv.Sniffer().sniff(sample_text, delimiters=CSV_DELIMITERS)
+    except csv.Error:
+        # Deutsches Excel exportiert mit Semikolon
+        dialect = csv.excel()
+        dialect.delimiter = ';' if sample_text.count(';') >= sample_text.count(',') else ','
+        return dialect
+
+
+def iter_csv_rows(file_path: str) -> Iterator[tuple]:
+    """
+    Liest eine CSV-Datei zeilenweise. Zeichenkodierung (chardet) und Trennzeichen (csv.Sniffer)
+    werden an den ersten 64 KB erkannt, die Datei selbst wird nicht komplett in den Speicher geladen.
+    Alle Werte bleiben Text (führende Nullen z.B. in Postleitzahlen bleiben so erhalten).
+    """
+    with open(file_path, 'rb') as f:
+        sample = f.read(CSV_SNIFF_BYTES)
+    encoding = _detect_csv_encoding(sample)
+    dialect = _detect_csv_dialect(sample.decode(encoding, errors='ignore'))
+    with open(file_path, 'r', encoding=encoding, errors='replace', newline='') as f:
+        for row in csv.reader(f, dialect):
+            yield tuple(value if value != '' else None for value in row)
+
+
+# --- OpenDocument (.ods) ---
+
+def _ods_cell_value(cell) -> Any:
+    value_type = cell.get(f'{_OFFICE}value-type')
+    if value_type in ('float', 'percentage', 'currency'):
+        number = float(cell.get(f'{_OFFICE}value'))
+        return int(number) if number.is_integer() else number
+    if value_type == 'date':
+        date_text = cell.get(f'{_OFFICE}date-value')
+        try:
+            return datetime.fromisoformat(date_text)
+        except (TypeError, ValueError):
+            return date_text
+    if value_type == 'boolean':
+        return cell.get(f'{_OFFICE}boolean-value') == 'true'
+    paragraphs = ["".join(paragraph.itertext()) for paragraph in cell.iter(f'{_TEXT}p')]
+    return "\n".join(paragraphs) if paragraphs else None
+
+
+def iter_ods_rows(file_path: str) -> Iterator[tuple]:
+    """
+    Liest das erste Tabellenblatt einer ODS-Datei mit iterparse; bereits gelesene Zeilen werden
+    sofort verworfen. Wiederholte Zeilen/Zellen (table:number-*-repeated) werden aufgelöst, leere
+    Wiederholungen am Zeilen- bzw. Tabellenende aber nicht ausgeschrieben.
+    """
+    with zipfile.ZipFile(file_path) as archive:
+        with archive.open('content.xml') as content:
+            for event, element in etree.iterparse(content, events=('end',), tag=(f'{_TABLE}table-row', f'{_TABLE}table')):
+                if element.tag == f'{_TABLE}table':
+                    return  # nur das erste Tabellenblatt
+                row: List[Any] = []
+                pending_empty = 0
+                for cell in element:
+                    if cell.tag not in (f'{_TABLE}table-cell', f'{_TABLE}covered-table-cell'):
+                        continue
+                    repeat = int(cell.get(f'{_TABLE}number-columns-repeated', '1'))
+                    value = _ods_cell_value(cell)
+                    if value is None:
+                        pending_empty += repeat
+                        continue
+                    row.extend([None] * pending_empty)
+                    pending_empty = 0
+                    row.extend([value] * repeat)
+                row_repeat = int(element.get(f'{_TABLE}number-rows-repeated', '1'))
+                for _ in range(row_repeat if row else 1):
+                    yield tuple(row)
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+
+# --- Excel 97-2003 (.xls) ---
+
+def iter_xls_rows(file_path: str) -> Iterator[tuple]:
+    try:
+        import xlrd
+    except ImportError:
+        raise ValueError("Für .xls-Dateien wird das Python-Paket 'xlrd' benötigt. "
+                         "Bitte installieren oder die Datei als .xlsx bzw. .csv speichern.")
+    book = xlrd.open_workbook(file_path, on_demand=True)
+    try:
+        sheet = book.sheet_by_index(0)
+        for row_index in range(sheet.nrows):
+            row = []
+            for cell in sheet.row(row_index):
+                if cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK):
+                    row.append(None)
+                elif cell.ctype == xlrd.XL_CELL_DATE:
+                    row.append(xlrd.xldate.xldate_as_datetime(cell.value, book.datemode))
+                elif cell.ctype == xlrd.XL_CELL_NUMBER:
+                    row.append(int(cell.value) if float(cell.value).is_integer() else cell.value)
+                elif cell.ctype == xlrd.XL_CELL_BOOLEAN:
+                    row.append(bool(cell.value))
+                elif cell.ctype == xlrd.XL_CELL_ERROR:
+                    row.append(None)
+                else:
+                    row.append(cell.value)
+            yield tuple(row)
+    finally:
+        book.release_resources()
+
+
+TABLE_READERS: Dict[str, Callable[[str], Iterator[tuple]]] = {
+    '.xlsx': iter_xlsx_rows,
+    '.xlsm': iter_xlsx_rows,
+    '.csv': iter_csv_rows,
+    '.ods': iter_ods_rows,
+    '.xls': iter_xls_rows,
+}
+SUPPORTED_EXTENSIONS = tuple(TABLE_READERS)
+
+
+def get_table_reader(file_path: str) -> Callable[[str], Iterator[tuple]]:
+    extension = os.path.splitext(file_path)[1].lower()
+    reader = TABLE_READERS.get(extension)
+    if reader is None:
+        raise ValueError(f"Dateiformat '{extension}' wird nicht unterstützt.")
+    return reader
+
+
+def header_columns(header_row: Optional[tuple]) -> List[Tuple[int, str]]:
+    """
+    Spaltennamen der Kopfzeile mit ihrer tatsächlichen Position. Spalten ohne Überschrift werden
+    übersprungen, ohne dass sich die Zuordnung der folgenden Spalten verschiebt.
+    """
+    columns = []
+    for position, value in enumerate(header_row or ()):
+        if value is not None and str(value).strip() != '':
+            columns.append((position, str(clean_for_json(value)).strip()))
+    return columns
+
+
+def read_table_columns(file_path: str) -> Tuple[List[str], List[List[Any]]]:
+    """
+    Liest eine Tabelle beliebigen unterstützten Formats in einem Durchgang und gibt die Spaltennamen
+    sowie pro Spalte die Werte aller nicht leeren Datenzeilen zurück.
+    """
+    rows = get_table_reader(file_path)(file_path)
+    try:
+        columns = header_columns(next(rows, None))
+        positions = [position for position, _ in columns]
+        column_values: List[List[Any]] = [[] for _ in columns]
+        for row in rows:
+            row_length = len(row)
+            values = [row[position] if position < row_length else None for position in positions]
+            if not any(value is not None and str(value).strip() != '' for value in values):
+                continue
+            for target, value in zip(column_values, values):
+                # Nur Datumswerte brauchen eine Umwandlung (clean_for_json), alle anderen Werte bleiben unverändert
+                target.append(clean_for_json(value) if value.__class__ is datetime else value)
+    finally:
+        rows.close()
+    return [name for _, name in columns], column_values
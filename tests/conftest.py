@@ -0,0 +1,63 @@
+import os
+import sys
+import shutil
+import tempfile
+import itertools
+
+# Vor dem Import der Anwendungsmodule setzen: temporäre Datenbank statt app.db, kurze Wartezeiten bei erneuten Versuchen
+_work_dir = tempfile.mkdtemp(prefix="serienmail_tests_")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_work_dir, 'tests.db')}"
+os.environ.setdefault("ENCRYPTION_KEY", "serienmail-tests")
+os.environ["MAIL_RETRY_BASE_SECONDS"] = "0.1"
+os.environ["MAIL_RETRY_MAX_SECONDS"] = "0.5"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from database import create_db_and_tables, SessionLocal, User
+from settings_manager import save_smtp_settings
+from utils.smtp_sink import SmtpSink
+
+create_db_and_tables()
+
+# Senderate und Tageslimit gelten pro Konto: jeder Test bekommt einen eigenen Benutzer
+_user_numbers = itertools.count(1)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(_work_dir, ignore_errors=True)
+
+
+@pytest.fixture
+def work_dir():
+    return _work_dir
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def smtp_sink():
+    with SmtpSink(store=True, seed=1) as sink:
+        yield sink
+
+
+@pytest.fixture
+def create_user(db, smtp_sink):
+    """Legt einen Benutzer mit SMTP-Einstellungen für den Sink an: create_user(daily_limit=None) -> user_id."""
+    def create(daily_limit=None):
+        number = next(_user_numbers)
+        user = User(username=f"test{number}", email=f"test{number}@example.com", password_hash='-', is_verified=True)
+        db.add(user)
+        db.commit()
+        save_smtp_settings(db, user.id, smtp_sink.host, f"test{number}@example.com", 'test', str(smtp_sink.port), 'none',
+                           daily_limit=daily_limit)
+        return user.id
+    return create
@@ -0,0 +1,125 @@
+import asyncio
+import email
+from datetime import datetime, timedelta
+
+import pytest
+
+from database import SessionLocal, GeneratedFile, ProcessLogEntry
+from email_sender import send_queued_emails
+from mail_queue import (STATE_SUCCESS, STATE_SENDING, STATE_RETRY, STATE_FAILED, enqueue_mailing, idempotency_key,
+                        interrupted_processes, message_id_for, queue_counts)
+
+
+def enqueue(db, user_id, count):
+    process, created = enqueue_mailing(db, user_id, {
+        'excel_file_original_name': 'test.xlsx', 'word_template_original_name': '',
+        'email_subject_template': 'Test ${Nummer}', 'email_body_template': '<p>Hallo ${Name}</p>', 'from_name': 'Test',
+    }, [{
+        'idempotency_key': idempotency_key(f"test{user_id}", '', index),
+        'recipient_email': f"empfaenger{index}@example.com",
+        'recipient_name': f"Empfänger {index}",
+        'pdf_path': None,
+        'subject': f"Test {index}",
+        'body': f"<p>Hallo Empfänger {index}</p>",
+        'body_text': f"Hallo Empfänger {index}",
+    } for index in range(count)])
+    assert created
+    return process
+
+
+def queue_rows(db, process_id):
+    db.expire_all()
+    return db.query(GeneratedFile).filter(GeneratedFile.process_id == process_id).order_by(GeneratedFile.id).all()
+
+
+def message_ids(smtp_sink):
+    return [email.message_from_bytes(data)['Message-ID'] for data in smtp_sink.messages]
+
+
+def test_temporary_failure_is_retried_until_sent(db, smtp_sink, create_user):
+    user_id = create_user()
+    process = enqueue(db, user_id, 1)
+    smtp_sink.temp_fail_rate = 1.0
+
+    def accept_from_now_on(log_entry, finished):
+        # Nur der erste Versuch wird mit 450 abgelehnt
+        smtp_sink.temp_fail_rate = 0.0
+
+    asyncio.run(send_queued_emails(db, user_id, process.id, progress_callback=accept_from_now_on))
+
+    [row] = queue_rows(db, process.id)
+    assert (row.email_sent_status, row.attempts) == (STATE_SUCCESS, 2)
+    assert row.sent_timestamp is not None and row.next_attempt_at is None
+    assert smtp_sink.stats['temp_failures'] == 1
+    # Die E-Mail und das Sendeprotokoll an den Absender
+    assert smtp_sink.stats['accepted'] == 2
+
+
+def test_permanent_failure_is_not_retried(db, smtp_sink, create_user):
+    user_id = create_user()
+    process = enqueue(db, user_id, 1)
+    smtp_sink.perm_fail_rate = 1.0
+
+    asyncio.run(send_queued_emails(db, user_id, process.id))
+
+    [row] = queue_rows(db, process.id)
+    assert (row.email_sent_status, row.attempts) == (STATE_FAILED, 1)
+    assert '550' in row.email_sent_message
+    assert smtp_sink.stats['perm_failures'] == 1
+    assert smtp_sink.stats['accepted'] == 0
+    db.refresh(process)
+    assert process.status == 'failed'
+
+
+def test_interrupted_sending_resumes_open_entries_only(db, smtp_sink, create_user):
+    user_id = create_user()
+    process = enqueue(db, user_id, 3)
+    sent_row, interrupted_row, queued_row = queue_rows(db, process.id)
+    # Zustand nach einem Abbruch: die erste E-Mail ist festgeschrieben, die zweite war gerade in Zustellung
+    sent_row.email_sent_status, sent_row.attempts, sent_row.sent_timestamp = STATE_SUCCESS, 1, datetime.utcnow()
+    interrupted_row.email_sent_status = STATE_SENDING
+    db.commit()
+    assert process.id in [entry['process_id'] for entry in interrupted_processes()]
+
+    asyncio.run(send_queued_emails(db, user_id, process.id))
+
+    assert [row.email_sent_status for row in queue_rows(db, process.id)] == [STATE_SUCCESS] * 3
+    smtp_from_email = f"test{user_id}@example.com"
+    delivered = message_ids(smtp_sink)
+    # Nur die offenen Einträge (plus Sendeprotokoll), mit der festen Message-ID des Eintrags
+    assert len(delivered) == 3
+    assert message_id_for(interrupted_row.idempotency_key, smtp_from_email) in delivered
+    assert message_id_for(queued_row.idempotency_key, smtp_from_email) in delivered
+    assert message_id_for(sent_row.idempotency_key, smtp_from_email) not in delivered
+    assert process.id not in [entry['process_id'] for entry in interrupted_processes()]
+
+
+def test_daily_limit_defers_remaining_entries(db, smtp_sink, create_user):
+    user_id = create_user(daily_limit=2)
+    process = enqueue(db, user_id, 5)
+
+    async def send_until_deferred():
+        # Der Versand wartet danach bis zum nächsten Tag; abgebrochen wird, sobald die Warteschlange feststeht
+        task = asyncio.create_task(send_queued_emails(db, user_id, process.id))
+        poll_db = SessionLocal()
+        try:
+            for _ in range(200):
+                await asyncio.sleep(0.05)
+                if queue_counts(poll_db, process.id) == {STATE_SUCCESS: 2, STATE_RETRY: 3}:
+                    break
+        finally:
+            poll_db.close()
+            task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(send_until_deferred())
+
+    rows = queue_rows(db, process.id)
+    assert [row.email_sent_status for row in rows] == [STATE_SUCCESS] * 2 + [STATE_RETRY] * 3
+    for row in rows[2:]:
+        # Zurückgestellt ohne Zustellversuch, bis die ersten Sendungen aus dem 24-Stunden-Fenster fallen
+        assert row.attempts == 0
+        assert row.next_attempt_at > datetime.utcnow() + timedelta(hours=23)
+    assert smtp_sink.stats['accepted'] == 2
+    assert db.query(ProcessLogEntry).filter(ProcessLogEntry.id == process.id).one().status == STATE_SENDING
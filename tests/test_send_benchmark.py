@@ -0,0 +1,24 @@
+from utils.send_benchmark import run_benchmark
+
+
+def test_benchmark_sends_every_recipient(smtp_sink, work_dir):
+    result = run_benchmark(1, 5, 4, smtp_sink, work_dir, shared_attachment=False, measure_memory=True)
+
+    assert result['sent'] == result['recipients'] == 5
+    # Jede E-Mail plus das Sendeprotokoll an den Absender
+    assert result['sink']['accepted'] == 6
+    assert result['sink']['temp_failures'] == result['sink']['perm_failures'] == result['sink']['disconnects'] == 0
+    assert result['sink']['connections'] >= 1
+    assert 0 <= result['p50_ms'] <= result['p99_ms']
+    assert result['peak_memory_mb'] is not None
+
+
+def test_benchmark_counts_retried_mails_once(smtp_sink, work_dir):
+    smtp_sink.temp_fail_rate = 0.3
+
+    result = run_benchmark(2, 10, 0, smtp_sink, work_dir, shared_attachment=True, measure_memory=False)
+
+    assert result['sent'] == result['recipients'] == 10
+    assert result['sink']['temp_failures'] > 0
+    assert result['sink']['accepted'] == 11
+    assert result['peak_memory_mb'] is None
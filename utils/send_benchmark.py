@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+# Misst den Versand Ende-zu-Ende gegen den lokalen SMTP-Sink (utils/smtp_sink.py) mit einer temporären Datenbank:
+# E-Mails pro Sekunde, Dauer pro E-Mail (p50/p99) und Speicher-Spitze für N Empfänger und verschiedene Anhanggrößen.
+# Aufruf aus dem Projektverzeichnis, z. B.:
+#   python -m utils.send_benchmark --recipients 2000 --attachment-kb 0 100 1024 --latency-ms 20 --temp-fail-rate 0.01
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.smtp_sink import SmtpSink
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Perzentil nach dem Nearest-Rank-Verfahren (0 bei leerer Liste)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(fraction * len(ordered) + 0.5) - 1))]
+
+
+def create_attachments(directory: str, count: int, size_kb: int, shared: bool) -> List[Optional[str]]:
+    """
+    Legt `count` PDF-Anhänge mit `size_kb` KB an (ohne Anhang bei 0). Individuelle Anhänge sind Hardlinks auf
+    eine Datei (eigener Pfad pro Empfänger wie im echten Versand, ohne den Platz mehrfach zu belegen).
+    """
+    if size_kb <= 0:
+        return [None] * count
+    os.makedirs(directory, exist_ok=True)
+    source_path = os.path.join(directory, "anhang.pdf")
+    with open(source_path, 'wb') as f:
+        f.write(b"%PDF-1.4\n")
+        f.write(os.urandom(max(0, size_kb * 1024 - 9)))
+    if shared:
+        return [source_path] * count
+    paths = []
+    for index in range(count):
+        path = os.path.join(directory, f"Dokument_{index:06d}.pdf")
+        try:
+            os.link(source_path, path)
+        except OSError:
+            shutil.copyfile(source_path, path)
+        paths.append(path)
+    return paths
+
+
+def run_benchmark(run_number: int, recipients: int, size_kb: int, sink: SmtpSink, work_dir: str,
+                  shared_attachment: bool, measure_memory: bool) -> Dict[str, Any]:
+    # Erst hier importieren: Datenbank-Pfad und Versand-Einstellungen kommen aus den Umgebungsvariablen (siehe main)
+    from database import SessionLocal, User
+    from settings_manager import save_smtp_settings
+    from mail_queue import enqueue_mailing, idempotency_key, queue_counts, STATE_SUCCESS
+    from email_sender import send_queued_emails
+
+    db = SessionLocal()
+    try:
+        # Eigener Benutzer pro Lauf: Senderate (rate_limiter.py) und Tageslimit gelten pro Konto
+        user = User(username=f"benchmark{run_number}", email=f"benchmark{run_number}@example.com", password_hash='-', is_verified=True)
+        db.add(user)
+        db.commit()
+        save_smtp_settings(db, user.id, sink.host, f"benchmark{run_number}@example.com", 'benchmark', str(sink.port), 'none')
+
+        attachments = create_attachments(os.path.join(work_dir, f"lauf{run_number}"), recipients, size_kb, shared_attachment)
+        process, _ = enqueue_mailing(db, user.id, {
+            'excel_file_original_name': 'benchmark', 'word_template_original_name': '',
+            'email_subject_template': 'Benchmark ${Nummer}', 'email_body_template': '<p>Sehr geehrte/r ${Name},</p>',
+            'from_name': 'Benchmark',
+        }, [{
+            'idempotency_key': idempotency_key(f"benchmark{run_number}", '', index),
+            'recipient_email': f"empfaenger{index}@example.com",
+            'recipient_name': f"Empfänger {index}",
+            'pdf_path': attachments[index],
+            'subject': f"Benchmark {index}",
+            'body': f"<p>Sehr geehrte/r Empfänger {index},</p><p>anbei erhalten Sie Ihr Dokument.</p>",
+            'body_text': f"Sehr geehrte/r Empfänger {index},\nanbei erhalten Sie Ihr Dokument.",
+        } for index in range(recipients)])
+
+        sink_stats_before = dict(sink.stats)
+        if measure_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        process_log = asyncio.run(send_queued_emails(db, user.id, process.id))
+        seconds = time.perf_counter() - started
+        peak_mb = None
+        if measure_memory:
+            peak_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+
+        sent = queue_counts(db, process.id).get(STATE_SUCCESS, 0)
+        latencies = [entry['latency_ms'] for entry in process_log if entry['status'] == 'success' and 'latency_ms' in entry]
+        return {
+            'recipients': recipients,
+            'attachment_kb': size_kb,
+            'sent': sent,
+            'seconds': round(seconds, 3),
+            'messages_per_second': round(sent / seconds, 1) if seconds else 0.0,
+            'p50_ms': percentile(latencies, 0.5),
+            'p99_ms': percentile(latencies, 0.99),
+            'peak_memory_mb': round(peak_mb, 1) if peak_mb is not None else None,
+            'sink': {key: sink.stats[key] - sink_stats_before[key] for key in sink.stats},
+        }
+    finally:
+        db.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Misst den E-Mail-Versand gegen einen lokalen SMTP-Sink.")
+    parser.add_argument("--recipients", type=int, default=1000, help="Anzahl Empfänger pro Lauf")
+    parser.add_argument("--attachment-kb", type=int, nargs='+', default=[0, 100], help="Anhanggrößen in KB (0 = ohne Anhang), ein Lauf pro Größe")
+    parser.add_argument("--shared-attachment", action='store_true', help="Alle Empfänger erhalten dieselbe Datei")
+    parser.add_argument("--connections", type=int, help="Anzahl paralleler SMTP-Verbindungen (SMTP_POOL_SIZE)")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Antwortzeit des Sinks pro Nachricht")
+    parser.add_argument("--temp-fail-rate", type=float, default=0.0, help="Anteil der Nachrichten mit 4xx-Antwort (0-1)")
+    parser.add_argument("--perm-fail-rate", type=float, default=0.0, help="Anteil der Nachrichten mit 5xx-Antwort (0-1)")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="Anteil der Nachrichten mit Verbindungsabbruch (0-1)")
+    parser.add_argument("--temp-fail-code", type=int, default=450, help="Antwortcode für vorübergehende Fehler (421/451 lösen die Drosselung aus)")
+    parser.add_argument("--seed", type=int, default=1, help="Startwert für die Fehlerauswahl des Sinks")
+    parser.add_argument("--no-memory", action='store_true', help="Ohne tracemalloc messen (schneller, aber ohne Speicher-Spitze)")
+    parser.add_argument("--json", action='store_true', help="Ergebnisse als JSON ausgeben (z. B. zum Vergleich zwischen Versionen)")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="send_benchmark_")
+    # Vor dem Import der Anwendungsmodule setzen: temporäre Datenbank statt app.db, kurze Wartezeiten bei erneuten Versuchen
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(work_dir, 'benchmark.db')}"
+    os.environ.setdefault("ENCRYPTION_KEY", "send-benchmark")
+    os.environ.setdefault("MAIL_RETRY_BASE_SECONDS", "0.2")
+    os.environ.setdefault("MAIL_RETRY_MAX_SECONDS", "2")
+    if args.connections:
+        os.environ["SMTP_POOL_SIZE"] = str(args.connections)
+
+    from database import create_db_and_tables
+    create_db_and_tables()
+
+    results = []
+    try:
+        with SmtpSink(latency=args.latency_ms / 1000, temp_fail_rate=args.temp_fail_rate, perm_fail_rate=args.perm_fail_rate,
+                      disconnect_rate=args.disconnect_rate, temp_fail_code=args.temp_fail_code, seed=args.seed) as sink:
+            for run_number, size_kb in enumerate(args.attachment_kb, start=1):
+                result = run_benchmark(run_number, args.recipients, size_kb, sink, work_dir, args.shared_attachment, not args.no_memory)
+                results.append(result)
+                if not args.json:
+                    memory = f"{result['peak_memory_mb']} MB" if result['peak_memory_mb'] is not None else "nicht gemessen"
+                    print(f"Anhang {size_kb} KB: {result['sent']}/{result['recipients']} gesendet in {result['seconds']:.2f} s, "
+                          f"{result['messages_per_second']} E-Mails/s, p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms, "
+                          f"Speicher-Spitze {memory}; Sink: {result['sink']}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
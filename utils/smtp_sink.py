@@ -0,0 +1,198 @@
+import os
+import time
+import random
+import asyncio
+import argparse
+import threading
+from typing import Dict, List, Optional
+
+# Lokaler SMTP-Ersatzserver für Tests und Messungen (siehe utils/send_benchmark.py): nimmt Nachrichten an,
+# zählt sie und speichert sie auf Wunsch. Antwortzeit, vorübergehende (4xx) und endgültige (5xx) Fehler sowie
+# Verbindungsabbrüche lassen sich einstellen. Jede Anmeldung wird akzeptiert, TLS wird nicht angeboten
+# (in den SMTP-Einstellungen Verschlüsselung "none" wählen).
+
+# Größte Nachricht, die der Sink annimmt (Puffergrenze beim Lesen)
+MAX_MESSAGE_BYTES = 256 * 1024 * 1024
+
+
+class SmtpSink:
+    """
+    SMTP-Server in einem eigenen Thread mit eigener Event-Loop. Fehler werden pro Nachricht nach dem DATA-Ende
+    ausgelost: mit `disconnect_rate` wird die Verbindung ohne Antwort geschlossen, mit `temp_fail_rate` bzw.
+    `perm_fail_rate` wird `temp_fail_code` bzw. `perm_fail_code` geantwortet (421/451 gelten in rate_limiter.py als
+    Drosselung, 450 nicht). `store=True` hält die angenommenen
+    Nachrichten in `messages`, `store_dir` schreibt sie zusätzlich als .eml-Dateien.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0,
+                 temp_fail_rate: float = 0.0, perm_fail_rate: float = 0.0, disconnect_rate: float = 0.0,
+                 temp_fail_code: int = 450, perm_fail_code: int = 550,
+                 store: bool = False, store_dir: Optional[str] = None, seed: Optional[int] = None):
+        self.host = host
+        self.port = port # 0 = freien Port wählen, nach start() steht hier der tatsächliche Port
+        self.latency = latency # Sekunden bis zur Antwort auf das DATA-Ende
+        self.temp_fail_rate = temp_fail_rate
+        self.perm_fail_rate = perm_fail_rate
+        self.disconnect_rate = disconnect_rate
+        self.temp_fail_code = temp_fail_code
+        self.perm_fail_code = perm_fail_code
+        self.store = store
+        self.store_dir = store_dir
+        self.messages: List[bytes] = []
+        self.stats: Dict[str, int] = {'connections': 0, 'accepted': 0, 'temp_failures': 0, 'perm_failures': 0,
+                                      'disconnects': 0, 'bytes': 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def _count(self, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self.stats[key] += amount
+
+    def _outcome(self) -> str:
+        with self._lock:
+            draw = self._random.random()
+        if draw < self.disconnect_rate:
+            return 'disconnect'
+        draw -= self.disconnect_rate
+        if draw < self.temp_fail_rate:
+            return 'temp_failure'
+        draw -= self.temp_fail_rate
+        if draw < self.perm_fail_rate:
+            return 'perm_failure'
+        return 'accepted'
+
+    def _keep(self, data: bytes) -> None:
+        with self._lock:
+            self.stats['accepted'] += 1
+            self.stats['bytes'] += len(data)
+            number = self.stats['accepted']
+            if self.store:
+                self.messages.append(data)
+        if self.store_dir:
+            with open(os.path.join(self.store_dir, f"{number:07d}.eml"), 'wb') as f:
+                f.write(data)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._count('connections')
+        writer.write(b"220 smtp-sink ESMTP\r\n")
+        try:
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                command = line[:4].upper()
+                if command == b"EHLO":
+                    writer.write(b"250-smtp-sink\r\n250-8BITMIME\r\n250-AUTH PLAIN LOGIN\r\n250 SIZE 0\r\n")
+                elif command == b"HELO":
+                    writer.write(b"250 smtp-sink\r\n")
+                elif command == b"AUTH":
+                    auth_words = line.split()
+                    if auth_words[1:2] == [b"LOGIN"]:
+                        # AUTH LOGIN: Benutzer (falls nicht schon mitgeschickt) und Passwort werden einzeln abgefragt
+                        prompts = [b"334 VXNlcm5hbWU6\r\n", b"334 UGFzc3dvcmQ6\r\n"][len(auth_words) - 2:]
+                        for prompt in prompts:
+                            writer.write(prompt)
+                            await writer.drain()
+                            if not await reader.readline():
+                                return
+                    writer.write(b"235 2.7.0 Authentication successful\r\n")
+                elif command == b"DATA":
+                    writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                    await writer.drain()
+                    # Die Nachricht am Stück lesen (zeilenweise wäre der Sink bei großen Anhängen selbst der Engpass)
+                    data = b"\r\n" + await reader.readuntil(b"\r\n.\r\n")
+                    data = data[2:-3].replace(b"\r\n..", b"\r\n.") # Punkt-Maskierung (RFC 5321, 4.5.2) entfernen
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    outcome = self._outcome()
+                    if outcome == 'disconnect':
+                        self._count('disconnects')
+                        return
+                    if outcome == 'temp_failure':
+                        self._count('temp_failures')
+                        writer.write(f"{self.temp_fail_code} 4.7.1 Try again later\r\n".encode('ascii'))
+                    elif outcome == 'perm_failure':
+                        self._count('perm_failures')
+                        writer.write(f"{self.perm_fail_code} 5.7.1 Message rejected\r\n".encode('ascii'))
+                    else:
+                        self._keep(data)
+                        writer.write(b"250 2.0.0 Ok: queued\r\n")
+                elif command == b"QUIT":
+                    writer.write(b"221 2.0.0 Bye\r\n")
+                    await writer.drain()
+                    return
+                else: # MAIL, RCPT, RSET, NOOP
+                    writer.write(b"250 2.0.0 Ok\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    def start(self) -> "SmtpSink":
+        """Startet den Server im Hintergrund und kehrt zurück, sobald er Verbindungen annimmt."""
+        if self.store_dir:
+            os.makedirs(self.store_dir, exist_ok=True)
+        ready = threading.Event()
+        self._loop = asyncio.new_event_loop()
+
+        def run() -> None:
+            asyncio.set_event_loop(self._loop)
+            self._server = self._loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port, limit=MAX_MESSAGE_BYTES))
+            self.port = self._server.sockets[0].getsockname()[1]
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="smtp-sink", daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self) -> None:
+        if self._loop is None:
+            return
+
+        async def shutdown() -> None:
+            self._server.close()
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._loop.close()
+        self._loop = None
+
+    def __enter__(self) -> "SmtpSink":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lokaler SMTP-Ersatzserver zum Testen des Versands.")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=2525)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Antwortzeit pro Nachricht in Millisekunden")
+    parser.add_argument("--temp-fail-rate", type=float, default=0.0, help="Anteil der Nachrichten mit 4xx-Antwort (0-1)")
+    parser.add_argument("--perm-fail-rate", type=float, default=0.0, help="Anteil der Nachrichten mit 5xx-Antwort (0-1)")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="Anteil der Nachrichten mit Verbindungsabbruch (0-1)")
+    parser.add_argument("--temp-fail-code", type=int, default=450, help="Antwortcode für vorübergehende Fehler (421/451 = Drosselung)")
+    parser.add_argument("--store-dir", help="Angenommene Nachrichten als .eml-Dateien in diesem Verzeichnis ablegen")
+    args = parser.parse_args()
+
+    sink = SmtpSink(args.host, args.port, args.latency_ms / 1000, args.temp_fail_rate, args.perm_fail_rate,
+                    args.disconnect_rate, temp_fail_code=args.temp_fail_code, store_dir=args.store_dir).start()
+    print(f"SMTP-Sink läuft auf {sink.host}:{sink.port} (Beenden mit Strg+C).")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.stop()
+        print(f"Statistik: {sink.stats}")
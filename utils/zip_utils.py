@@ -0,0 +1,253 @@
+import os
+import time
+import struct
+import zlib
+import zipfile
+from io import BytesIO
+from typing import Iterable, Iterator, List, NamedTuple, Tuple
+
+# Satzstrukturen des ZIP-Formats (identisch zu den Definitionen im Modul zipfile)
+_LOCAL_FILE_HEADER = struct.Struct("<4s2B4HL2L2H")
+_CENTRAL_DIRECTORY_ENTRY = struct.Struct("<4s4B4HL2L5H2L")
+_END_OF_CENTRAL_DIRECTORY = struct.Struct("<4s4H2LH")
+_DATA_DESCRIPTOR = struct.Struct("<4s3L")
+
+_ZIP_VERSION = 20
+_FLAG_UTF8 = 0x800
+_FLAG_DATA_DESCRIPTOR = 0x08
+_ZIP32_LIMIT = 0xFFFFFFFF
+
+
+class RawZipMember(NamedTuple):
+    """Ein ZIP-Eintrag mit seinen bereits komprimierten Daten, wie er in der Quelldatei liegt."""
+    filename: str
+    compress_type: int
+    crc: int
+    file_size: int
+    date_time: Tuple[int, int, int, int, int, int]
+    create_system: int
+    external_attr: int
+    raw_data: memoryview
+
+
+def read_raw_members(zip_bytes: bytes) -> List[RawZipMember]:
+    """
+    Liest alle Einträge eines ZIP-Archivs, ohne sie zu entpacken. Die komprimierten Daten werden
+    als Ausschnitt des Quellpuffers zurückgegeben und können unverändert weitergeschrieben werden.
+    """
+    source = memoryview(zip_bytes)
+    members = []
+    with zipfile.ZipFile(BytesIO(zip_bytes), 'r') as zf:
+        for info in zf.infolist():
+            header = _LOCAL_FILE_HEADER.unpack_from(zip_bytes, info.header_offset)
+            if header[0] != b'PK\x03\x04':
+                raise zipfile.BadZipFile(f"Ungültiger lokaler Header für '{info.filename}'.")
+            # Namens- und Extra-Feld des lokalen Headers können von denen im Verzeichnis abweichen
+            data_start = info.header_offset + _LOCAL_FILE_HEADER.size + header[10] + header[11]
+            members.append(RawZipMember(
+                filename=info.filename,
+                compress_type=info.compress_type,
+                crc=info.CRC,
+                file_size=info.file_size,
+                date_time=info.date_time,
+                create_system=info.create_system,
+                external_attr=info.external_attr,
+                raw_data=source[data_start:data_start + info.compress_size],
+            ))
+    return members
+
+
+def _dos_date_time(date_time: Tuple[int, int, int, int, int, int]) -> Tuple[int, int]:
+    year, month, day, hour, minute, second = date_time
+    dos_date = (max(year, 1980) - 1980) << 9 | month << 5 | day
+    dos_time = hour << 11 | minute << 5 | second // 2
+    return dos_date, dos_time
+
+
+class RawZipWriter:
+    """
+    Minimaler ZIP-Schreiber, der bereits komprimierte Daten unverändert übernehmen kann
+    (zipfile.ZipFile würde jeden Eintrag dekomprimieren und neu komprimieren).
+    Schreibt sequenziell, das Ziel muss also nicht seekable sein.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.offset = 0
+        self._central_directory: List[bytes] = []
+
+    def _write(self, data) -> None:
+        self.fp.write(data)
+        self.offset += len(data)
+
+    def _write_local_header(self, filename: str, crc: int, compress_size: int, file_size: int, compress_type: int,
+                            date_time, flag_bits: int = 0) -> int:
+        """Schreibt den lokalen Header eines Eintrags und gibt dessen Position zurück."""
+        if compress_size > _ZIP32_LIMIT or file_size > _ZIP32_LIMIT or self.offset > _ZIP32_LIMIT:
+            raise ValueError("ZIP-Archive über 4 GB (ZIP64) werden nicht unterstützt.")
+        encoded_name = filename.encode('utf-8')
+        flag_bits |= 0 if filename.isascii() else _FLAG_UTF8
+        dos_date, dos_time = _dos_date_time(date_time)
+        header_offset = self.offset
+        self._write(_LOCAL_FILE_HEADER.pack(
+            b'PK\x03\x04', _ZIP_VERSION, 0, flag_bits, compress_type, dos_time, dos_date,
+            crc, compress_size, file_size, len(encoded_name), 0))
+        self._write(encoded_name)
+        return header_offset
+
+    def _add_directory_entry(self, filename: str, header_offset: int, crc: int, compress_size: int, file_size: int,
+                             compress_type: int, date_time, create_system: int = 0, external_attr: int = 0,
+                             flag_bits: int = 0) -> None:
+        if compress_size > _ZIP32_LIMIT or file_size > _ZIP32_LIMIT:
+            raise ValueError("ZIP-Archive über 4 GB (ZIP64) werden nicht unterstützt.")
+        encoded_name = filename.encode('utf-8')
+        flag_bits |= 0 if filename.isascii() else _FLAG_UTF8
+        dos_date, dos_time = _dos_date_time(date_time)
+        self._central_directory.append(_CENTRAL_DIRECTORY_ENTRY.pack(
+            b'PK\x01\x02', _ZIP_VERSION, create_system, _ZIP_VERSION, 0, flag_bits, compress_type,
+            dos_time, dos_date, crc, compress_size, file_size, len(encoded_name), 0, 0, 0, 0,
+            external_attr, header_offset) + encoded_name)
+
+    def add_raw(self, filename: str, raw_data, crc: int, file_size: int, compress_type: int,
+                date_time=(1980, 1, 1, 0, 0, 0), create_system: int = 0, external_attr: int = 0) -> None:
+        """Schreibt einen Eintrag, dessen Daten bereits im Zielformat (`compress_type`) vorliegen."""
+        compress_size = len(raw_data)
+        header_offset = self._write_local_header(filename, crc, compress_size, file_size, compress_type, date_time)
+        self._write(raw_data)
+        self._add_directory_entry(filename, header_offset, crc, compress_size, file_size, compress_type,
+                                  date_time, create_system, external_attr)
+
+    def add_chunks(self, filename: str, chunks: Iterable[bytes], crc: int, file_size: int,
+                   date_time=(1980, 1, 1, 0, 0, 0), external_attr: int = 0o100644 << 16) -> Iterator[None]:
+        """
+        Schreibt einen unkomprimierten Eintrag (STORED) stückweise. CRC und Größe müssen vorab bekannt sein,
+        dafür braucht der Eintrag keinen Datendeskriptor und ist mit allen Entpackprogrammen lesbar.
+        Liefert nach jedem geschriebenen Stück die Kontrolle zurück, damit der Aufrufer Daten abholen kann.
+        """
+        header_offset = self._write_local_header(filename, crc, file_size, file_size, zipfile.ZIP_STORED, date_time)
+        yield
+        written = 0
+        for chunk in chunks:
+            self._write(chunk)
+            written += len(chunk)
+            yield
+        if written != file_size:
+            raise ValueError(f"'{filename}' hat sich während des Schreibens verändert.")
+        self._add_directory_entry(filename, header_offset, crc, file_size, file_size, zipfile.ZIP_STORED,
+                                  date_time, 3, external_attr)
+
+    def add_deflated_chunks(self, filename: str, chunks: Iterable[bytes], date_time=(1980, 1, 1, 0, 0, 0),
+                            compresslevel: int = 6, external_attr: int = 0o100644 << 16) -> Iterator[None]:
+        """
+        Komprimiert einen Eintrag stückweise. CRC und Größen stehen erst am Ende fest und werden in einem
+        Datendeskriptor hinter den Daten abgelegt.
+        """
+        header_offset = self._write_local_header(filename, 0, 0, 0, zipfile.ZIP_DEFLATED, date_time, _FLAG_DATA_DESCRIPTOR)
+        yield
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        crc, file_size, compress_size = 0, 0, 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            compressed = compressor.compress(chunk)
+            if compressed:
+                self._write(compressed)
+                compress_size += len(compressed)
+                yield
+        compressed = compressor.flush()
+        self._write(compressed)
+        compress_size += len(compressed)
+        self._write(_DATA_DESCRIPTOR.pack(b'PK\x07\x08', crc, compress_size, file_size))
+        self._add_directory_entry(filename, header_offset, crc, compress_size, file_size, zipfile.ZIP_DEFLATED,
+                                  date_time, 3, external_attr, _FLAG_DATA_DESCRIPTOR)
+        yield
+
+    def add_bytes(self, filename: str, data: bytes, compress: bool = True,
+                  date_time=(1980, 1, 1, 0, 0, 0), compresslevel: int = 6) -> None:
+        """Schreibt unkomprimierte Daten, wahlweise als Deflate-Eintrag."""
+        crc = zlib.crc32(data)
+        if compress:
+            compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+            raw_data = compressor.compress(data) + compressor.flush()
+            compress_type = zipfile.ZIP_DEFLATED
+        else:
+            raw_data = data
+            compress_type = zipfile.ZIP_STORED
+        self.add_raw(filename, raw_data, crc, len(data), compress_type, date_time)
+
+    def add_member(self, member: RawZipMember) -> None:
+        self.add_raw(member.filename, member.raw_data, member.crc, member.file_size, member.compress_type,
+                     member.date_time, member.create_system, member.external_attr)
+
+    def close(self) -> None:
+        """Schreibt das zentrale Verzeichnis und den Abschlussdatensatz."""
+        if len(self._central_directory) > 0xFFFF:
+            raise ValueError("ZIP-Archive mit mehr als 65535 Einträgen (ZIP64) werden nicht unterstützt.")
+        directory_offset = self.offset
+        for entry in self._central_directory:
+            self._write(entry)
+        directory_size = self.offset - directory_offset
+        count = len(self._central_directory)
+        self._write(_END_OF_CENTRAL_DIRECTORY.pack(
+            b'PK\x05\x06', 0, 0, count, count, directory_size, directory_offset, 0))
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class _ChunkBuffer:
+    """Sammelt, was der RawZipWriter schreibt, bis der Generator es abholt."""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+
+    def write(self, data) -> None:
+        self.chunks.append(bytes(data))
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _read_file_chunks(path: str, chunk_size: int) -> Iterator[bytes]:
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _file_crc(path: str, chunk_size: int) -> int:
+    crc = 0
+    for chunk in _read_file_chunks(path, chunk_size):
+        crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def stream_zip_files(files: Iterable[Tuple[str, str]], compress: bool = False,
+                     chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Erzeugt ein ZIP-Archiv aus (Pfad, Name im Archiv)-Paaren als Folge von Byte-Blöcken, z.B. für eine
+    StreamingResponse. Es wird nichts zwischengespeichert; der Speicherbedarf hängt nur von `chunk_size`
+    und der Größe des zentralen Verzeichnisses ab.
+    Ohne `compress` werden die Dateien unverändert abgelegt (für PDFs, die bereits komprimiert sind,
+    ist das kaum größer und deutlich schneller). Die CRC wird dafür in einem ersten Lesedurchgang bestimmt.
+    """
+    buffer = _ChunkBuffer()
+    writer = RawZipWriter(buffer)
+    for path, archive_name in files:
+        stat_result = os.stat(path)
+        date_time = time.localtime(stat_result.st_mtime)[:6]
+        if compress:
+            steps = writer.add_deflated_chunks(archive_name, _read_file_chunks(path, chunk_size), date_time)
+        else:
+            steps = writer.add_chunks(archive_name, _read_file_chunks(path, chunk_size), _file_crc(path, chunk_size),
+                                      stat_result.st_size, date_time)
+        for _ in steps:
+            data = buffer.drain()
+            if data:
+                yield data
+    writer.close()
+    yield buffer.drain()